@@ -1,35 +1,2419 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash, g, has_app_context
 import json
+import click
 import os
-from datetime import datetime, timedelta
+import sqlite3
+import numpy as np
+from datetime import datetime, timedelta, date
 import random
 import hashlib
+import re
+import secrets
+import threading
+import time
+import atexit
+from bisect import bisect_left, insort
 from functools import wraps
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: cross-process file locks are not available
+    fcntl = None
 
 # app declaration
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'  # Change this to a secure random key in production
 
+# Storage configuration ('json' or 'sqlite')
+app.config['STORAGE_BACKEND'] = os.environ.get('STORAGE_BACKEND', 'json')
+app.config['SQLITE_PATH'] = os.environ.get('SQLITE_PATH', 'data/store.db')
+
+# Start loading data and warming caches in the background as soon as the app
+# is imported; when off, this starts with the first request. `flask` CLI
+# commands other than `flask run` never warm up on import.
+app.config['WARM_UP_ON_IMPORT'] = os.environ.get('WARM_UP_ON_IMPORT', '1') == '1'
+
+# Price history retention: daily prices for this many days, then weekly
+# aggregates up to the second limit, then monthly aggregates kept indefinitely.
+# Per-product overrides of the daily window are given as JSON, e.g. {"101": 30}
+app.config['PRICE_HISTORY_DAILY_DAYS'] = int(os.environ.get('PRICE_HISTORY_DAILY_DAYS', 90))
+app.config['PRICE_HISTORY_WEEKLY_DAYS'] = int(os.environ.get('PRICE_HISTORY_WEEKLY_DAYS', 730))
+app.config['PRICE_HISTORY_PRODUCT_DAILY_DAYS'] = {
+    int(product_id): int(days)
+    for product_id, days in json.loads(os.environ.get('PRICE_HISTORY_PRODUCT_DAILY_DAYS', '{}')).items()
+}
+
+# Shopping carts: how many each worker keeps in memory, and how many days a
+# cart can go unchanged before it is deleted as abandoned
+app.config['CART_CACHE_SIZE'] = int(os.environ.get('CART_CACHE_SIZE', 1024))
+app.config['CART_MAX_AGE_DAYS'] = int(os.environ.get('CART_MAX_AGE_DAYS', 30))
+
 # Load data
 def load_data(filename):
     with open(filename, 'r') as f:
         return json.load(f)
 
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock shared by every process (and thread) working on `path`,
+    held on a side '.lock' file so the data file itself can be replaced.
+    The holder may delete the lock file; waiters then lock the new one.
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = f"{path}.lock"
+    while True:
+        f = open(lock_path, 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.fstat(f.fileno()).st_ino == os.stat(lock_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        f.close()
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+def file_inode(path):
+    try:
+        return os.stat(path).st_ino
+    except FileNotFoundError:
+        return None
+
+def file_stamp(path):
+    """
+    Cheap version stamp for a file: changes whenever it is replaced or written
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def write_bytes_atomic(contents, filepath):
+    """
+    Write bytes to a temporary file and rename it over `filepath`, so readers
+    and crashes only ever see the old or the new complete file
+    """
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, filepath)
+
+def write_json_atomic(data, filepath):
+    write_bytes_atomic(json.dumps(data, indent=2).encode('utf-8'), filepath)
+
+SAVE_COALESCE_DELAY = 0.5  # seconds a save waits for further saves of the same file
+SAVE_RETRY_DELAY = 1.0     # seconds before retrying a failed save, doubled after each failure...
+SAVE_RETRY_MAX_DELAY = 60.0  # ...up to this
+
+class SaveError(Exception):
+    """
+    Raised by WriteBehindWriter.flush() for saves that failed; they stay pending and are retried
+    """
+
+class WriteBehindWriter:
+    """
+    Background thread that persists datasets off the request path.
+
+    Saves of the same target (a file path by default) that arrive within
+    SAVE_COALESCE_DELAY of each other are coalesced into one call of
+    `write(data, target)` with the latest data. A save that fails is kept
+    pending and retried with a growing delay, so the data is not lost when
+    the disk or database is unavailable for a while. flush() is a barrier
+    that returns once everything scheduled so far is on disk, and raises
+    SaveError if some of it could not be written.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.pending = {}   # target -> [data, due time, write]
+        self.in_flight = set()
+        self.attempts = {}  # target -> number of writes tried so far
+        self.failures = {}  # target -> (consecutive failures, last error)
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def schedule(self, data, target, write=write_json_atomic):
+        with self.condition:
+            if target in self.pending:
+                self.pending[target][0] = data
+            else:
+                self.pending[target] = [data, time.monotonic() + self.delay, write]
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    now = time.monotonic()
+                    due = [target for target, (_, due_time, _) in self.pending.items() if due_time <= now]
+                    if due:
+                        break
+                    if not self.pending:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(min(entry[1] for entry in self.pending.values()) - now)
+                batch = [(target, self.pending.pop(target)) for target in due]
+                self.in_flight.update(due)
+
+            for target, (data, _, write) in batch:
+                try:
+                    write(data, target)
+                    with self.condition:
+                        self.failures.pop(target, None)
+                except Exception as e:
+                    if isinstance(e, RuntimeError) and 'interpreter shutdown' in str(e):
+                        # Nothing can wait out a backoff once the interpreter is exiting; retry now
+                        with self.condition:
+                            self.pending.setdefault(target, [data, time.monotonic(), write])
+                        continue
+                    self._retry_later(target, data, write, e)
+
+            with self.condition:
+                for target in due:
+                    self.attempts[target] = self.attempts.get(target, 0) + 1
+                self.in_flight.difference_update(due)
+                self.condition.notify_all()
+
+    def _retry_later(self, target, data, write, e):
+        """
+        Record a failed write of `target` and keep it pending for a retry
+        after a delay that doubles with each consecutive failure
+        """
+        with self.condition:
+            count = self.failures.get(target, (0, None))[0] + 1
+            self.failures[target] = (count, e)
+            retry_delay = min(SAVE_RETRY_DELAY * 2 ** (count - 1), SAVE_RETRY_MAX_DELAY)
+            # Newer data scheduled in the meantime replaces this one
+            self.pending.setdefault(target, [data, time.monotonic() + retry_delay, write])
+        print(f"Error saving {target} (attempt {count}, retrying in {retry_delay:g}s): {str(e)}")
+
+    def is_pending(self, target):
+        with self.condition:
+            return target in self.pending or target in self.in_flight
+
+    def flush(self):
+        with self.condition:
+            # Each target waits for one more attempt; failed ones are not retried here again
+            waiting = {target: self.attempts.get(target, 0) for target in set(self.pending) | self.in_flight}
+            for entry in self.pending.values():
+                entry[1] = 0
+            self.condition.notify_all()
+
+            def unsaved(target):
+                return target in self.pending or target in self.in_flight
+
+            def settled(target):
+                return not unsaved(target) or (target in self.failures and self.attempts.get(target, 0) > waiting[target])
+
+            while not all(settled(target) for target in waiting):
+                self.condition.wait()
+            failed = {target: self.failures[target][1] for target in waiting
+                      if unsaved(target) and target in self.failures}
+        if failed:
+            raise SaveError('; '.join(f"{target}: {str(e)}" for target, e in failed.items()))
+
+data_writer = WriteBehindWriter(SAVE_COALESCE_DELAY)
+atexit.register(data_writer.flush)
+
+# Order history write-ahead log
+ORDER_LOG_FSYNC_BATCH = 20                # fsync after this many unsynced orders...
+ORDER_LOG_FSYNC_INTERVAL = 1.0            # ...or once this many seconds have passed since the last fsync
+ORDER_LOG_COMPACT_SIZE = 1024 * 1024      # fold the log into the snapshot once it grows past this many bytes
+
+class OrderLog:
+    """
+    Append-only order log next to the order history snapshot.
+
+    Each checkout appends one JSON line to the log instead of rewriting the
+    snapshot. fsync is batched across orders, with a timer covering the last
+    batch when orders stop coming, and once the log grows past
+    ORDER_LOG_COMPACT_SIZE it is rotated and folded into a new snapshot in a
+    background thread. Loading replays rotated log + snapshot + log, skipping
+    orders already seen.
+
+    Several processes can share the log: appends and rotation happen under a
+    cross-process lock on the log, compaction under a lock on the snapshot,
+    and refresh() picks up orders other processes appended since this one
+    last read the log.
+    """
+
+    def __init__(self, snapshot_path, log_path):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.rotated_path = log_path + '.1'
+        self.lock = threading.Lock()
+        self.data = None
+        self.seen = set()
+        self.file = None
+        self.read_inode = None   # inode of the log file read so far...
+        self.read_offset = 0     # ...and how far into it
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.sync_timer = None
+        self.compacting = None
+
+    def load(self):
+        if os.path.exists(self.rotated_path):
+            # Finish a compaction interrupted by a restart (no-op if another process is on it)
+            self._compact()
+        
+        with self.lock, file_lock(self.log_path):
+            # The rotated log is read before the snapshot so a compaction finishing
+            # in between cannot hide its orders
+            rotated_orders, _ = self._read_log(self.rotated_path)
+            data = load_data(self.snapshot_path)
+            self.seen = set(order['id'] for order in data['orders'])
+            self.data = data
+            self._add_orders(rotated_orders)
+            self.read_inode = file_inode(self.log_path)
+            self.read_offset = 0
+            if self.read_inode is not None:
+                orders, self.read_offset = self._read_log(self.log_path, repair=True)
+                self._add_orders(orders)
+            self.file = open(self.log_path, 'a')
+            if self.read_inode is None:
+                self.read_inode = file_inode(self.log_path)
+        return data
+
+    def _add_orders(self, orders):
+        added = []
+        for order in orders:
+            if order['id'] not in self.seen:
+                self.seen.add(order['id'])
+                self.data['orders'].append(order)
+                added.append(order)
+        return added
+
+    def _read_log(self, path, offset=0, repair=False):
+        """
+        Return (orders, end offset) for the complete lines of a log file after `offset`
+        """
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                lines = f.readlines()
+        except FileNotFoundError:
+            return [], offset
+        orders = []
+        for line in lines:
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError('incomplete line')
+                order = json.loads(line)
+            except ValueError:
+                # A torn final line from a crash mid-append. When holding the log
+                # lock, cut it off so new orders are not appended after it
+                if repair:
+                    with open(path, 'r+b') as f:
+                        f.truncate(offset)
+                break
+            orders.append(order)
+            offset += len(line)
+        return orders, offset
+
+    def refresh(self):
+        """
+        Add orders appended by other processes to the loaded data and return them
+        """
+        with self.lock:
+            orders = []
+            try:
+                stat = os.stat(self.log_path)
+                inode, size = stat.st_ino, stat.st_size
+            except FileNotFoundError:
+                inode, size = None, 0
+            if inode == self.read_inode and size < self.read_offset:
+                # Shorter than what was read: the log was rotated and compacted
+                # away, and the new log reuses its inode
+                orders = load_data(self.snapshot_path)['orders']
+                self.read_offset = 0
+            elif inode != self.read_inode:
+                # The log was rotated: finish the old one, then start on the new one
+                if file_inode(self.rotated_path) == self.read_inode:
+                    orders, _ = self._read_log(self.rotated_path, self.read_offset)
+                else:
+                    # The rotated log was already compacted away; catch up from the snapshot
+                    orders = load_data(self.snapshot_path)['orders']
+                self.read_inode, self.read_offset = inode, 0
+            if inode is not None:
+                new_orders, self.read_offset = self._read_log(self.log_path, self.read_offset)
+                orders.extend(new_orders)
+            return self._add_orders(orders)
+
+    def append(self, order):
+        with self.lock, file_lock(self.log_path):
+            if os.fstat(self.file.fileno()).st_ino != file_inode(self.log_path):
+                # Another process rotated the log
+                self._sync()
+                self.file.close()
+                self.file = open(self.log_path, 'a')
+            
+            size_before = os.fstat(self.file.fileno()).st_size
+            self.file.write(json.dumps(order) + '\n')
+            self.file.flush()
+            size_after = os.fstat(self.file.fileno()).st_size
+            if self.read_inode == os.fstat(self.file.fileno()).st_ino and self.read_offset == size_before:
+                # Nothing from other processes in between, so there is no need to read our own line back
+                self.read_offset = size_after
+            self.seen.add(order['id'])
+            
+            self.unsynced += 1
+            if (self.unsynced >= ORDER_LOG_FSYNC_BATCH
+                    or time.monotonic() - self.last_sync >= ORDER_LOG_FSYNC_INTERVAL):
+                self._sync()
+            elif self.sync_timer is None:
+                # fsync this order within the interval even if no other order follows
+                self.sync_timer = threading.Timer(ORDER_LOG_FSYNC_INTERVAL, self._timed_sync)
+                self.sync_timer.daemon = True
+                self.sync_timer.start()
+            if size_after >= ORDER_LOG_COMPACT_SIZE:
+                self._start_compaction()
+
+    def sync(self):
+        with self.lock:
+            if self.unsynced:
+                self._sync()
+
+    def _timed_sync(self):
+        with self.lock:
+            self.sync_timer = None
+            if self.unsynced:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def _start_compaction(self):
+        """
+        Rotate the log; called with both the log lock and the file lock held
+        """
+        if self.compacting and self.compacting.is_alive():
+            return
+        if os.path.exists(self.rotated_path):
+            # A previous compaction has not finished yet
+            return
+        # Rotate the log so new orders go to a fresh file while the snapshot is written
+        self._sync()
+        self.file.close()
+        os.replace(self.log_path, self.rotated_path)
+        self.file = open(self.log_path, 'a')
+        self.compacting = threading.Thread(target=self._compact, daemon=True)
+        self.compacting.start()
+
+    def _compact(self):
+        with file_lock(self.snapshot_path):
+            if not os.path.exists(self.rotated_path):
+                return
+            data = load_data(self.snapshot_path)
+            seen = set(order['id'] for order in data['orders'])
+            orders, _ = self._read_log(self.rotated_path)
+            data['orders'].extend(order for order in orders if order['id'] not in seen)
+            write_json_atomic(data, self.snapshot_path)
+            os.remove(self.rotated_path)
+
+    def compact(self):
+        """
+        Fold the log into the snapshot and wait for it to finish
+        """
+        with self.lock, file_lock(self.log_path):
+            self._start_compaction()
+            compacting = self.compacting
+        if compacting:
+            compacting.join()
+
+# Location registry
+class LocationRegistry:
+    """
+    Interns every district to a dense integer location id. Price history,
+    inventory and predictions key locations by these ids; "city_district"
+    string keys are only built or parsed where data enters or leaves the app
+    (files, SQLite tables, URLs and JSON responses).
+
+    Ids are handed out in first-seen order, starting with the locations dataset's
+    order at load, and never reused, so they stay valid for the life of the
+    process. They are not persisted; stored data keeps string keys.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = []     # location id -> "city_district" key
+        self.pairs = []    # location id -> (city id, district id)
+        self.ids = {}      # (city id, district id) -> location id
+        self.key_ids = {}  # "city_district" key -> location id
+
+    def __len__(self):
+        return len(self.keys)
+
+    def intern(self, city_id, district_id):
+        location_id = self.ids.get((city_id, district_id))
+        if location_id is None:
+            with self.lock:
+                location_id = self.ids.get((city_id, district_id))
+                if location_id is None:
+                    location_id = len(self.keys)
+                    location_key = f"{city_id}_{district_id}"
+                    self.keys.append(location_key)
+                    self.pairs.append((city_id, district_id))
+                    self.key_ids[location_key] = location_id
+                    self.ids[(city_id, district_id)] = location_id
+        return location_id
+
+    def id_for_key(self, location_key):
+        location_id = self.key_ids.get(location_key)
+        if location_id is None:
+            city_id, district_id = map(int, location_key.split('_'))
+            location_id = self.intern(city_id, district_id)
+        return location_id
+
+    def find(self, city_id, district_id):
+        """
+        Id of a district that has already been interned, else None
+        """
+        return self.ids.get((city_id, district_id))
+
+    def find_key(self, location_key):
+        return self.key_ids.get(location_key)
+
+    def register(self, locations):
+        for city in locations['cities']:
+            for district in city['districts']:
+                self.intern(city['id'], district['id'])
+
+    def location(self, location_id):
+        """
+        Return the (city, district) of a location id; either is None if it no longer exists
+        """
+        city_id, district_id = self.pairs[location_id]
+        return get_city_by_id(city_id), get_district_by_id(city_id, district_id)
+
+    def name(self, location_id):
+        city, district = self.location(location_id)
+        return f"{city['name']}, {district['name']}" if city and district else self.keys[location_id]
+
+    def price_factors(self):
+        """
+        District price factor per location id, NaN for districts that no longer exist
+        """
+        return np.array([district['price_factor'] if district else np.nan
+                         for _, district in map(self.location, range(len(self.keys)))], dtype=np.float64)
+
+location_registry = LocationRegistry()
+
+# Price history store
+LOCATION_KEY_BITS = 20  # location ids are packed into the low bits of a row key
+LOCATION_KEY_MASK = (1 << LOCATION_KEY_BITS) - 1
+PRICE_RECORD = np.dtype([('key', '<i8'), ('price', '<i8')])  # fixed-width on-disk record
+
+class DayPartition:
+    """
+    One day of price history as an array of PRICE_RECORD records sorted by
+    key (product id and location id packed into one integer).
+
+    The records may be a read-only memory map of a partition file; the first
+    upsert copies them into memory.
+    """
+
+    __slots__ = ('ordinal', 'records')
+
+    def __init__(self, ordinal, records=None):
+        self.ordinal = ordinal
+        self.records = records if records is not None else np.zeros(0, dtype=PRICE_RECORD)
+
+    @classmethod
+    def from_rows(cls, ordinal, rows):
+        """
+        Build a partition from (key, price) pairs with unique keys
+        """
+        records = np.array(list(rows), dtype=PRICE_RECORD)
+        records.sort(order='key')
+        return cls(ordinal, records)
+
+    @property
+    def keys(self):
+        return self.records['key']
+
+    @property
+    def prices(self):
+        return self.records['price']
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, key):
+        keys = self.keys
+        i = int(np.searchsorted(keys, key))
+        if i < len(keys) and keys[i] == key:
+            return i
+        return -1
+
+    def key_range(self, low, high):
+        """
+        Return the (start, stop) rows with low <= key < high
+        """
+        keys = self.keys
+        return int(np.searchsorted(keys, low)), int(np.searchsorted(keys, high))
+
+    def upsert(self, key, price):
+        """
+        Set the price for a key. Returns True if a new row was added
+        """
+        i = self.find(key)
+        if i >= 0:
+            if not self.records.flags.writeable:
+                self.records = np.array(self.records)
+            self.records['price'][i] = price
+            return False
+        i = int(np.searchsorted(self.keys, key))
+        self.records = np.insert(self.records, i, np.array((key, price), dtype=PRICE_RECORD))
+        return True
+
+# Price history retention
+AGGREGATE_WEEKLY = 7     # resolution values of aggregate records
+AGGREGATE_MONTHLY = 30
+AGGREGATE_RESOLUTIONS = {AGGREGATE_WEEKLY: 'weekly', AGGREGATE_MONTHLY: 'monthly'}
+# One period of one product and location: `period` is the ordinal of its first
+# day and `last` the ordinal of the latest day folded in, whose price is `close`
+AGGREGATE_RECORD = np.dtype([
+    ('resolution', '<i8'), ('key', '<i8'), ('period', '<i8'), ('last', '<i8'),
+    ('min', '<i8'), ('max', '<i8'), ('sum', '<i8'), ('count', '<i8'), ('close', '<i8')
+])
+AGGREGATE_COLUMNS = ('resolution', 'product_id', 'location_key', 'period', 'last',
+                     'min', 'max', 'sum', 'count', 'close')  # aggregate_entries() fields as stored
+UNIX_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def week_starts(ordinals):
+    # Ordinal 1 (0001-01-01) is a Monday
+    return (ordinals - 1) // 7 * 7 + 1
+
+def month_starts(ordinals):
+    days = (ordinals - UNIX_EPOCH_ORDINAL).astype('datetime64[D]')
+    return days.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + UNIX_EPOCH_ORDINAL
+
+def weekly_aggregates(records, ordinal):
+    """
+    Turn one day's PRICE_RECORDs into single-day weekly aggregate records
+    """
+    aggregates = np.zeros(len(records), dtype=AGGREGATE_RECORD)
+    aggregates['resolution'] = AGGREGATE_WEEKLY
+    aggregates['key'] = records['key']
+    aggregates['period'] = week_starts(np.full(len(records), ordinal, dtype=np.int64))
+    aggregates['last'] = ordinal
+    for field in ('min', 'max', 'sum', 'close'):
+        aggregates[field] = records['price']
+    aggregates['count'] = 1
+    return aggregates
+
+def merge_aggregates(*parts):
+    """
+    Combine aggregate records, folding records of the same resolution, key
+    and period into one
+    """
+    records = np.concatenate(parts)
+    if not len(records):
+        return records
+    records = records[np.lexsort((records['last'], records['period'], records['key'], records['resolution']))]
+    changed = np.zeros(len(records) - 1, dtype=bool)
+    for field in ('resolution', 'key', 'period'):
+        changed |= records[field][1:] != records[field][:-1]
+    starts = np.concatenate(([0], np.flatnonzero(changed) + 1))
+    ends = np.concatenate((starts[1:], [len(records)])) - 1
+    merged = records[ends].copy()  # latest `last` and `close` of each group
+    merged['min'] = np.minimum.reduceat(records['min'], starts)
+    merged['max'] = np.maximum.reduceat(records['max'], starts)
+    merged['sum'] = np.add.reduceat(records['sum'], starts)
+    merged['count'] = np.add.reduceat(records['count'], starts)
+    return merged
+
+class PriceHistoryStore:
+    """
+    Process-resident price history, partitioned by day.
+
+    Each DayPartition keeps its rows sorted by (product, location) key, so a
+    product/location lookup is a binary search per day and a product filter
+    a key range. With the JSON backend partitions are memory-mapped from
+    fixed-width binary files, so loading does not parse the history. New
+    days are appended and old days dropped as whole partitions, without
+    touching the rest of the history. `last_ingested` is the watermark of
+    the last daily ingestion. compact() folds days past the retention window
+    into weekly and monthly aggregates.
+
+    The store is loaded from and saved through the storage backend. Changes
+    since the last save are journaled (upserted rows, appended and dropped
+    days) so backends only write what changed. `version` is bumped on every
+    change so derived results know when to recompute.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.load_lock = threading.Lock()  # serializes the first load
+        self.loaded = False
+        self.version = 0
+        self._reset()
+        self._clear_changes()
+
+    def _reset(self):
+        self.partitions = {}         # date ordinal -> DayPartition
+        self.days = []               # sorted date ordinals
+        self.count = 0
+        self.last_ingested = None    # date ordinal
+        self.aggregates = np.zeros(0, dtype=AGGREGATE_RECORD)  # sorted by resolution, key, period
+        # Every key with daily rows, sorted, and how many days it has rows on
+        self.pair_keys = np.zeros(0, dtype=np.int64)
+        self.pair_rows = np.zeros(0, dtype=np.int64)
+        self.pair_products = Counter()
+        self.pair_locations = Counter()
+        self.display_order = None    # (version, keys in display order, their sort values, sort value function)
+
+    def _clear_changes(self):
+        self.changes = []            # upserted (product_id, location_key, date, price) rows
+        self.new_days = set()        # ordinals of days appended or rewritten whole
+        self.dropped_days = set()    # ordinals of days removed
+        self.aggregates_changed = False
+        self.rewrite = False         # everything was replaced
+
+    def _key(self, product_id, location_key):
+        return (product_id << LOCATION_KEY_BITS) | location_registry.id_for_key(location_key)
+
+    @staticmethod
+    def _relocate(records, location_keys):
+        """
+        Re-key records whose location ids index `location_keys` (as stored) to
+        registry location ids. Returns `records` itself when the ids already agree.
+        """
+        location_ids = np.array([location_registry.id_for_key(key) for key in location_keys], dtype=np.int64)
+        if np.array_equal(location_ids, np.arange(len(location_keys))) or not len(records):
+            return records
+        records = np.array(records)
+        records['key'] = (records['key'] & ~LOCATION_KEY_MASK) | location_ids[records['key'] & LOCATION_KEY_MASK]
+        return records
+
+    def _count_keys(self, keys, delta):
+        """
+        Add `delta` (+1 or -1) to the row counts of sorted, unique `keys` in
+        the pair index, in time linear in the index size
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(keys):
+            return
+        positions = np.searchsorted(self.pair_keys, keys)
+        if delta > 0:
+            present = positions < len(self.pair_keys)
+            present[present] = self.pair_keys[positions[present]] == keys[present]
+            if not present.all():
+                self._count_pairs(keys[~present], 1)
+                self.pair_keys = np.insert(self.pair_keys, positions[~present], keys[~present])
+                self.pair_rows = np.insert(self.pair_rows, positions[~present], 0)
+                positions = np.searchsorted(self.pair_keys, keys)
+        self.pair_rows[positions] += delta
+        if delta < 0:
+            kept = self.pair_rows > 0
+            if not kept.all():
+                self._count_pairs(self.pair_keys[~kept], -1)
+                self.pair_keys = self.pair_keys[kept]
+                self.pair_rows = self.pair_rows[kept]
+
+    def _count_pairs(self, keys, delta):
+        """
+        Add `delta` to the per-product and per-location counts of product and
+        location pairs, so unique_counts never rescans the pair index
+        """
+        for counter, ids in ((self.pair_products, keys >> LOCATION_KEY_BITS),
+                             (self.pair_locations, keys & LOCATION_KEY_MASK)):
+            values, counts = np.unique(ids, return_counts=True)
+            for value, count in zip(values.tolist(), counts.tolist()):
+                counter[value] += delta * count
+                if counter[value] <= 0:
+                    del counter[value]
+
+    def _add_partition(self, partition):
+        if partition.ordinal not in self.partitions:
+            insort(self.days, partition.ordinal)
+        else:
+            self.count -= len(self.partitions[partition.ordinal])
+            self._count_keys(self.partitions[partition.ordinal].keys, -1)
+        self.partitions[partition.ordinal] = partition
+        self.count += len(partition)
+        self._count_keys(partition.keys, 1)
+
+    def _load_entries(self, entries):
+        by_day = {}
+        ordinals = {}
+        for entry in entries:
+            ordinal = ordinals.get(entry['date'])
+            if ordinal is None:
+                ordinal = ordinals[entry['date']] = date.fromisoformat(entry['date']).toordinal()
+            by_day.setdefault(ordinal, {})[self._key(entry['product_id'], entry['location_key'])] = entry['price']
+        for ordinal, rows in by_day.items():
+            self._add_partition(DayPartition.from_rows(ordinal, rows.items()))
+
+    def _load_partitions(self, partitions, location_keys):
+        """
+        Install stored partitions; returns False if their location ids had to
+        be translated, so the files no longer match memory
+        """
+        relocated = False
+        for date_str, records in partitions:
+            relocated_records = self._relocate(records, location_keys)
+            if relocated_records is not records:
+                relocated = True
+                relocated_records = np.sort(relocated_records, order='key')
+            self._add_partition(DayPartition(date.fromisoformat(date_str).toordinal(), relocated_records))
+        return not relocated
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        # Checked again under the lock: the warm-up thread and requests can
+        # get here together, and a second load would drop days appended since
+        with self.load_lock:
+            if not self.loaded:
+                self.load()
+
+    def _load_aggregate_entries(self, entries):
+        aggregates = np.zeros(len(entries), dtype=AGGREGATE_RECORD)
+        resolutions = {name: resolution for resolution, name in AGGREGATE_RESOLUTIONS.items()}
+        for i, entry in enumerate(entries):
+            aggregates[i] = (
+                resolutions[entry['resolution']], self._key(entry['product_id'], entry['location_key']),
+                date.fromisoformat(entry['period']).toordinal(), date.fromisoformat(entry['last']).toordinal(),
+                entry['min'], entry['max'], entry['sum'], entry['count'], entry['close']
+            )
+        self.aggregates = merge_aggregates(aggregates)
+
+    def load(self, source=None):
+        """
+        Load from the storage backend, or from another backend's storage when
+        `source` is given (which leaves any older layout unmigrated)
+        """
+        # Read before taking the store lock: backends take their own lock
+        # first and the store lock second when saving
+        history = (source or storage).load_price_history()
+        with self.lock:
+            self.install(history)
+            if history.get('legacy') and source is None:
+                # Migrate to the backend's current layout
+                self.rewrite = True
+                self.save()
+
+    def install(self, history):
+        """
+        Replace the contents of the store with history read by a storage backend
+        """
+        with self.lock:
+            self._reset()
+            self._clear_changes()
+            if 'partitions' in history:
+                in_place = self._load_partitions(history['partitions'], history['locations'])
+                if history.get('aggregates') is not None:
+                    aggregates = self._relocate(history['aggregates'], history['locations'])
+                    if aggregates is not history['aggregates']:
+                        in_place = False
+                        aggregates = merge_aggregates(aggregates)
+                    self.aggregates = aggregates
+                if not in_place:
+                    # Stored with other location ids; the next save rewrites everything
+                    self.rewrite = True
+            else:
+                self._load_entries(history['history'])
+                self._load_aggregate_entries(history.get('aggregates', []))
+            last_ingested = history.get('last_ingested')
+            if last_ingested:
+                self.last_ingested = date.fromisoformat(last_ingested).toordinal()
+            elif self.days:
+                # Older files have no watermark; the newest day stands in for it
+                self.last_ingested = self.days[-1]
+            self.version += 1
+            self.loaded = True
+
+    def apply_days(self, days, dropped, aggregates, last_ingested):
+        """
+        Bring the store up to date with days other workers changed: `days`
+        maps 'YYYY-MM-DD' to (product_id, location_key, price) rows that
+        replace the day, `dropped` lists days that are gone, and `aggregates`
+        (aggregate_entries() format) replace the aggregates unless None.
+        Changes made here and not saved yet are kept.
+        """
+        with self.lock:
+            pending = {}
+            for product_id, location_key, date_str, price in self.changes:
+                pending.setdefault(date_str, {})[self._key(product_id, location_key)] = price
+            for date_str in dropped:
+                ordinal = date.fromisoformat(date_str).toordinal()
+                if ordinal in self.partitions and ordinal not in self.new_days and date_str not in pending:
+                    self._drop_partition(ordinal)
+            for date_str, rows in days.items():
+                ordinal = date.fromisoformat(date_str).toordinal()
+                if ordinal in self.new_days:
+                    continue
+                day = {self._key(product_id, location_key): price for product_id, location_key, price in rows}
+                day.update(pending.get(date_str, {}))
+                if day:
+                    self._add_partition(DayPartition.from_rows(ordinal, day.items()))
+                elif ordinal in self.partitions:
+                    self._drop_partition(ordinal)
+            if aggregates is not None and not self.aggregates_changed:
+                self._load_aggregate_entries(aggregates)
+            if last_ingested:
+                self.last_ingested = max(date.fromisoformat(last_ingested).toordinal(), self.last_ingested or 0)
+            self.version += 1
+
+    def _drop_partition(self, ordinal):
+        partition = self.partitions.pop(ordinal)
+        self.days.remove(ordinal)
+        self.count -= len(partition)
+        self._count_keys(partition.keys, -1)
+
+    def save(self):
+        storage.save_price_history(self)
+
+    def drain_changes(self):
+        """
+        Return and reset the changes accumulated since the last call:
+        {'rewrite', 'changes', 'new_days', 'dropped_days', 'aggregates'}, with
+        days as 'YYYY-MM-DD'
+        """
+        with self.lock:
+            result = {
+                'rewrite': self.rewrite,
+                'aggregates': self.aggregates_changed,
+                'changes': self.changes,
+                'new_days': sorted(date.fromordinal(ordinal).isoformat() for ordinal in self.new_days),
+                'dropped_days': sorted(date.fromordinal(ordinal).isoformat() for ordinal in self.dropped_days)
+            }
+            self._clear_changes()
+            return result
+
+    def replace(self, entries, aggregates=None):
+        """
+        Discard the current history and load `entries` in its place, with
+        the weekly and monthly `aggregates` (aggregate_entries() format) if
+        given. Otherwise the current aggregates that end before the first
+        day of `entries` are kept, as those days cannot be among them.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            kept = self.aggregates
+            self._reset()
+            self._clear_changes()
+            self._load_entries(entries)
+            if aggregates is not None:
+                self._load_aggregate_entries(aggregates)
+            else:
+                self.aggregates = kept[kept['last'] < self.days[0]] if self.days else kept
+            self.last_ingested = self.days[-1] if self.days else None
+            self.rewrite = True
+            self.version += 1
+            self.loaded = True
+
+    def replace_days(self, days):
+        """
+        Discard the current history and replace it with (date ordinal,
+        PRICE_RECORD records) days keyed by registry location ids. The
+        backend writes each day as it comes, so `days` can be a generator
+        and only one day is held in memory at a time.
+        """
+        storage.replace_price_history(self, days)
+
+    def __len__(self):
+        self.ensure_loaded()
+        return self.count
+
+    def day_count(self, date_str):
+        self.ensure_loaded()
+        partition = self.partitions.get(date.fromisoformat(date_str).toordinal())
+        return len(partition) if partition else 0
+
+    def last_ingested_date(self):
+        self.ensure_loaded()
+        return date.fromordinal(self.last_ingested).isoformat() if self.last_ingested else None
+
+    def date_range(self):
+        """
+        Return the (oldest, newest) dates in the history, or (None, None) if it is empty
+        """
+        self.ensure_loaded()
+        with self.lock:
+            if not self.days:
+                return None, None
+            return date.fromordinal(self.days[0]).isoformat(), date.fromordinal(self.days[-1]).isoformat()
+
+    def unique_counts(self):
+        """
+        Return the number of distinct products and locations with daily history
+        """
+        self.ensure_loaded()
+        with self.lock:
+            return len(self.pair_products), len(self.pair_locations)
+
+    def _display_order(self):
+        """
+        Return the pair index keys ordered by product id, then location key,
+        both descending, their descending sort values, and a function giving
+        the sort value of a key. Recomputed only after the history changed.
+        """
+        if self.display_order is None or self.display_order[0] != self.version:
+            location_ranks = np.argsort(np.argsort(np.array(location_registry.keys, dtype=object))).astype(np.int64)
+            location_count = max(len(location_ranks), 1)
+
+            def sort_value(keys):
+                return (keys >> LOCATION_KEY_BITS) * location_count + location_ranks[keys & LOCATION_KEY_MASK]
+
+            values = sort_value(self.pair_keys)
+            order = np.argsort(-values, kind='stable')
+            self.display_order = (self.version, self.pair_keys[order], values[order], sort_value)
+        return self.display_order[1:]
+
+    def page(self, product_id=None, location_id=None, since=None, cursor=None, limit=500):
+        """
+        One page of history entries ordered by product id, location key and
+        date, all descending, like a sorted table. `cursor` is the
+        (product_id, location_id, date) of the last entry of the previous
+        page. Only pairs and days that can be on the page are looked at.
+
+        Returns (entries, cursor for the next page or None)
+        """
+        self.ensure_loaded()
+        with self.lock:
+            keys, values, sort_value = self._display_order()
+            if product_id is not None or location_id is not None:
+                matching = np.ones(len(keys), dtype=bool)
+                if product_id is not None:
+                    matching &= (keys >> LOCATION_KEY_BITS) == product_id
+                if location_id is not None:
+                    matching &= (keys & LOCATION_KEY_MASK) == location_id
+                keys = keys[matching]
+                values = values[matching]
+
+            start = 0
+            cursor_key = cursor_ordinal = None
+            if cursor is not None:
+                cursor_key = (cursor[0] << LOCATION_KEY_BITS) | cursor[1]
+                cursor_ordinal = date.fromisoformat(cursor[2]).toordinal()
+                cursor_value = int(sort_value(np.array([cursor_key], dtype=np.int64))[0])
+                start = int(np.searchsorted(-values, -cursor_value, side='left'))
+
+            first_day = bisect_left(self.days, date.fromisoformat(since).toordinal()) if since else 0
+            window = [self.partitions[ordinal] for ordinal in reversed(self.days[first_day:])]
+            rows = []  # (pair key, date ordinal, price), in page order
+            while start < len(keys) and len(rows) <= limit and window:
+                chunk = keys[start:start + limit + 1]
+                found_pairs, found_ordinals, found_prices = [], [], []
+                for partition in window:
+                    positions = np.searchsorted(partition.keys, chunk)
+                    present = positions < len(partition)
+                    present[present] = partition.keys[positions[present]] == chunk[present]
+                    found_pairs.append(np.flatnonzero(present))
+                    found_ordinals.append(np.full(int(present.sum()), partition.ordinal, dtype=np.int64))
+                    found_prices.append(partition.prices[positions[present]])
+                pairs = np.concatenate(found_pairs)
+                ordinals = np.concatenate(found_ordinals)
+                prices = np.concatenate(found_prices)
+                order = np.lexsort((-ordinals, pairs))
+                for pair, ordinal, price in zip(pairs[order].tolist(), ordinals[order].tolist(), prices[order].tolist()):
+                    key = int(chunk[pair])
+                    if key == cursor_key and ordinal >= cursor_ordinal:
+                        continue
+                    rows.append((key, ordinal, price))
+                start += len(chunk)
+
+        entries = [
+            {
+                'product_id': key >> LOCATION_KEY_BITS,
+                'location_id': key & LOCATION_KEY_MASK,
+                'date': date.fromordinal(ordinal).isoformat(),
+                'price': price
+            }
+            for key, ordinal, price in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = entries[-1]
+            next_cursor = (last['product_id'], last['location_id'], last['date'])
+        return entries, next_cursor
+
+    def series(self, product_id, location_id, limit=None):
+        """
+        Return [(date ordinal, price), ...] for one product and location,
+        oldest first, limited to the `limit` most recent entries
+        """
+        self.ensure_loaded()
+        with self.lock:
+            key = (product_id << LOCATION_KEY_BITS) | location_id
+            series = []
+            for ordinal in reversed(self.days):
+                partition = self.partitions[ordinal]
+                i = partition.find(key)
+                if i >= 0:
+                    series.append((ordinal, int(partition.prices[i])))
+                    if limit and len(series) >= limit:
+                        break
+        series.reverse()
+        return series
+
+    def columns(self):
+        """
+        Return (keys, date ordinals, prices) as NumPy arrays for every row, in day order
+        """
+        self.ensure_loaded()
+        with self.lock:
+            partitions = [self.partitions[ordinal] for ordinal in self.days]
+            records = np.concatenate([p.records for p in partitions]) if partitions else np.zeros(0, dtype=PRICE_RECORD)
+            keys = records['key']
+            prices = records['price']
+            dates = np.repeat(np.array(self.days, dtype=np.int64), [len(p) for p in partitions])
+        return keys, dates, prices
+
+    def _records_entries(self, records, date_str):
+        return [
+            {
+                'product_id': key >> LOCATION_KEY_BITS,
+                'location_key': location_registry.keys[key & LOCATION_KEY_MASK],
+                'date': date_str,
+                'price': price
+            }
+            for key, price in zip(records['key'].tolist(), records['price'].tolist())
+        ]
+
+    def entries(self, product_id=None, location_id=None, since=None, until=None):
+        """
+        Return history entries in the JSON entry format, optionally filtered by
+        product, location id and an inclusive 'YYYY-MM-DD' date range.
+        Only the matching days and key ranges of each partition are touched.
+        """
+        self.ensure_loaded()
+        entries = []
+        with self.lock:
+            first_day = bisect_left(self.days, date.fromisoformat(since).toordinal()) if since else 0
+            last_day = bisect_left(self.days, date.fromisoformat(until).toordinal() + 1) if until else len(self.days)
+            for ordinal in self.days[first_day:last_day]:
+                records = self.partitions[ordinal].records
+                if product_id is not None:
+                    start, stop = self.partitions[ordinal].key_range(product_id << LOCATION_KEY_BITS,
+                                                                     (product_id + 1) << LOCATION_KEY_BITS)
+                    records = records[start:stop]
+                if location_id is not None:
+                    records = records[(records['key'] & LOCATION_KEY_MASK) == location_id]
+                entries.extend(self._records_entries(records, date.fromordinal(ordinal).isoformat()))
+        return entries
+
+    def day_entries(self, date_str):
+        """
+        Return the entries of one day in the JSON entry format
+        """
+        self.ensure_loaded()
+        with self.lock:
+            partition = self.partitions.get(date.fromisoformat(date_str).toordinal())
+            if partition is None:
+                return []
+            return self._records_entries(partition.records, date_str)
+
+    def day_records(self, date_str):
+        """
+        Return a copy of one day's PRICE_RECORD records, or None if the day has no partition
+        """
+        self.ensure_loaded()
+        with self.lock:
+            partition = self.partitions.get(date.fromisoformat(date_str).toordinal())
+            return None if partition is None else np.array(partition.records)
+
+    def days_iso(self):
+        with self.lock:
+            return [date.fromordinal(ordinal).isoformat() for ordinal in self.days]
+
+    def upsert(self, product_id, location_id, date_str, price):
+        """
+        Set the price for one product, location and date. Returns True if a new entry was added
+        """
+        self.ensure_loaded()
+        with self.lock:
+            ordinal = date.fromisoformat(date_str).toordinal()
+            partition = self.partitions.get(ordinal)
+            if partition is None:
+                partition = DayPartition(ordinal)
+                self._add_partition(partition)
+            key = (product_id << LOCATION_KEY_BITS) | location_id
+            created = partition.upsert(key, price)
+            if created:
+                self.count += 1
+                self._count_keys([key], 1)
+            self.changes.append((product_id, location_registry.keys[location_id], date_str, price))
+            self.version += 1
+            return created
+
+    def append_day(self, date_str, rows):
+        """
+        Ingest one day of (product_id, location_id, price) rows as a whole
+        partition and advance the watermark. Rows already present for that
+        day (e.g. entered by an admin) are kept.
+        """
+        self.ensure_loaded()
+        with self.lock:
+            ordinal = date.fromisoformat(date_str).toordinal()
+            rows = {(product_id << LOCATION_KEY_BITS) | location_id: price for product_id, location_id, price in rows}
+            existing = self.partitions.get(ordinal)
+            if existing is not None:
+                rows.update(zip(existing.keys.tolist(), existing.prices.tolist()))
+            self._add_partition(DayPartition.from_rows(ordinal, rows.items()))
+            self.new_days.add(ordinal)
+            self.last_ingested = max(ordinal, self.last_ingested or ordinal)
+            self.version += 1
+
+    def ingest_day(self, date_str, rows):
+        """
+        append_day() and save, once across workers: returns False without
+        changing anything if the stored watermark already covers the day
+        """
+        self.ensure_loaded()
+        return storage.ingest_price_history_day(self, date_str, rows)
+
+    def aggregate_records(self):
+        with self.lock:
+            return np.array(self.aggregates)
+
+    def aggregate_entries(self, product_id=None, location_id=None):
+        """
+        Return weekly and monthly aggregates, optionally for one product and
+        location, as dictionaries ordered by resolution, product, location and period
+        """
+        self.ensure_loaded()
+        with self.lock:
+            aggregates = self.aggregates
+            if product_id is not None:
+                product_ids = aggregates['key'] >> LOCATION_KEY_BITS
+                aggregates = aggregates[product_ids == product_id]
+            if location_id is not None:
+                aggregates = aggregates[(aggregates['key'] & LOCATION_KEY_MASK) == location_id]
+            return [
+                {
+                    'product_id': int(record['key']) >> LOCATION_KEY_BITS,
+                    'location_key': location_registry.keys[int(record['key']) & LOCATION_KEY_MASK],
+                    'resolution': AGGREGATE_RESOLUTIONS[int(record['resolution'])],
+                    'period': date.fromordinal(int(record['period'])).isoformat(),
+                    'last': date.fromordinal(int(record['last'])).isoformat(),
+                    'min': int(record['min']),
+                    'max': int(record['max']),
+                    'sum': int(record['sum']),
+                    'count': int(record['count']),
+                    'mean': round(int(record['sum']) / int(record['count']), 2),
+                    'close': int(record['close'])
+                }
+                for record in aggregates
+            ]
+
+    def compact(self, today, daily_days, weekly_days, product_daily_days=None):
+        """
+        Apply the retention policy as of the `today` ordinal: rows older than
+        `daily_days` (or the product's entry in `product_daily_days`) are
+        folded into weekly aggregates and removed, and weekly aggregates older
+        than `weekly_days` into monthly ones. Works one day at a time so
+        readers are only held up briefly. Returns the number of rows folded.
+        """
+        self.ensure_loaded()
+        product_daily_days = product_daily_days or {}
+        default_cutoff = today - daily_days
+        oldest_cutoff = max([default_cutoff] + [today - days for days in product_daily_days.values()])
+        folded = 0
+        with self.lock:
+            candidates = self.days[:bisect_left(self.days, oldest_cutoff)]
+        for ordinal in candidates:
+            with self.lock:
+                partition = self.partitions.get(ordinal)
+                if partition is None:
+                    continue
+                records = partition.records
+                cutoffs = np.full(len(records), default_cutoff, dtype=np.int64)
+                if product_daily_days:
+                    product_ids = records['key'] >> LOCATION_KEY_BITS
+                    for product_id, days in product_daily_days.items():
+                        cutoffs[product_ids == product_id] = today - days
+                expired = ordinal < cutoffs
+                if not expired.any():
+                    continue
+                self.aggregates = merge_aggregates(self.aggregates, weekly_aggregates(records[expired], ordinal))
+                kept = records[~expired]
+                self.count -= len(records) - len(kept)
+                self._count_keys(records['key'][expired], -1)
+                if len(kept):
+                    self.partitions[ordinal] = DayPartition(ordinal, np.array(kept))
+                    self.new_days.add(ordinal)
+                else:
+                    del self.partitions[ordinal]
+                    self.days.remove(ordinal)
+                    self.new_days.discard(ordinal)
+                    self.dropped_days.add(ordinal)
+                folded += int(expired.sum())
+                self.aggregates_changed = True
+                self.version += 1
+
+        with self.lock:
+            aggregates = self.aggregates
+            # A week moves to its month once the whole week is past the weekly window
+            expired = (aggregates['resolution'] == AGGREGATE_WEEKLY) & (aggregates['period'] + 7 <= today - weekly_days)
+            if expired.any():
+                monthly = aggregates[expired].copy()
+                monthly['resolution'] = AGGREGATE_MONTHLY
+                monthly['period'] = month_starts(monthly['period'])
+                self.aggregates = merge_aggregates(aggregates[~expired], monthly)
+                folded += int(expired.sum())
+                self.aggregates_changed = True
+                self.version += 1
+        return folded
+
+price_history_store = PriceHistoryStore()
+
+# Storage backends
+DATASET_FILES = {
+    'products': '../products.json',
+    'locations': '../locations.json',
+    'users': 'users.json',
+    'orders': 'order_history.json'
+}
+ID_SEQUENCES_FILE = 'id_sequences.json'          # next unallocated id per entity
+CARTS_DIR = 'data/carts'                         # one <cart id>.json file per cart
+CART_ID_PATTERN = re.compile(r'[0-9a-f]{32}')    # ids issued by get_cart_id()
+PRICE_HISTORY_FILE = 'data/price_history.json'  # single-file layout, migrated on first load
+PRICE_HISTORY_DIR = 'data/price_history'         # one YYYY-MM-DD.bin file of PRICE_RECORDs per day
+PRICE_HISTORY_MANIFEST = os.path.join(PRICE_HISTORY_DIR, 'manifest.json')
+PRICE_HISTORY_AGGREGATES = os.path.join(PRICE_HISTORY_DIR, 'aggregates.bin')  # AGGREGATE_RECORDs
+
+def price_history_partition_path(date_str, extension='bin'):
+    return os.path.join(PRICE_HISTORY_DIR, f"{date_str}.{extension}")
+
+def price_history_partition_days(extension='bin'):
+    """
+    Return the days that have a partition file, oldest first
+    """
+    days = []
+    try:
+        names = os.listdir(PRICE_HISTORY_DIR)
+    except FileNotFoundError:
+        return days
+    suffix = f".{extension}"
+    for name in names:
+        if not name.endswith(suffix):
+            continue
+        try:
+            days.append(date.fromisoformat(name[:-len(suffix)]).isoformat())
+        except ValueError:
+            continue  # manifest.json
+    return sorted(days)
+
+def map_records(path, dtype):
+    """
+    Memory-map a file of fixed-width records read-only. Records are sliced
+    straight out of the page cache instead of being parsed.
+    """
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+# Dataset <-> row conversion
+def dataset_rows(name, data):
+    """
+    Return {table: {key: row tuple}} for a dataset, the last element of each
+    row being the record serialized as JSON
+    """
+    if name == 'products':
+        categories, products = {}, {}
+        for category in data['categories']:
+            category_fields = {k: v for k, v in category.items() if k != 'products'}
+            categories[category['id']] = (category['id'], json.dumps(category_fields))
+            for product in category['products']:
+                products[product['id']] = (product['id'], category['id'], json.dumps(product))
+        return {'categories': categories, 'products': products}
+    if name == 'locations':
+        return {'cities': {city['id']: (city['id'], json.dumps(city)) for city in data['cities']}}
+    if name == 'users':
+        return {'users': {user['id']: (user['id'], user['email'], json.dumps(user)) for user in data['users']}}
+    if name == 'orders':
+        return {'orders': {
+            order['id']: (order['id'], order['user_id'], order['date'], order['total'], json.dumps(order))
+            for order in data['orders']
+        }}
+    raise ValueError(f"Unknown dataset: {name}")
+
+def dataset_from_rows(name, rows):
+    """
+    Inverse of dataset_rows(), keeping the order of the rows. Products of a
+    category that no longer exists are dropped.
+    """
+    if name == 'products':
+        categories = []
+        categories_by_id = {}
+        for category_id, fields in rows['categories'].values():
+            category = json.loads(fields)
+            category['products'] = []
+            categories.append(category)
+            categories_by_id[category_id] = category
+        for _, category_id, product in rows['products'].values():
+            if category_id in categories_by_id:
+                categories_by_id[category_id]['products'].append(json.loads(product))
+        return {'categories': categories}
+    table = {'locations': 'cities', 'users': 'users', 'orders': 'orders'}[name]
+    return {table: [json.loads(row[-1]) for row in rows[table].values()]}
+
+def merge_rows(base, ours, theirs):
+    """
+    Three-way merge of dataset rows: the records we added, changed or removed
+    since `base` applied on top of `theirs`. Where both sides changed the
+    same record, ours wins.
+    """
+    merged = {}
+    for table, rows in ours.items():
+        base_rows = base.get(table, {})
+        table_rows = dict(theirs.get(table, {}))
+        for key, row in rows.items():
+            if base_rows.get(key) != row:
+                table_rows[key] = row
+        for key in base_rows:
+            if key not in rows:
+                table_rows.pop(key, None)
+        merged[table] = table_rows
+    return merged
+
+class JsonStorage:
+    """
+    Default backend: one JSON file per dataset, written atomically behind the
+    request, with orders going to an append-only log.
+
+    Writes take a cross-process lock on the file. File stamps seen at load or
+    written by this process are remembered so stale_datasets() can tell when
+    another worker changed a file. If another worker wrote a dataset since
+    this one last read or wrote it, only the records this worker changed
+    are applied on top of the file (see merge_rows()), and the merged
+    result is picked up by the next stale check.
+    """
+
+    name = 'json'
+
+    def __init__(self):
+        self.order_log = OrderLog(DATASET_FILES['orders'], 'order_history.log')
+        self.known = {}  # dataset -> file stamp as of the last load or own write
+        self.saved = {}  # dataset -> {table: {key: row}} as last read or written
+
+    def _path(self, name):
+        if name == 'orders':
+            return self.order_log.log_path
+        if name == 'price_history':
+            return PRICE_HISTORY_MANIFEST
+        return DATASET_FILES[name]
+
+    def load(self, name):
+        self.known[name] = file_stamp(self._path(name))
+        if name == 'orders':
+            data = self.order_log.load()
+        else:
+            data = load_data(DATASET_FILES[name])
+            self.saved[name] = dataset_rows(name, data)
+        return data
+
+    def save(self, name, data):
+        data_writer.schedule(data, DATASET_FILES[name], self._write)
+
+    def _write(self, data, filepath):
+        name = next(n for n, path in DATASET_FILES.items() if path == filepath)
+        rows = dataset_rows(name, data)
+        with file_lock(filepath):
+            merged = file_stamp(filepath) != self.known.get(name) and name in self.saved
+            if merged:
+                # Another worker saved since we last read or wrote the file
+                rows = merge_rows(self.saved[name], rows, dataset_rows(name, load_data(filepath)))
+                data = dataset_from_rows(name, rows)
+            write_json_atomic(data, filepath)
+            self.saved[name] = rows
+            # After a merge our copy lacks the other worker's records; leave the stamp unknown so it is reloaded
+            self.known[name] = None if merged else file_stamp(filepath)
+
+    def stale_datasets(self):
+        """
+        Return the datasets changed on disk by other processes, skipping those
+        with a save of our own still queued (it merges the other process's
+        changes and leaves the dataset to be reloaded after it)
+        """
+        stale = []
+        for name in ('products', 'locations', 'users', 'orders', 'price_history'):
+            path = self._path(name)
+            if file_stamp(path) != self.known.get(name) and not data_writer.is_pending(path):
+                stale.append(name)
+        return stale
+
+    def refresh_orders(self):
+        self.known['orders'] = file_stamp(self.order_log.log_path)
+        return self.order_log.refresh()
+
+    def append_order(self, order):
+        self.order_log.append(order)
+
+    def allocate_ids(self, name, count, floor):
+        """
+        Reserve `count` consecutive ids from a sequence and return the first.
+        `floor()` gives the first id of a sequence that does not exist yet.
+        """
+        with file_lock(ID_SEQUENCES_FILE):
+            try:
+                sequences = load_data(ID_SEQUENCES_FILE)
+            except FileNotFoundError:
+                sequences = {}
+            start = sequences.get(name) or floor()
+            sequences[name] = start + count
+            write_json_atomic(sequences, ID_SEQUENCES_FILE)
+        return start
+
+    def _cart_path(self, cart_id):
+        # The id comes from the session cookie, so it must never be able to name another file
+        if not isinstance(cart_id, str) or not CART_ID_PATTERN.fullmatch(cart_id):
+            raise ValueError(f"Invalid cart id {cart_id!r}")
+        return os.path.join(CARTS_DIR, f"{cart_id}.json")
+
+    def _read_cart(self, path):
+        # Stamp and contents come from the same open file, so they always agree
+        try:
+            with open(path, 'r') as f:
+                stat = os.fstat(f.fileno())
+                items = json.load(f)
+        except FileNotFoundError:
+            return None, {}
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size), {int(product_id): quantity
+                                                              for product_id, quantity in items.items()}
+
+    def cart_stamp(self, cart_id):
+        return file_stamp(self._cart_path(cart_id))
+
+    def load_cart(self, cart_id):
+        """
+        Return (stamp, items) for a cart, items being a product id -> quantity dict
+        """
+        return self._read_cart(self._cart_path(cart_id))
+
+    def update_cart(self, cart_id, change):
+        """
+        Apply change(items) to a cart and write it, under that cart's own lock
+        """
+        path = self._cart_path(cart_id)
+        os.makedirs(CARTS_DIR, exist_ok=True)
+        with file_lock(path):
+            _, items = self._read_cart(path)
+            change(items)
+            write_json_atomic({str(product_id): quantity for product_id, quantity in items.items()}, path)
+            return file_stamp(path), items
+
+    def expire_carts(self, cutoff):
+        """
+        Delete the carts last written before `cutoff` (a timestamp) and their
+        lock files; returns how many were deleted
+        """
+        try:
+            names = os.listdir(CARTS_DIR)
+        except FileNotFoundError:
+            return 0
+        expired = 0
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(CARTS_DIR, name)
+            try:
+                if os.stat(path).st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                continue
+            with file_lock(path):
+                # Checked again under the lock, as the cart may have been written meanwhile
+                try:
+                    if os.stat(path).st_mtime >= cutoff:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                try:
+                    os.remove(f"{path}.lock")
+                except FileNotFoundError:
+                    pass
+                expired += 1
+        return expired
+
+    def load_price_history(self):
+        """
+        Map every day partition. The manifest is written last by each save,
+        so its stamp versions the whole directory; it also holds the location
+        keys that the location ids packed into record keys refer to.
+        """
+        os.makedirs(PRICE_HISTORY_DIR, exist_ok=True)
+        with file_lock(PRICE_HISTORY_MANIFEST):
+            history = self._read_price_history()
+        if history is not None:
+            return history
+        try:
+            with open(PRICE_HISTORY_FILE, 'r') as f:
+                return {'history': json.load(f)['history'], 'last_ingested': None, 'legacy': True}
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {'history': [], 'last_ingested': None}
+
+    def refresh_price_history(self, store):
+        # Partitions are memory-mapped, so mapping them all again is cheap
+        store.load()
+
+    def _read_price_history(self):
+        """
+        Read the partitioned layout, or return None if there is none; called
+        with the manifest lock held
+        """
+        self.known['price_history'] = file_stamp(PRICE_HISTORY_MANIFEST)
+        try:
+            with open(PRICE_HISTORY_MANIFEST, 'r') as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if 'locations' in manifest:
+            return {
+                'partitions': [
+                    (day, map_records(price_history_partition_path(day), PRICE_RECORD))
+                    for day in price_history_partition_days()
+                ],
+                'aggregates': (map_records(PRICE_HISTORY_AGGREGATES, AGGREGATE_RECORD)
+                               if os.path.exists(PRICE_HISTORY_AGGREGATES) else None),
+                'locations': manifest['locations'],
+                'last_ingested': manifest.get('last_ingested')
+            }
+        # Earlier layout with one JSON file per day
+        history = []
+        for day in price_history_partition_days('json'):
+            with open(price_history_partition_path(day, 'json'), 'r') as f:
+                history.extend(json.load(f)['history'])
+        return {'history': history, 'last_ingested': manifest.get('last_ingested'), 'legacy': True}
+
+    def replace_price_history(self, store, days):
+        """
+        Write each day to a staging file next to the partitions as it is
+        generated, then swap them all in under the manifest lock and map the
+        store onto the new files
+        """
+        os.makedirs(PRICE_HISTORY_DIR, exist_ok=True)
+        staged = []
+        try:
+            for ordinal, records in days:
+                day = date.fromordinal(ordinal).isoformat()
+                write_bytes_atomic(records.tobytes(), price_history_partition_path(day, 'bin.new'))
+                staged.append(day)
+            with file_lock(PRICE_HISTORY_MANIFEST), store.lock:
+                removed = [
+                    price_history_partition_path(day) for day in set(price_history_partition_days()) - set(staged)
+                ] + [
+                    price_history_partition_path(day, 'json') for day in price_history_partition_days('json')
+                ] + [PRICE_HISTORY_AGGREGATES]
+                for path in removed:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                for day in staged:
+                    os.replace(price_history_partition_path(day, 'bin.new'), price_history_partition_path(day))
+                manifest = {'last_ingested': staged[-1] if staged else None, 'locations': list(location_registry.keys)}
+                staged = []
+                write_json_atomic(manifest, PRICE_HISTORY_MANIFEST)
+                store.install(self._read_price_history())
+        finally:
+            for day in staged:
+                try:
+                    os.remove(price_history_partition_path(day, 'bin.new'))
+                except FileNotFoundError:
+                    pass
+
+    def save_price_history(self, store):
+        # The store itself is scheduled so coalesced saves still see every change
+        data_writer.schedule(store, PRICE_HISTORY_MANIFEST, self._write_price_history)
+
+    def _write_price_history(self, store, filepath):
+        os.makedirs(PRICE_HISTORY_DIR, exist_ok=True)
+        with file_lock(filepath):
+            self._write_price_history_changes(store, store.drain_changes(), filepath)
+
+    def ingest_price_history_day(self, store, date_str, rows):
+        """
+        Append one day to the store and write it, unless the watermark on
+        disk shows another worker has already ingested that day. Returns
+        whether the day was ingested.
+        """
+        os.makedirs(PRICE_HISTORY_DIR, exist_ok=True)
+        with file_lock(PRICE_HISTORY_MANIFEST):
+            try:
+                last_ingested = load_data(PRICE_HISTORY_MANIFEST).get('last_ingested')
+            except (FileNotFoundError, json.JSONDecodeError):
+                last_ingested = None
+            if last_ingested is not None and last_ingested >= date_str:
+                return False
+            store.append_day(date_str, rows)
+            self._write_price_history_changes(store, store.drain_changes(), PRICE_HISTORY_MANIFEST)
+        return True
+
+    def _write_price_history_changes(self, store, changes, filepath):
+        """
+        Write only the day partitions touched since the last save, delete
+        dropped days, write the aggregates if they changed, then the manifest
+        with the ingestion watermark. Called with the manifest lock held.
+        """
+        try:
+            stale = file_stamp(filepath) != self.known.get('price_history')
+            manifest = None
+            if stale and not changes['rewrite']:
+                try:
+                    manifest = load_data(filepath)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    pass
+            if manifest is not None and 'locations' in manifest:
+                # Another worker saved since we loaded: apply our changes to its files
+                locations = self._merge_price_history(store, changes, manifest['locations'])
+                with store.lock:
+                    last_ingested = max(filter(None, (store.last_ingested_date(), manifest.get('last_ingested'))),
+                                        default=None)
+                write_json_atomic({'last_ingested': last_ingested, 'locations': locations}, filepath)
+                # Our store lacks the other worker's rows; leave the stamp unknown so it is reloaded
+                self.known['price_history'] = None
+                return
+            rewrite = changes['rewrite'] or stale
+            if rewrite:
+                days = store.days_iso()
+                removed = [
+                    price_history_partition_path(day)
+                    for day in set(price_history_partition_days()) - set(days)
+                ] + [
+                    price_history_partition_path(day, 'json') for day in price_history_partition_days('json')
+                ]
+            else:
+                days = sorted(set(changes['new_days']) | set(change[2] for change in changes['changes']))
+                removed = [price_history_partition_path(day) for day in changes['dropped_days']]
+            for path in removed:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            for day in days:
+                records = store.day_records(day)
+                if records is not None:
+                    write_bytes_atomic(records.tobytes(), price_history_partition_path(day))
+            if rewrite or changes['aggregates']:
+                write_bytes_atomic(store.aggregate_records().tobytes(), PRICE_HISTORY_AGGREGATES)
+            with store.lock:
+                manifest = {'last_ingested': store.last_ingested_date(), 'locations': list(location_registry.keys)}
+            write_json_atomic(manifest, filepath)
+            self.known['price_history'] = file_stamp(filepath)
+        except Exception:
+            # The drained changes are lost; rewrite every partition on the next save
+            with store.lock:
+                store.rewrite = True
+            raise
+
+    def _merge_price_history(self, store, changes, locations):
+        """
+        Apply drained changes to partitions saved by another worker, keyed by
+        that worker's location ids (`locations`, extended with any of ours it
+        lacks, which is returned). Days we appended or rewrote whole, and the
+        aggregates if we changed them, replace theirs; upserted rows are
+        applied to their copy of the day. Called with the manifest lock held.
+        """
+        locations = list(locations)
+        positions = {key: i for i, key in enumerate(locations)}
+
+        def position(location_key):
+            if location_key not in positions:
+                positions[location_key] = len(locations)
+                locations.append(location_key)
+            return positions[location_key]
+
+        def translate(records):
+            to_file = np.array([position(key) for key in list(location_registry.keys)], dtype=np.int64)
+            records = np.array(records)
+            records['key'] = (records['key'] & ~LOCATION_KEY_MASK) | to_file[records['key'] & LOCATION_KEY_MASK]
+            return records
+
+        for day in changes['dropped_days']:
+            try:
+                os.remove(price_history_partition_path(day))
+            except FileNotFoundError:
+                pass
+        for day in changes['new_days']:
+            records = store.day_records(day)
+            if records is not None:
+                write_bytes_atomic(np.sort(translate(records), order='key').tobytes(),
+                                   price_history_partition_path(day))
+
+        upserts = {}
+        days = set(store.days_iso()) - set(changes['new_days'])
+        for product_id, location_key, date_str, price in changes['changes']:
+            if date_str in days:
+                upserts.setdefault(date_str, {})[(product_id << LOCATION_KEY_BITS) | position(location_key)] = price
+        for day, rows in upserts.items():
+            path = price_history_partition_path(day)
+            try:
+                existing = np.fromfile(path, dtype=PRICE_RECORD)
+            except FileNotFoundError:
+                existing = np.zeros(0, dtype=PRICE_RECORD)
+            merged = dict(zip(existing['key'].tolist(), existing['price'].tolist()))
+            merged.update(rows)
+            write_bytes_atomic(DayPartition.from_rows(0, merged.items()).records.tobytes(), path)
+
+        if changes['aggregates']:
+            write_bytes_atomic(merge_aggregates(translate(store.aggregate_records())).tobytes(),
+                               PRICE_HISTORY_AGGREGATES)
+        return locations
+
+    def close(self):
+        self.order_log.sync()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS products (id INTEGER PRIMARY KEY, category_id INTEGER NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS products_category ON products (category_id);
+CREATE TABLE IF NOT EXISTS cities (id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, email TEXT NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS users_email ON users (email COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, date TEXT NOT NULL,
+                                   total REAL NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS orders_user ON orders (user_id, date);
+CREATE INDEX IF NOT EXISTS orders_date ON orders (date);
+CREATE TABLE IF NOT EXISTS order_items (order_id INTEGER NOT NULL, product_id INTEGER NOT NULL, quantity INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS order_items_order ON order_items (order_id);
+CREATE INDEX IF NOT EXISTS order_items_product ON order_items (product_id);
+CREATE TABLE IF NOT EXISTS price_history (product_id INTEGER NOT NULL, location_key TEXT NOT NULL, date TEXT NOT NULL,
+                                          price INTEGER NOT NULL, PRIMARY KEY (product_id, location_key, date)) WITHOUT ROWID;
+-- The primary key serves lookups by product, location and date
+CREATE INDEX IF NOT EXISTS price_history_location ON price_history (location_key, date);
+CREATE INDEX IF NOT EXISTS price_history_date ON price_history (date);
+CREATE TABLE IF NOT EXISTS price_history_aggregates (resolution TEXT NOT NULL, product_id INTEGER NOT NULL,
+                                                     location_key TEXT NOT NULL, period TEXT NOT NULL, last TEXT NOT NULL,
+                                                     min INTEGER NOT NULL, max INTEGER NOT NULL, sum INTEGER NOT NULL,
+                                                     count INTEGER NOT NULL, close INTEGER NOT NULL,
+                                                     PRIMARY KEY (product_id, location_key, resolution, period)) WITHOUT ROWID;
+-- The price_history meta version of each day's latest write, so workers only re-read the days that changed
+CREATE TABLE IF NOT EXISTS price_history_days (date TEXT PRIMARY KEY, version INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS id_sequences (name TEXT PRIMARY KEY, next_id INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS carts (id TEXT PRIMARY KEY, version INTEGER NOT NULL, data TEXT NOT NULL,
+                                  updated REAL NOT NULL DEFAULT 0);
+CREATE TABLE IF NOT EXISTS meta (dataset TEXT PRIMARY KEY, version INTEGER NOT NULL);
+INSERT OR IGNORE INTO meta (dataset, version) VALUES
+    ('products', 0), ('locations', 0), ('users', 0), ('orders', 0), ('price_history', 0);
+"""
+
+class SqliteStorage:
+    """
+    SQLite backend in WAL mode, so several worker processes can read while
+    one writes.
+
+    Records are stored as JSON documents next to the indexed columns that
+    are queried: products by category, users by email, orders by user and
+    date, order items by product and price history by product, location and
+    date. Saving a dataset only writes the records that changed since the
+    last save, diffed against the serialized rows this worker last read or
+    wrote, so concurrent workers editing different records do not overwrite
+    each other. Each worker thread gets its own connection.
+
+    Every write bumps the dataset's counter in the `meta` table;
+    stale_datasets() compares those counters with the ones this worker has
+    seen. Price history writes also stamp the days they touch with the new
+    counter, so a worker catching up re-reads only those days.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.saved = {}     # dataset -> {table: {key: row}} as last read or written
+        self.datasets = {}
+        self.known = {}     # dataset -> meta version as of the last load or own write
+        self.day_versions = {}           # price history day -> version as of the last read or own write
+        self.aggregates_version = None   # same for the price history aggregates
+        self.orders_rowid = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = self.connection()
+        conn.executescript(SQLITE_SCHEMA)
+        with conn:
+            # Older databases have carts without a last-updated time; their carts count as updated now
+            if 'updated' not in {row[1] for row in conn.execute('PRAGMA table_info(carts)')}:
+                conn.execute('ALTER TABLE carts ADD COLUMN updated REAL NOT NULL DEFAULT 0')
+                conn.execute('UPDATE carts SET updated = ?', (time.time(),))
+            # Older databases have price history without day versions
+            if conn.execute('SELECT COUNT(*) FROM price_history_days').fetchone()[0] == 0:
+                conn.execute('INSERT INTO price_history_days (date, version) SELECT DISTINCT date, 0 FROM price_history')
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def is_empty(self):
+        return self.connection().execute('SELECT COUNT(*) FROM products').fetchone()[0] == 0
+
+    def versions(self):
+        return dict(self.connection().execute('SELECT dataset, version FROM meta'))
+
+    def _bump(self, conn, name):
+        """
+        Increment a dataset's version inside the current write transaction
+        """
+        conn.execute('UPDATE meta SET version = version + 1 WHERE dataset = ?', (name,))
+        version = conn.execute('SELECT version FROM meta WHERE dataset = ?', (name,)).fetchone()[0]
+        if self.known.get(name) == version - 1:
+            # Nobody else wrote since we last looked
+            self.known[name] = version
+        return version
+
+    def stale_datasets(self):
+        return [
+            name for name, version in self.versions().items()
+            if version != self.known.get(name) and not data_writer.is_pending(f"sqlite:{name}")
+        ]
+
+    def refresh_orders(self):
+        conn = self.connection()
+        self.known['orders'] = self.versions()['orders']
+        rows = conn.execute('SELECT rowid, data FROM orders WHERE rowid > ? ORDER BY rowid',
+                            (self.orders_rowid,)).fetchall()
+        orders = self.datasets['orders']['orders']
+        order_ids = self.saved['orders']['orders']
+        added = []
+        for rowid, data in rows:
+            order = json.loads(data)
+            self.orders_rowid = max(self.orders_rowid, rowid)
+            if order['id'] not in order_ids:
+                order_ids[order['id']] = (order['id'], order['user_id'], order['date'], order['total'], data)
+                orders.append(order)
+                added.append(order)
+        return added
+
+    def load(self, name):
+        conn = self.connection()
+        self.known[name] = self.versions()[name]
+        if name == 'products':
+            categories = []
+            categories_by_id = {}
+            for category_id, fields in conn.execute('SELECT id, data FROM categories ORDER BY rowid'):
+                category = json.loads(fields)
+                category['products'] = []
+                categories.append(category)
+                categories_by_id[category_id] = category
+            for category_id, product in conn.execute('SELECT category_id, data FROM products ORDER BY rowid'):
+                if category_id in categories_by_id:
+                    categories_by_id[category_id]['products'].append(json.loads(product))
+            data = {'categories': categories}
+        elif name == 'locations':
+            data = {'cities': [json.loads(row[0]) for row in conn.execute('SELECT data FROM cities ORDER BY rowid')]}
+        elif name == 'users':
+            data = {'users': [json.loads(row[0]) for row in conn.execute('SELECT data FROM users ORDER BY rowid')]}
+        elif name == 'orders':
+            rows = conn.execute('SELECT rowid, data FROM orders ORDER BY rowid').fetchall()
+            data = {'orders': [json.loads(row[1]) for row in rows]}
+            self.orders_rowid = rows[-1][0] if rows else 0
+        else:
+            raise ValueError(f"Unknown dataset: {name}")
+        self.saved[name] = dataset_rows(name, data)
+        self.datasets[name] = data
+        return data
+
+    def save(self, name, data):
+        data_writer.schedule(data, f"sqlite:{name}", lambda data, target: self._write(name, data))
+
+    def _write(self, name, data):
+        rows = dataset_rows(name, data)
+        saved = self.saved.get(name, {})
+        conn = self.connection()
+        with conn:
+            for table, table_rows in rows.items():
+                saved_rows = saved.get(table, {})
+                columns = len(next(iter(table_rows.values()))) if table_rows else 0
+                changed = [row for key, row in table_rows.items() if saved_rows.get(key) != row]
+                removed = [(key,) for key in saved_rows if key not in table_rows]
+                if changed:
+                    conn.executemany(self._upsert_sql(table, columns), changed)
+                if removed:
+                    conn.executemany(f'DELETE FROM {table} WHERE id = ?', removed)
+                if table == 'orders':
+                    self._write_order_items(conn, [row[4] for row in changed], removed)
+            self._bump(conn, name)
+        self.saved[name] = rows
+
+    def _upsert_sql(self, table, columns):
+        names = {
+            'categories': ('id', 'data'),
+            'products': ('id', 'category_id', 'data'),
+            'cities': ('id', 'data'),
+            'users': ('id', 'email', 'data'),
+            'orders': ('id', 'user_id', 'date', 'total', 'data')
+        }[table]
+        updates = ', '.join(f'{column} = excluded.{column}' for column in names[1:])
+        return (f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * columns)}) "
+                f"ON CONFLICT(id) DO UPDATE SET {updates}")
+
+    def _write_order_items(self, conn, changed_orders, removed):
+        order_ids = [(json.loads(order)['id'],) for order in changed_orders] + removed
+        conn.executemany('DELETE FROM order_items WHERE order_id = ?', order_ids)
+        items = []
+        for order in changed_orders:
+            order = json.loads(order)
+            items.extend((order['id'], item['product_id'], item['quantity']) for item in order['items'])
+        conn.executemany('INSERT INTO order_items (order_id, product_id, quantity) VALUES (?, ?, ?)', items)
+
+    def append_order(self, order):
+        row = (order['id'], order['user_id'], order['date'], order['total'], json.dumps(order))
+        conn = self.connection()
+        with conn:
+            conn.execute(self._upsert_sql('orders', len(row)), row)
+            self._write_order_items(conn, [row[4]], [])
+            self._bump(conn, 'orders')
+        self.saved.setdefault('orders', {}).setdefault('orders', {})[order['id']] = row
+
+    def allocate_ids(self, name, count, floor):
+        conn = self.connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT next_id FROM id_sequences WHERE name = ?', (name,)).fetchone()
+            start = row[0] if row else floor()
+            conn.execute('INSERT OR REPLACE INTO id_sequences (name, next_id) VALUES (?, ?)', (name, start + count))
+        return start
+
+    # A cart's stamp is its (version, updated) pair: versions restart when an
+    # expired cart is recreated, the update time does not repeat
+
+    def _read_cart(self, conn, cart_id):
+        row = conn.execute('SELECT version, updated, data FROM carts WHERE id = ?', (cart_id,)).fetchone()
+        if row is None:
+            return None, {}
+        return (row[0], row[1]), {int(product_id): quantity for product_id, quantity in json.loads(row[2]).items()}
+
+    def cart_stamp(self, cart_id):
+        row = self.connection().execute('SELECT version, updated FROM carts WHERE id = ?', (cart_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def load_cart(self, cart_id):
+        return self._read_cart(self.connection(), cart_id)
+
+    def update_cart(self, cart_id, change):
+        conn = self.connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            stamp, items = self._read_cart(conn, cart_id)
+            change(items)
+            stamp = ((stamp[0] if stamp else 0) + 1, time.time())
+            conn.execute('INSERT OR REPLACE INTO carts (id, version, updated, data) VALUES (?, ?, ?, ?)',
+                         (cart_id, *stamp, json.dumps({str(product_id): quantity
+                                                       for product_id, quantity in items.items()})))
+        return stamp, items
+
+    def expire_carts(self, cutoff):
+        conn = self.connection()
+        with conn:
+            return conn.execute('DELETE FROM carts WHERE updated < ?', (cutoff,)).rowcount
+
+    def load_price_history(self):
+        conn = self.connection()
+        with conn:
+            # One read transaction, so the rows and the watermark agree
+            conn.execute('BEGIN')
+            self.known['price_history'] = self.versions()['price_history']
+            rows = conn.execute('SELECT product_id, location_key, date, price FROM price_history')
+            history = [
+                {'product_id': product_id, 'location_key': location_key, 'date': date_str, 'price': price}
+                for product_id, location_key, date_str, price in rows
+            ]
+            last_ingested = self._setting(conn, 'price_history_last_ingested')
+            cursor = conn.execute(f"SELECT {', '.join(AGGREGATE_COLUMNS)} FROM price_history_aggregates")
+            aggregates = [dict(zip(AGGREGATE_COLUMNS, row)) for row in cursor]
+            self.day_versions = dict(conn.execute('SELECT date, version FROM price_history_days'))
+            self.aggregates_version = self._setting(conn, 'price_history_aggregates_version')
+        return {
+            'history': history,
+            'aggregates': aggregates,
+            'last_ingested': last_ingested
+        }
+
+    def _setting(self, conn, key):
+        row = conn.execute('SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def refresh_price_history(self, store):
+        """
+        Catch up with other workers' price history writes, reading only the
+        days and aggregates whose version changed since this worker last read
+        or wrote them
+        """
+        known_days = dict(self.day_versions)
+        known_aggregates = self.aggregates_version
+        conn = self.connection()
+        with conn:
+            # One read transaction, so the days, versions and watermark agree
+            conn.execute('BEGIN')
+            self.known['price_history'] = self.versions()['price_history']
+            day_versions = dict(conn.execute('SELECT date, version FROM price_history_days'))
+            changed = [day for day, version in day_versions.items() if known_days.get(day) != version]
+            days = {day: [] for day in changed}
+            for start in range(0, len(changed), 500):
+                chunk = changed[start:start + 500]
+                rows = conn.execute('SELECT product_id, location_key, date, price FROM price_history '
+                                    f"WHERE date IN ({', '.join('?' for _ in chunk)})", chunk)
+                for product_id, location_key, date_str, price in rows:
+                    days[date_str].append((product_id, location_key, price))
+            aggregates_version = self._setting(conn, 'price_history_aggregates_version')
+            aggregates = None
+            if aggregates_version != known_aggregates:
+                cursor = conn.execute(f"SELECT {', '.join(AGGREGATE_COLUMNS)} FROM price_history_aggregates")
+                aggregates = [dict(zip(AGGREGATE_COLUMNS, row)) for row in cursor]
+            last_ingested = self._setting(conn, 'price_history_last_ingested')
+        with store.lock:
+            # Days this worker wrote while we were reading are newer in memory than what was read
+            written = {day for day in set(known_days) | set(self.day_versions)
+                       if self.day_versions.get(day) != known_days.get(day)}
+            store.apply_days({day: rows for day, rows in days.items() if day not in written},
+                             [day for day in known_days if day not in day_versions and day not in written],
+                             aggregates if self.aggregates_version == known_aggregates else None,
+                             last_ingested)
+            for day, version in day_versions.items():
+                if day not in written:
+                    self.day_versions[day] = version
+            for day in known_days:
+                if day not in day_versions and day not in written:
+                    self.day_versions.pop(day, None)
+            if self.aggregates_version == known_aggregates:
+                self.aggregates_version = aggregates_version
+
+    def _write_price_history(self, conn, entries, last_ingested, aggregates=None):
+        conn.executemany('INSERT OR REPLACE INTO price_history (product_id, location_key, date, price) '
+                         'VALUES (?, ?, ?, ?)',
+                         [(e['product_id'], e['location_key'], e['date'], e['price']) for e in entries])
+        if aggregates is not None:
+            conn.execute('DELETE FROM price_history_aggregates')
+            conn.executemany(
+                f"INSERT INTO price_history_aggregates ({', '.join(AGGREGATE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in AGGREGATE_COLUMNS)})",
+                [tuple(aggregate[column] for column in AGGREGATE_COLUMNS) for aggregate in aggregates])
+        if last_ingested is not None:
+            conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('price_history_last_ingested', ?)",
+                         (last_ingested,))
+
+    def save_price_history(self, store):
+        # Under the store lock, so a save drained from the store cannot land after replace_price_history()
+        with store.lock:
+            self._save_price_history(store)
+
+    def _save_price_history(self, store):
+        conn = self.connection()
+        with conn:
+            self._write_price_history_changes(conn, store, store.drain_changes())
+
+    def ingest_price_history_day(self, store, date_str, rows):
+        """
+        Append one day to the store and write it in one transaction, unless
+        the stored watermark shows another worker has already ingested that
+        day. Returns whether the day was ingested.
+        """
+        conn = self.connection()
+        with store.lock, conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT value FROM settings WHERE key = 'price_history_last_ingested'").fetchone()
+            if row is not None and row[0] >= date_str:
+                return False
+            store.append_day(date_str, rows)
+            self._write_price_history_changes(conn, store, store.drain_changes())
+        return True
+
+    def _write_price_history_changes(self, conn, store, changes):
+        version = self._bump(conn, 'price_history')
+        if changes['rewrite']:
+            conn.execute('DELETE FROM price_history')
+            conn.execute('DELETE FROM price_history_days')
+            for day in store.days_iso():
+                self._write_price_history(conn, store.day_entries(day), None)
+            self._write_price_history(conn, [], store.last_ingested_date(), store.aggregate_entries())
+            self._stamp_days(conn, version, store.days_iso(), [])
+            self._stamp_aggregates(conn, version)
+        else:
+            # Whole days are replaced, so rows folded into aggregates go too
+            conn.executemany('DELETE FROM price_history WHERE date = ?',
+                             [(day,) for day in changes['dropped_days'] + changes['new_days']])
+            for day in changes['new_days']:
+                self._write_price_history(conn, store.day_entries(day), None)
+            days = set(store.days_iso())
+            upserts = [change for change in changes['changes'] if change[2] in days]
+            conn.executemany('INSERT OR REPLACE INTO price_history (product_id, location_key, date, price) '
+                             'VALUES (?, ?, ?, ?)', upserts)
+            self._write_price_history(conn, [], store.last_ingested_date(),
+                                      store.aggregate_entries() if changes['aggregates'] else None)
+            self._stamp_days(conn, version, changes['new_days'], [change[2] for change in upserts],
+                             changes['dropped_days'])
+            if changes['aggregates']:
+                self._stamp_aggregates(conn, version)
+
+    def _stamp_days(self, conn, version, whole_days, upserted_days, dropped_days=()):
+        """
+        Record the write of `version` on the days it touched. Days written
+        whole now match this worker's memory; a day that only had rows
+        upserted does so only if nobody else wrote it since this worker read it.
+        """
+        upserted_days = set(upserted_days) - set(whole_days)
+        stored = dict(conn.execute('SELECT date, version FROM price_history_days')) if upserted_days else {}
+        conn.executemany('DELETE FROM price_history_days WHERE date = ?', [(day,) for day in dropped_days])
+        conn.executemany('INSERT OR REPLACE INTO price_history_days (date, version) VALUES (?, ?)',
+                         [(day, version) for day in set(whole_days) | upserted_days])
+        for day in dropped_days:
+            self.day_versions.pop(day, None)
+        for day in whole_days:
+            self.day_versions[day] = version
+        for day in upserted_days:
+            if day in stored and stored[day] == self.day_versions.get(day):
+                self.day_versions[day] = version
+
+    def _stamp_aggregates(self, conn, version):
+        # Aggregates are always written whole
+        conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('price_history_aggregates_version', ?)",
+                     (str(version),))
+        self.aggregates_version = str(version)
+
+    def replace_price_history(self, store, days):
+        """
+        Insert each day into a staging table as it is generated, one
+        transaction per day, then swap the staged rows in and reload the store
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute('DROP TABLE IF EXISTS price_history_staging')
+            conn.execute('CREATE TABLE price_history_staging (product_id INTEGER NOT NULL, location_key TEXT NOT NULL, '
+                         'date TEXT NOT NULL, price INTEGER NOT NULL)')
+        last_ingested = None
+        try:
+            for ordinal, records in days:
+                last_ingested = date.fromordinal(ordinal).isoformat()
+                with conn:
+                    conn.executemany('INSERT INTO price_history_staging (product_id, location_key, date, price) '
+                                     'VALUES (?, ?, ?, ?)',
+                                     [(key >> LOCATION_KEY_BITS, location_registry.keys[key & LOCATION_KEY_MASK],
+                                       last_ingested, price)
+                                      for key, price in zip(records['key'].tolist(), records['price'].tolist())])
+            with store.lock:
+                with conn:
+                    conn.execute('DELETE FROM price_history')
+                    conn.execute('INSERT INTO price_history (product_id, location_key, date, price) '
+                                 'SELECT product_id, location_key, date, price FROM price_history_staging')
+                    self._write_price_history(conn, [], last_ingested, [])
+                    version = self._bump(conn, 'price_history')
+                    conn.execute('DELETE FROM price_history_days')
+                    conn.execute('INSERT INTO price_history_days (date, version) '
+                                 'SELECT DISTINCT date, ? FROM price_history', (version,))
+                    self._stamp_aggregates(conn, version)
+                store.install(self.load_price_history())
+        finally:
+            with conn:
+                conn.execute('DROP TABLE IF EXISTS price_history_staging')
+
+    def import_from(self, source):
+        """
+        Replace the database contents with the datasets and price history of another backend
+        """
+        conn = self.connection()
+        with conn:
+            for table in ('categories', 'products', 'cities', 'users', 'orders', 'order_items', 'price_history',
+                          'price_history_aggregates'):
+                conn.execute(f'DELETE FROM {table}')
+        self.saved = {}
+        for name in DATASET_FILES:
+            self._write(name, source.load(name))
+        history = PriceHistoryStore()
+        history.load(source)
+        with conn:
+            conn.execute('DELETE FROM price_history_days')
+            self._write_price_history(conn, history.entries(), history.last_ingested_date(),
+                                      history.aggregate_entries())
+            version = self._bump(conn, 'price_history')
+            self._stamp_days(conn, version, history.days_iso(), [])
+            self._stamp_aggregates(conn, version)
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+def create_storage(config):
+    backend = config['STORAGE_BACKEND']
+    if backend == 'json':
+        return JsonStorage()
+    if backend == 'sqlite':
+        return SqliteStorage(config['SQLITE_PATH'])
+    raise ValueError(f"Unknown storage backend: {backend}")
+
 def save_data(data, filename):
-    # Determine the correct path based on the filename
-    if filename in ['products.json', 'locations.json']:
-        filepath = f'../{filename}'
+    # Determine the dataset based on the filename
+    name = next((n for n, path in DATASET_FILES.items() if os.path.basename(path) == filename), None)
+    if name:
+        storage.save(name, data)
     else:
-        filepath = filename
-        
-    with open(filepath, 'w') as f:
-        json.dump(data, f, indent=2)
+        data_writer.schedule(data, filename)
+
+def flush_data():
+    """
+    Wait until every save_data call made so far has been written to disk
+    """
+    data_writer.flush()
+
+# Datasets, filled in place by load_datasets() on first use; the products
+# and locations datasets are published as catalog snapshots instead
+storage = create_storage(app.config)
+users_data = {}
+order_history = {}
+atexit.register(storage.close)
+
+# Id sequences
+ID_BLOCK_SIZE = 20  # ids a worker takes from a sequence at a time
+
+class IdAllocator:
+    """
+    New ids for orders, users, products and categories. Each sequence's next
+    unallocated id is persisted by the storage backend; a worker reserves a
+    block of ID_BLOCK_SIZE ids under the backend's lock and then hands them
+    out locally, so ids are unique across threads and worker processes
+    without coordinating on every insert. Ids only ever increase; a block
+    left unused when a worker exits is skipped.
+    """
+
+    def __init__(self, block_size, floors):
+        self.block_size = block_size
+        self.floors = floors  # sequence -> function giving its first id when it is first created
+        self.blocks = {}      # sequence -> [next id, end of block]
+        self.lock = threading.Lock()
+
+    def next_id(self, name):
+        with self.lock:
+            block = self.blocks.get(name)
+            if block is None or block[0] >= block[1]:
+                start = storage.allocate_ids(name, self.block_size, self.floors[name])
+                block = self.blocks[name] = [start, start + self.block_size]
+            block[0] += 1
+            return block[0] - 1
+
+id_allocator = IdAllocator(ID_BLOCK_SIZE, {
+    'orders': lambda: max((order['id'] for order in order_history['orders']), default=0) + 1,
+    'users': lambda: max((user['id'] for user in users_data['users']), default=0) + 1,
+    'products': lambda: max(catalog_index.products, default=0) + 1,
+    'categories': lambda: max(catalog_index.categories, default=0) + 1
+})
+
+# Cart store
+CART_EXPIRY_INTERVAL = 3600  # seconds between sweeps for abandoned carts in each worker
+
+class CartStore:
+    """
+    Shopping carts kept on the server, keyed by a random cart id that is all
+    the session cookie carries. A cart is a product id -> quantity dict in
+    the order products were added.
+
+    Carts are persisted by the storage backend and the most recently used
+    ones are cached here. A cached cart is reused only while its storage
+    stamp is unchanged, so edits made through other workers are seen on the
+    next request. Returned carts are shared and must not be modified; use
+    update().
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.carts = OrderedDict()  # cart id -> (stamp, items)
+        self.lock = threading.Lock()
+
+    def get(self, cart_id):
+        stamp = storage.cart_stamp(cart_id)
+        with self.lock:
+            cached = self.carts.get(cart_id)
+            if cached and cached[0] == stamp:
+                self.carts.move_to_end(cart_id)
+                return cached[1]
+        stamp, items = storage.load_cart(cart_id)
+        self._put(cart_id, stamp, items)
+        return items
+
+    def update(self, cart_id, change):
+        """
+        Apply change(items) to a copy of the cart and persist it, atomically across workers
+        """
+        stamp, items = storage.update_cart(cart_id, change)
+        self._put(cart_id, stamp, items)
+        return items
+
+    def _put(self, cart_id, stamp, items):
+        with self.lock:
+            self.carts[cart_id] = (stamp, items)
+            self.carts.move_to_end(cart_id)
+            while len(self.carts) > self.maxsize:
+                self.carts.popitem(last=False)
+
+cart_store = CartStore(app.config['CART_CACHE_SIZE'])
+
+cart_expiry_lock = threading.Lock()
+cart_expiry_due = 0.0
+
+def expire_carts():
+    """
+    Delete the carts that have not changed for CART_MAX_AGE_DAYS
+    """
+    try:
+        expired = storage.expire_carts(time.time() - app.config['CART_MAX_AGE_DAYS'] * 86400)
+        if expired:
+            print(f"Deleted {expired} abandoned carts")
+    except Exception as e:
+        print(f"Error expiring carts: {str(e)}")
+
+def start_cart_expiry():
+    """
+    Sweep abandoned carts in the background, at most once per CART_EXPIRY_INTERVAL
+    """
+    global cart_expiry_due
+    with cart_expiry_lock:
+        if time.time() < cart_expiry_due:
+            return
+        cart_expiry_due = time.time() + CART_EXPIRY_INTERVAL
+    threading.Thread(target=expire_carts, daemon=True).start()
 
-# Load initial data
-products_data = load_data('../products.json')
-locations_data = load_data('../locations.json')
-users_data = load_data('users.json')
-order_history = load_data('order_history.json')
+def get_cart_id(create=False):
+    """
+    The session's cart id, or None if it has no cart and `create` is false.
+    A cart still carried in the cookie by an older session is moved into the store.
+    """
+    cart_id = session.get('cart_id')
+    if cart_id is not None and not (isinstance(cart_id, str) and CART_ID_PATTERN.fullmatch(cart_id)):
+        # Not an id this app issued; start a new cart rather than use it
+        session.pop('cart_id')
+        cart_id = None
+    if cart_id is None and (create or 'cart' in session):
+        cart_id = session['cart_id'] = secrets.token_hex(16)
+    if 'cart' in session:
+        legacy_items = session.pop('cart')
+
+        def merge(items):
+            for item in legacy_items:
+                items[item['product_id']] = items.get(item['product_id'], 0) + item['quantity']
+        cart_store.update(cart_id, merge)
+    return cart_id
+
+def get_cart():
+    cart_id = get_cart_id()
+    return cart_store.get(cart_id) if cart_id else {}
 
 # Authentication decorators
 def login_required(f):
@@ -47,71 +2431,776 @@ def admin_required(f):
             return redirect(url_for('admin_login'))
         
         # Check if user is admin
-        user = next((u for u in users_data['users'] if u['id'] == session['user_id']), None)
+        user = get_user_by_id(session['user_id'])
         if not user or not user.get('is_admin', False):
             return redirect(url_for('admin_login'))
             
         return f(*args, **kwargs)
     return decorated_function
 
+# User indexes
+class UserIndex:
+    """
+    Id and lower-cased email lookups over users_data. Routes that create
+    users register them with add().
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_email = {}
+
+    def rebuild(self, users):
+        by_id = {user['id']: user for user in users}
+        by_email = {user['email'].lower(): user for user in users}
+        self.by_id, self.by_email = by_id, by_email
+
+    def add(self, user):
+        self.by_id[user['id']] = user
+        self.by_email[user['email'].lower()] = user
+
+user_index = UserIndex()
+
 # Helper functions
 def get_user_by_id(user_id):
-    return next((u for u in users_data['users'] if u['id'] == user_id), None)
+    if not has_app_context():
+        return user_index.by_id.get(user_id)
+    
+    # Memoize per request so a user is resolved only once
+    memo = g.setdefault('users_by_id', {})
+    if user_id not in memo:
+        memo[user_id] = user_index.by_id.get(user_id)
+    return memo[user_id]
 
 def get_user_by_email(email):
-    return next((u for u in users_data['users'] if u['email'] == email), None)
+    return user_index.by_email.get((email or '').lower())
+
+# Dashboard metrics
+RECENT_ORDERS_SIZE = 5  # orders listed on the admin dashboard
+
+class DashboardMetrics:
+    """
+    Order and signup totals for the admin dashboard, kept per day so today's
+    figures are a lookup. Checkout and registration record new orders and
+    users with add_order()/add_user(); the rebuild methods recount after a
+    dataset is loaded wholesale. `lock` guards every update and snapshot, as
+    checkout, registration and the dashboard run on different threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total_orders = 0
+        self.total_revenue = 0
+        self.orders_by_day = Counter()   # date -> orders placed
+        self.revenue_by_day = Counter()  # date -> order totals
+        self.signups_by_day = Counter()  # date -> users joined
+        self.recent = []                 # newest RECENT_ORDERS_SIZE (date, id, order), oldest first
+
+    def rebuild_orders(self):
+        with self.lock:
+            self.total_orders = 0
+            self.total_revenue = 0
+            self.orders_by_day = Counter()
+            self.revenue_by_day = Counter()
+            self.recent = []
+            for order in order_history['orders']:
+                self._add_order(order)
+
+    def rebuild_users(self, users):
+        signups_by_day = Counter(user.get('joined_date') for user in users)
+        with self.lock:
+            self.signups_by_day = signups_by_day
+
+    def add_order(self, order):
+        with self.lock:
+            self._add_order(order)
+
+    def _add_order(self, order):
+        self.total_orders += 1
+        self.total_revenue += order['total']
+        self.orders_by_day[order['date']] += 1
+        self.revenue_by_day[order['date']] += order['total']
+        insort(self.recent, (order['date'], order['id'], order))
+        if len(self.recent) > RECENT_ORDERS_SIZE:
+            self.recent.pop(0)
+
+    def add_user(self, user):
+        with self.lock:
+            self.signups_by_day[user.get('joined_date')] += 1
+
+    def stats(self, day):
+        """
+        Return the totals and `day`'s figures as one consistent snapshot
+        """
+        with self.lock:
+            return {
+                'total_orders': self.total_orders,
+                'orders_today': self.orders_by_day[day],
+                'total_revenue': self.total_revenue,
+                'revenue_today': self.revenue_by_day[day],
+                'new_users_today': self.signups_by_day[day]
+            }
+
+    def recent_orders(self):
+        with self.lock:
+            recent = list(self.recent)
+        return [order for _, _, order in reversed(recent)]
+
+dashboard_metrics = DashboardMetrics()
+
+# Order indexes
+ORDERS_PAGE_SIZE = 10  # orders per page on /orders
+
+class UserOrderIndex:
+    """
+    Each user's orders as a (date, id, order) list kept sorted on insert, so
+    a user's order count is len() and a page of their newest orders is a
+    slice. Checkout records new orders with add(); rebuild() re-indexes
+    order_history after it is loaded wholesale.
+    """
+
+    def __init__(self):
+        self.by_user = {}
+
+    def rebuild(self):
+        self.by_user = {}
+        for order in order_history['orders']:
+            self.add(order)
+
+    def add(self, order):
+        insort(self.by_user.setdefault(order['user_id'], []), (order['date'], order['id'], order))
+
+    def count(self, user_id):
+        return len(self.by_user.get(user_id, ()))
+
+    def page(self, user_id, page, page_size=ORDERS_PAGE_SIZE):
+        """
+        Return the user's orders on 1-based `page`, newest first
+        """
+        orders = self.by_user.get(user_id, [])
+        stop = len(orders) - (page - 1) * page_size
+        return [order for _, _, order in reversed(orders[max(0, stop - page_size):max(0, stop)])]
+
+user_order_index = UserOrderIndex()
+
+class ProductOrderIndex:
+    """
+    Per-product order counts over order_history, so checking whether a
+    product was ever ordered does not scan every order's items
+    """
+
+    def __init__(self):
+        self.orders = Counter()  # product id -> orders containing it
+
+    def rebuild(self):
+        self.orders = Counter()
+        for order in order_history['orders']:
+            self.add(order)
+
+    def add(self, order):
+        for product_id in set(item['product_id'] for item in order['items']):
+            self.orders[product_id] += 1
+
+    def order_count(self, product_id):
+        return self.orders[product_id]
+
+product_order_index = ProductOrderIndex()
+
+def rebuild_order_indexes():
+    dashboard_metrics.rebuild_orders()
+    user_order_index.rebuild()
+    product_order_index.rebuild()
+
+def index_order(order):
+    """
+    Record an order added to order_history in every order index
+    """
+    dashboard_metrics.add_order(order)
+    user_order_index.add(order)
+    product_order_index.add(order)
+
+# Catalog snapshots
+class CatalogSnapshot:
+    """
+    One version of the catalog: the products and locations datasets and the
+    id lookups over them. A snapshot is never modified once published, so a
+    request can hold on to one and read it without locking while admin
+    writes publish newer ones.
+    """
+
+    def __init__(self, products_data, locations_data, version):
+        self.products_data = products_data
+        self.locations_data = locations_data
+        self.version = version
+        self.products = {}            # product id -> product
+        self.categories = {}          # category id -> category
+        self.product_categories = {}  # product id -> category
+        for category in products_data['categories']:
+            self.categories[category['id']] = category
+            for product in category['products']:
+                self.products[product['id']] = product
+                self.product_categories[product['id']] = category
+
+        self.cities = {}              # city id -> city
+        self.districts = {}           # (city id, district id) -> district
+        for city in locations_data['cities']:
+            self.cities[city['id']] = city
+            for district in city['districts']:
+                self.districts[(city['id'], district['id'])] = district
+
+class CatalogIndex:
+    """
+    Publishes the current CatalogSnapshot.
+
+    Readers take `snapshot` once and use it for the whole request; the lookup
+    properties below each read the current one. Writers are serialized by
+    `lock`: they copy the categories and products they change, share
+    everything else with the current snapshot, save the new products dataset
+    and swap the snapshot in with a single assignment, so readers never see
+    a half-applied change. `version` increases with every publish so derived
+    views know when to recompute.
+    """
+
+    def __init__(self):
+        self.snapshot = CatalogSnapshot({'categories': []}, {'cities': []}, 0)
+        self.lock = threading.Lock()
+
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    @property
+    def products(self):
+        return self.snapshot.products
+
+    @property
+    def categories(self):
+        return self.snapshot.categories
+
+    @property
+    def product_categories(self):
+        return self.snapshot.product_categories
+
+    @property
+    def cities(self):
+        return self.snapshot.cities
+
+    @property
+    def districts(self):
+        return self.snapshot.districts
+
+    def publish(self, products_data=None, locations_data=None):
+        """
+        Replace either dataset wholesale, e.g. after loading it from storage
+        """
+        with self.lock:
+            self._publish(products_data, locations_data)
+
+    def _publish(self, products_data=None, locations_data=None):
+        current = self.snapshot
+        if locations_data is not None:
+            location_registry.register(locations_data)
+        self.snapshot = CatalogSnapshot(products_data if products_data is not None else current.products_data,
+                                        locations_data if locations_data is not None else current.locations_data,
+                                        current.version + 1)
+
+    def _save(self, categories):
+        products_data = dict(self.snapshot.products_data, categories=categories)
+        save_data(products_data, 'products.json')
+        self._publish(products_data)
+
+    def _replace_category(self, categories, category):
+        return [category if c['id'] == category['id'] else c for c in categories]
+
+    def add_product(self, category_id, product):
+        """
+        Add a product to a category; returns False if the category does not exist
+        """
+        with self.lock:
+            category = self.snapshot.categories.get(category_id)
+            if not category:
+                return False
+            category = dict(category, products=category['products'] + [product])
+            self._save(self._replace_category(self.snapshot.products_data['categories'], category))
+            return True
+
+    def update_product(self, product_id, category_id, fields):
+        """
+        Apply `fields` to a product, moving it to another category if
+        category_id differs; returns False if either does not exist
+        """
+        with self.lock:
+            product = self.snapshot.products.get(product_id)
+            old_category = self.snapshot.product_categories.get(product_id)
+            new_category = self.snapshot.categories.get(category_id)
+            if not product or not new_category:
+                return False
+            updated_product = dict(product, **fields)
+            categories = self.snapshot.products_data['categories']
+            if old_category['id'] == category_id:
+                products = [updated_product if p['id'] == product_id else p for p in old_category['products']]
+                categories = self._replace_category(categories, dict(old_category, products=products))
+            else:
+                products = [p for p in old_category['products'] if p['id'] != product_id]
+                categories = self._replace_category(categories, dict(old_category, products=products))
+                categories = self._replace_category(
+                    categories, dict(new_category, products=new_category['products'] + [updated_product]))
+            self._save(categories)
+            return True
+
+    def remove_product(self, product_id):
+        """
+        Remove a product; returns False if it does not exist
+        """
+        with self.lock:
+            category = self.snapshot.product_categories.get(product_id)
+            if not category:
+                return False
+            products = [p for p in category['products'] if p['id'] != product_id]
+            self._save(self._replace_category(self.snapshot.products_data['categories'],
+                                              dict(category, products=products)))
+            return True
+
+    def add_category(self, category):
+        with self.lock:
+            self._save(self.snapshot.products_data['categories'] + [category])
+
+catalog_index = CatalogIndex()
 
 def get_product_by_id(product_id):
-    for category in products_data['categories']:
-        for product in category['products']:
-            if product['id'] == product_id:
-                return product
-    return None
+    return catalog_index.products.get(product_id)
 
 def get_category_by_id(category_id):
-    return next((c for c in products_data['categories'] if c['id'] == category_id), None)
+    return catalog_index.categories.get(category_id)
+
+def get_category_for_product(product_id):
+    return catalog_index.product_categories.get(product_id)
 
 def get_city_by_id(city_id):
-    return next((c for c in locations_data['cities'] if c['id'] == city_id), None)
+    return catalog_index.cities.get(city_id)
 
 def get_district_by_id(city_id, district_id):
-    city = get_city_by_id(city_id)
-    if city:
-        return next((d for d in city['districts'] if d['id'] == district_id), None)
-    return None
+    return catalog_index.districts.get((city_id, district_id))
 
 def get_location_info():
     if 'city_id' in session and 'district_id' in session:
         city = get_city_by_id(session['city_id'])
         district = get_district_by_id(session['city_id'], session['district_id'])
         if city and district:
-            return {'city': city, 'district': district}
+            return {'city': city, 'district': district, 'id': location_registry.intern(city['id'], district['id'])}
     return None
 
-def calculate_price_with_location(base_price, location):
-    if location:
-        return round(base_price * location['district']['price_factor'])
-    return base_price
+def calculate_price_with_location(base_price, location):
+    if location:
+        return round(base_price * location['district']['price_factor'])
+    return base_price
+
+# Inventory ledger
+INVENTORY_FILE = 'data/inventory.bin'          # on-hand and reserved quantity matrices
+INVENTORY_AXES_FILE = 'data/inventory.json'    # product ids and location keys of their rows and columns
+UNTRACKED = -1  # on-hand value of a product and location without stock management
+INVENTORY_PLANES = 3            # on hand, reserved, time of the latest reservation
+RESERVATION_TIMEOUT = 300       # seconds after which a reservation left by a stopped worker is released
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id, available):
+        super().__init__(f"Only {available} left of product {product_id}")
+        self.product_id = product_id
+        self.available = available
+
+class InventoryLedger:
+    """
+    Stock per product and district, kept out of the catalog as dense int64
+    (product x location) matrices, on hand, reserved and the time of the
+    latest reservation, in one memory-mapped file. Every worker maps the same file, and each operation
+    runs under the file's lock, so reserve() checks and claims stock
+    atomically across threads and processes.
+
+    Checkout reserves the cart, then commits the reservation once the order
+    is recorded or releases it if that fails. Reservations a worker left
+    behind by stopping in between are released when the ledger is next
+    loaded, once they are older than RESERVATION_TIMEOUT. Cells set to UNTRACKED sell
+    without limit, which is also what products and districts the ledger has
+    never seen get. The mapping itself is the shared state; writing it back
+    to disk is batched through the write-behind writer.
+    """
+
+    def __init__(self, path, axes_path):
+        self.path = path
+        self.axes_path = axes_path
+        self.stamp = None
+        self.product_ids = []
+        self.location_keys = []
+        self.product_index = {}      # product id -> row
+        self.location_columns = {}   # registry location id -> column
+        self.column_locations = []   # column -> registry location id
+        self.cells = np.zeros((INVENTORY_PLANES, 0, 0), dtype='<i8')  # [0] on hand, [1] reserved, [2] reserved at
+
+    @property
+    def loaded(self):
+        return self.stamp is not None
+
+    def load(self, products, locations):
+        """
+        Map the ledger, creating it from the catalog's legacy per-product
+        'inventory' dicts on first use; `products` and the `locations` keys
+        give the rows and columns to allocate
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with file_lock(self.path):
+            self._settle_axes()
+            if file_stamp(self.axes_path) is None:
+                stock = {}
+                for product in products:
+                    for location_key, quantity in (product.get('inventory') or {}).items():
+                        stock[(product['id'], location_key)] = quantity
+                self._write([product['id'] for product in products], locations, stock)
+            self._remap()
+            if len(self.cells) < INVENTORY_PLANES:
+                # Ledgers written before reservations were timed
+                self._write(self.product_ids, self.location_keys, self._stock())
+                self._remap()
+            self._release_stale()
+
+    def _remap(self):
+        """
+        Re-read the axes and map the matrices if another worker replaced them
+        """
+        self._settle_axes()
+        stamp = file_stamp(self.axes_path)
+        if stamp == self.stamp:
+            return
+        axes = load_data(self.axes_path)
+        self.product_ids = axes['products']
+        self.location_keys = axes['locations']
+        self.product_index = {product_id: i for i, product_id in enumerate(self.product_ids)}
+        self.column_locations = [location_registry.id_for_key(location_key) for location_key in self.location_keys]
+        self.location_columns = {location_id: i for i, location_id in enumerate(self.column_locations)}
+        size = len(self.product_ids) * len(self.location_keys)
+        if size:
+            planes = os.path.getsize(self.path) // (8 * size)
+            self.cells = np.memmap(self.path, dtype='<i8', mode='r+',
+                                   shape=(planes, len(self.product_ids), len(self.location_keys)))
+        else:
+            self.cells = np.zeros((INVENTORY_PLANES, len(self.product_ids), len(self.location_keys)), dtype='<i8')
+        self.stamp = stamp
+
+    def _settle_axes(self):
+        """
+        Finish or undo a _write() that stopped before committing its axes:
+        the pending axes are kept only if the matrices were written for them
+        """
+        pending_path = f"{self.axes_path}.new"
+        if not os.path.exists(pending_path):
+            return
+        axes = load_data(pending_path)
+        size = 8 * INVENTORY_PLANES * len(axes['products']) * len(axes['locations'])
+        if os.path.exists(self.path) and os.path.getsize(self.path) == size:
+            os.replace(pending_path, self.axes_path)
+        else:
+            os.remove(pending_path)
+
+    def _stock(self):
+        """
+        Return {(product id, location key): (on hand, reserved, reserved at)} for the tracked cells
+        """
+        stock = {}
+        rows, columns = np.nonzero(self.cells[0] != UNTRACKED)
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            quantities = [int(value) for value in self.cells[:, row, column]]
+            stock[(self.product_ids[row], self.location_keys[column])] = \
+                tuple(quantities + [0] * (INVENTORY_PLANES - len(quantities)))
+        return stock
+
+    def _release_stale(self):
+        """
+        Drop reservations older than RESERVATION_TIMEOUT, left by a worker that
+        stopped between reserve() and commit() or release()
+        """
+        stale = (self.cells[1] > 0) & (self.cells[2] < time.time() - RESERVATION_TIMEOUT)
+        if stale.any():
+            self.cells[1][stale] = 0
+            self._schedule_save()
+            print(f"Released stale inventory reservations in {int(stale.sum())} cells")
+
+    def _write(self, product_ids, location_keys, stock):
+        """
+        Replace the ledger with new axes; `stock` maps (product id, location
+        key) to (on hand, reserved, reserved at) or an on-hand quantity
+        """
+        cells = np.zeros((INVENTORY_PLANES, len(product_ids), len(location_keys)), dtype='<i8')
+        cells[0] = UNTRACKED
+        product_index = {product_id: i for i, product_id in enumerate(product_ids)}
+        location_index = {location_key: i for i, location_key in enumerate(location_keys)}
+        for (product_id, location_key), quantities in stock.items():
+            if product_id in product_index and location_key in location_index:
+                cells[:, product_index[product_id], location_index[location_key]] = \
+                    quantities if isinstance(quantities, tuple) else (quantities, 0, 0)
+        # The axes are staged, then the matrices written, then the axes renamed
+        # into place: other workers only remap once the axes change, and a
+        # crash in between is settled by _settle_axes()
+        pending_path = f"{self.axes_path}.new"
+        write_json_atomic({'products': product_ids, 'locations': location_keys}, pending_path)
+        write_bytes_atomic(cells.tobytes(), self.path)
+        os.replace(pending_path, self.axes_path)
+
+    def _grow(self, product_id, location_id):
+        """
+        Add a row or column for a product or location the ledger does not have yet
+        """
+        product_ids = self.product_ids + ([product_id] if product_id not in self.product_index else [])
+        location_keys = self.location_keys + (
+            [location_registry.keys[location_id]] if location_id not in self.location_columns else [])
+        self._write(product_ids, location_keys, self._stock())
+        self._remap()
+
+    def _cell(self, product_id, location_id):
+        row = self.product_index.get(product_id)
+        column = self.location_columns.get(location_id)
+        return None if row is None or column is None else (row, column)
+
+    def _schedule_save(self):
+        data_writer.schedule(self, self.path, write=lambda ledger, _: ledger.flush())
+
+    def flush(self):
+        with file_lock(self.path):
+            if isinstance(self.cells, np.memmap):
+                self.cells.flush()
+
+    def stock(self, product_id):
+        """
+        Return {location id: (on hand, reserved)} for the tracked locations of a product
+        """
+        with file_lock(self.path):
+            self._remap()
+            row = self.product_index.get(product_id)
+            if row is None:
+                return {}
+            columns = np.flatnonzero(self.cells[0, row] != UNTRACKED)
+            return {
+                self.column_locations[column]: (int(self.cells[0, row, column]), int(self.cells[1, row, column]))
+                for column in columns.tolist()
+            }
+
+    def set_quantity(self, product_id, location_id, quantity):
+        """
+        Set the on-hand quantity of a product at a location
+        """
+        if quantity < 0:
+            raise ValueError('Inventory quantity cannot be negative')
+        with file_lock(self.path):
+            self._remap()
+            if self._cell(product_id, location_id) is None:
+                self._grow(product_id, location_id)
+            self.cells[0][self._cell(product_id, location_id)] = quantity
+        self._schedule_save()
+
+    def reserve(self, location_id, items):
+        """
+        Claim the (product id, quantity) items at one location, all or none.
+        Raises InsufficientStock for the first item that is short; otherwise
+        returns the reservation to pass to commit() or release().
+        """
+        quantities = Counter()
+        for product_id, quantity in items:
+            # Carts are also filled from older sessions, so quantities are checked here as well
+            if quantity <= 0:
+                raise ValueError(f"Invalid quantity {quantity} of product {product_id}")
+            quantities[product_id] += quantity
+        with file_lock(self.path):
+            self._remap()
+            reservation = []
+            for product_id, quantity in quantities.items():
+                cell = self._cell(product_id, location_id)
+                if cell is None or self.cells[0][cell] == UNTRACKED:
+                    continue
+                available = int(self.cells[0][cell] - self.cells[1][cell])
+                if available < quantity:
+                    raise InsufficientStock(product_id, max(available, 0))
+                reservation.append((product_id, location_id, quantity))
+            reserved_at = int(time.time())
+            for product_id, location_id, quantity in reservation:
+                cell = self._cell(product_id, location_id)
+                self.cells[1][cell] += quantity
+                self.cells[2][cell] = reserved_at
+        if reservation:
+            self._schedule_save()
+        return reservation
+
+    def _settle(self, reservation, sold):
+        if not reservation:
+            return
+        with file_lock(self.path):
+            self._remap()
+            for product_id, location_id, quantity in reservation:
+                cell = self._cell(product_id, location_id)
+                if cell is None:
+                    continue
+                self.cells[1][cell] = max(0, self.cells[1][cell] - quantity)
+                if sold and self.cells[0][cell] != UNTRACKED:
+                    self.cells[0][cell] = max(0, self.cells[0][cell] - quantity)
+        self._schedule_save()
+
+    def commit(self, reservation):
+        """
+        Take reserved stock off the shelf
+        """
+        self._settle(reservation, sold=True)
+
+    def release(self, reservation):
+        """
+        Return reserved stock unsold
+        """
+        self._settle(reservation, sold=False)
+
+inventory_ledger = InventoryLedger(INVENTORY_FILE, INVENTORY_AXES_FILE)
+
+# Location-priced catalog views
+class PricedCatalogCache:
+    """
+    Copies of the catalog with location pricing applied, materialized once
+    per district and catalog snapshot and reused until a newer one is published.
+    Views are shared between requests and must not be modified.
+    """
+
+    def __init__(self):
+        self.views = {}  # location id or None -> (catalog version, view)
+
+    def get(self, location):
+        key = location['id'] if location else None
+        snapshot = catalog_index.snapshot
+        cached = self.views.get(key)
+        if cached and cached[0] == snapshot.version:
+            return cached[1]
+        
+        view = self._build(snapshot, location)
+        self.views[key] = (snapshot.version, view)
+        return view
+
+    def _build(self, snapshot, location):
+        categories = []
+        categories_by_id = {}
+        for category in snapshot.products_data['categories']:
+            category_copy = category.copy()
+            products_copy = []
+            
+            for product in category['products']:
+                product_copy = product.copy()
+                product_copy['original_price'] = product['price']
+                product_copy['price'] = calculate_price_with_location(product['price'], location)
+                products_copy.append(product_copy)
+                
+            category_copy['products'] = products_copy
+            categories.append(category_copy)
+            categories_by_id[category['id']] = category_copy
+        return {'categories': categories, 'categories_by_id': categories_by_id}
+
+priced_catalog = PricedCatalogCache()
+
+# Price prediction
+PREDICTION_WINDOW = 10               # most recent entries used per product and location
+PREDICTION_MIN_POINTS = 3            # fewer entries than this fall back to the current price
+PREDICTION_TREND_FACTOR = 0.02       # how much to adjust the average for the trend
+PREDICTION_MIN_FACTOR = 0.85         # predictions stay within these factors of the current price
+PREDICTION_MAX_FACTOR = 1.15
+PREDICTION_DEFAULT_CONFIDENCE = 80   # confidence without enough history
+PREDICTION_BASE_CONFIDENCE = 90      # confidence with PREDICTION_MIN_POINTS steady entries
+PREDICTION_CONFIDENCE_PER_POINT = 2  # added for every entry beyond PREDICTION_MIN_POINTS
+PREDICTION_MIN_CONFIDENCE = 50
+PREDICTION_MAX_CONFIDENCE = 95
+
+def trend_prediction(avg_price, trend, current_price):
+    """
+    Average price adjusted for the trend and kept near the current price;
+    takes numbers or numpy arrays and returns the unrounded prediction
+    """
+    predicted = avg_price * (1 + PREDICTION_TREND_FACTOR * trend)
+    return np.clip(predicted, current_price * PREDICTION_MIN_FACTOR, current_price * PREDICTION_MAX_FACTOR)
+
+def prediction_confidence(volatility_factor, data_points):
+    """
+    Rounded confidence for a window of `data_points` entries; takes numbers or numpy arrays
+    """
+    confidence = (PREDICTION_BASE_CONFIDENCE - volatility_factor * 100
+                  + (data_points - PREDICTION_MIN_POINTS) * PREDICTION_CONFIDENCE_PER_POINT)
+    return np.rint(np.clip(confidence, PREDICTION_MIN_CONFIDENCE, PREDICTION_MAX_CONFIDENCE))
+
+# Prediction cache
+PREDICTION_CACHE_SIZE = 4096  # product/location predictions kept in memory
+
+class PredictionCache:
+    """
+    Bounded LRU cache of predict_price() results.
+
+    Keys include the price history and catalog versions, so entries computed
+    before a change are never served; the write paths also call invalidate()
+    to release them right away. Cached results are shared between requests
+    and must not be modified.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Return (found, value)
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'invalidations': self.invalidations
+            }
+
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE)
 
 def predict_price(product_id, location):
     """
-    Predict price based on previous 10 days of orders for a specific product and location
+    Cached price prediction for a specific product and location
     """
     if not location:
         return None
     
-    # Load price history data
-    try:
-        with open('data/price_history.json', 'r') as f:
-            price_history = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        # If file doesn't exist or is invalid, initialize with empty data
-        price_history = {'history': []}
-    
-    # Create a unique key for product and location combination
-    location_key = f"{location['city']['id']}_{location['district']['id']}"
-    product_location_key = f"{product_id}_{location_key}"
-    
+    key = (product_id, location['id'], price_history_store.version, catalog_index.version)
+    found, prediction = prediction_cache.get(key)
+    if not found:
+        prediction = compute_price_prediction(product_id, location)
+        prediction_cache.put(key, prediction)
+    return prediction
+
+def compute_price_prediction(product_id, location):
+    """
+    Predict price based on previous 10 days of orders for a specific product and location
+    """
     # Get product base price
     product = get_product_by_id(product_id)
     if not product:
@@ -120,56 +3209,45 @@ def predict_price(product_id, location):
     base_price = product['price']
     current_price = round(base_price * location['district']['price_factor'])
     
-    # Filter price history for this product and location
-    product_history = [
-        entry for entry in price_history['history'] 
-        if entry['product_id'] == product_id and entry['location_key'] == location_key
-    ]
+    # Price history for this product and location (newest first)
+    product_history = price_history_store.series(product_id, location['id'], limit=PREDICTION_WINDOW)
+    product_history.reverse()
     
-    # Sort by date (newest first)
-    product_history.sort(key=lambda x: x['date'], reverse=True)
-    
-    # If we have less than 3 data points, return current price with location factor
-    if len(product_history) < 3:
+    # Without enough data points, return current price with location factor
+    if len(product_history) < PREDICTION_MIN_POINTS:
         return {
             'current_price': current_price,
             'predicted_price': current_price,
-            'confidence': 80,  # Default confidence
+            'confidence': PREDICTION_DEFAULT_CONFIDENCE,
             'history': []
         }
     
-    # Use up to last 10 days of data for prediction
-    recent_history = product_history[:10]
+    # Use up to the last PREDICTION_WINDOW days of data for prediction
+    recent_history = product_history[:PREDICTION_WINDOW]
     
     # Calculate average price and trend
-    prices = [entry['price'] for entry in recent_history]
+    prices = [price for _, price in recent_history]
     avg_price = sum(prices) / len(prices)
     
     # Simple trend analysis: positive if prices are generally increasing
     trend = sum(prices[:3]) / 3 - sum(prices[-3:]) / 3
     
-    # Calculate predicted price with a small adjustment based on trend
-    trend_factor = 0.02  # How much to adjust for trend
-    predicted_price = avg_price * (1 + trend_factor * trend)
-    
-    # Make sure prediction is reasonable (within ±15% of current price)
-    predicted_price = max(current_price * 0.85, min(current_price * 1.15, predicted_price))
-    predicted_price = round(predicted_price)
+    # Calculate predicted price with a small adjustment based on trend, kept near the current price
+    predicted_price = int(np.rint(trend_prediction(avg_price, trend, current_price)))
     
     # Calculate confidence based on amount of data and volatility
     data_points = len(recent_history)
     volatility = sum([abs(prices[i] - prices[i-1]) for i in range(1, len(prices))]) / (len(prices) - 1)
     volatility_factor = volatility / avg_price
     
-    confidence = round(min(95, max(50, 90 - volatility_factor * 100 + (data_points - 3) * 2)))
+    confidence = int(prediction_confidence(volatility_factor, data_points))
     
     # Format recent history for display
     formatted_history = []
-    for entry in recent_history:
-        date_obj = datetime.strptime(entry['date'], '%Y-%m-%d')
+    for ordinal, price in recent_history:
         formatted_history.append({
-            'date': date_obj.strftime('%b %d'),
-            'price': entry['price']
+            'date': date.fromordinal(ordinal).strftime('%b %d'),
+            'price': price
         })
     
     return {
@@ -179,51 +3257,470 @@ def predict_price(product_id, location):
         'history': formatted_history
     }
 
+# Batch price prediction
+class BatchPredictions:
+    """
+    predict_price() results for every (product, location) pair with price
+    history, computed in one vectorized pass over the store's columns.
+
+    Numeric fields are held in arrays indexed by pair; get() turns one pair
+    into the same dictionary predict_price() returns.
+    """
+
+    def __init__(self, key, product_ids, location_ids, dates, prices):
+        self.key = key
+        self.dates = dates
+        self.prices = prices
+
+        # Rows of a pair are contiguous and sorted by date, so pair blocks start wherever the pair changes
+        n = len(prices)
+        changes = np.flatnonzero((product_ids[1:] != product_ids[:-1]) | (location_ids[1:] != location_ids[:-1])) + 1
+        starts = np.concatenate(([0], changes)) if n else np.zeros(0, dtype=np.int64)
+        stops = np.concatenate((starts[1:], [n])) if n else np.zeros(0, dtype=np.int64)
+        self.pair_product_ids = product_ids[starts]
+        self.pair_location_ids = location_ids[starts]
+        self.starts, self.stops = starts, stops
+        self.pairs = {
+            pair: i for i, pair in enumerate(zip(self.pair_product_ids.tolist(), self.pair_location_ids.tolist()))
+        }
+
+        # Current prices from the catalog; pairs whose product or district no longer exists get NaN
+        unique_products, product_inverse = np.unique(self.pair_product_ids, return_inverse=True)
+        products = catalog_index.products
+        base_prices = np.array([
+            products[product_id]['price'] if product_id in products else np.nan
+            for product_id in unique_products.tolist()
+        ], dtype=np.float64)
+        price_factors = location_registry.price_factors()
+        self.base_prices = base_prices[product_inverse] if len(unique_products) else np.zeros(0)
+        factors = price_factors[self.pair_location_ids] if len(price_factors) else np.zeros(0)
+        self.valid = ~np.isnan(self.base_prices) & ~np.isnan(factors)
+        self.current_prices = np.rint(self.base_prices * factors)
+
+        # Window of the most recent entries per pair (oldest first in storage)
+        counts = stops - starts
+        window = np.minimum(counts, PREDICTION_WINDOW)
+        self.window = window
+        enough = counts >= PREDICTION_MIN_POINTS
+        self.enough = enough
+
+        self.predicted_prices = self.current_prices.copy()
+        self.confidence = np.full(len(starts), float(PREDICTION_DEFAULT_CONFIDENCE))
+        if not enough.any():
+            return
+
+        idx = np.flatnonzero(enough)
+        w = window[idx]
+        window_starts = stops[idx] - w
+        offsets = np.cumsum(w) - w
+        rows = np.repeat(window_starts - offsets, w) + np.arange(w.sum())
+        window_prices = prices[rows].astype(np.float64)
+        groups = np.repeat(np.arange(len(idx)), w)
+
+        avg_price = np.add.reduceat(window_prices, offsets) / w
+        # Trend: newest three entries against the oldest three in the window
+        stop = stops[idx]
+        newest = prices[stop - 1] + prices[stop - 2] + prices[stop - 3]
+        oldest = prices[window_starts] + prices[window_starts + 1] + prices[window_starts + 2]
+        trend = newest / 3 - oldest / 3
+
+        self.predicted_prices[idx] = np.rint(trend_prediction(avg_price, trend, self.current_prices[idx]))
+
+        same_pair = groups[1:] == groups[:-1]
+        steps = np.abs(np.diff(window_prices))[same_pair]
+        volatility = np.bincount(groups[1:][same_pair], weights=steps, minlength=len(idx)) / (w - 1)
+        volatility_factor = volatility / avg_price
+        self.confidence[idx] = prediction_confidence(volatility_factor, w)
+
+    def get(self, product_id, location_id):
+        """
+        Return the prediction for one pair in predict_price() format, or None
+        if the product or location does not exist
+        """
+        i = self.pairs.get((product_id, location_id))
+        if i is None or not self.valid[i]:
+            product = get_product_by_id(product_id)
+            _, district = location_registry.location(location_id)
+            if not product or not district:
+                return None
+            current_price = round(product['price'] * district['price_factor'])
+            return {'current_price': current_price, 'predicted_price': current_price,
+                    'confidence': PREDICTION_DEFAULT_CONFIDENCE, 'history': []}
+
+        history = []
+        if self.enough[i]:
+            for row in range(self.stops[i] - 1, self.stops[i] - 1 - self.window[i], -1):
+                history.append({
+                    'date': date.fromordinal(int(self.dates[row])).strftime('%b %d'),
+                    'price': int(self.prices[row])
+                })
+        return {
+            'current_price': int(self.current_prices[i]),
+            'predicted_price': int(self.predicted_prices[i]),
+            'confidence': int(self.confidence[i]),
+            'history': history
+        }
+
+    def largest_changes(self, limit):
+        """
+        Return the (product_id, location_id) pairs with the largest predicted
+        change from the current price, biggest first
+        """
+        change = np.where(self.valid, np.abs(self.predicted_prices - self.current_prices), -1)
+        order = np.argsort(-change, kind='stable')[:limit]
+        return [
+            (int(self.pair_product_ids[i]), int(self.pair_location_ids[i]))
+            for i in order if self.valid[i]
+        ]
+
+batch_predictions = None
+pair_history = None
+
+def price_history_by_pair():
+    """
+    The store's rows grouped by (product, location) pair, oldest first within
+    each pair: (store version, product ids, location ids, date ordinals,
+    prices). Regrouped only after the history changed.
+    """
+    global pair_history
+    price_history_store.ensure_loaded()
+    with price_history_store.lock:
+        version = price_history_store.version
+        if pair_history is not None and pair_history[0] == version:
+            return pair_history
+        keys, dates, prices = price_history_store.columns()
+    # Partitions are stored by day; regroup the rows by pair
+    order = np.lexsort((dates, keys))
+    keys = keys[order]
+    pair_history = (version, keys >> LOCATION_KEY_BITS, keys & LOCATION_KEY_MASK,
+                    dates[order], prices[order])
+    return pair_history
+
+def predict_prices_batch():
+    """
+    Predictions for every product and location pair, recomputed only when
+    price history or the catalog has changed since the last call
+    """
+    global batch_predictions
+    history = price_history_by_pair()
+    key = (history[0], catalog_index.version)
+    if batch_predictions is not None and batch_predictions.key == key:
+        return batch_predictions
+    batch_predictions = BatchPredictions(key, *history[1:])
+    return batch_predictions
+
+# Price analytics
+ANALYTICS_BACKTEST_DAYS = 30  # days of history replayed to measure prediction accuracy
+ANALYTICS_TABLE_ROWS = 20     # least accurate pairs listed on the analytics page
+
+class PriceAnalytics:
+    """
+    Price statistics for the admin analytics page, computed in one
+    vectorized pass over the price history grouped by pair:
+
+    - fluctuation: mean absolute day-to-day price change in percent, per
+      product, location, city and category
+    - accuracy: predict_price()'s algorithm replayed on each of the last
+      ANALYTICS_BACKTEST_DAYS days of history, using only the entries before
+      that day, against the price actually recorded that day
+    """
+
+    def __init__(self, key, product_ids, location_ids, dates, prices):
+        self.key = key
+        n = len(prices)
+        prices_f = prices.astype(np.float64)
+
+        # Position of each row within its pair
+        pair_start = np.ones(n, dtype=bool)
+        pair_start[1:] = (product_ids[1:] != product_ids[:-1]) | (location_ids[1:] != location_ids[:-1])
+        position = np.arange(n) - np.maximum.accumulate(np.where(pair_start, np.arange(n), 0))
+        last_row = np.ones(n, dtype=bool)
+        last_row[:-1] = pair_start[1:]
+
+        # Catalog lookups by product and location
+        self.product_ids, product_index = np.unique(product_ids, return_inverse=True)
+        self.location_count = len(location_registry)
+        districts = [location_registry.location(location_id) for location_id in range(self.location_count)]
+        snapshot = catalog_index.snapshot
+        categories = [snapshot.product_categories.get(product_id) for product_id in self.product_ids.tolist()]
+        self.categories = snapshot.products_data['categories']
+        category_positions = {category['id']: i for i, category in enumerate(self.categories)}
+        product_category = np.array([
+            category_positions.get(category['id'], -1) if category else -1 for category in categories
+        ], dtype=np.int64)
+        base_prices = np.array([
+            snapshot.products[product_id]['price'] if product_id in snapshot.products else np.nan
+            for product_id in self.product_ids.tolist()
+        ], dtype=np.float64)
+        price_factors = np.array([district['price_factor'] if district else np.nan for _, district in districts],
+                                 dtype=np.float64)
+        current_prices = np.rint(base_prices[product_index] * price_factors[location_ids]) if n else np.zeros(0)
+
+        # Day-to-day fluctuation
+        step_rows = np.flatnonzero(~pair_start)
+        steps = np.abs(prices_f[step_rows] - prices_f[step_rows - 1]) / prices_f[step_rows - 1] * 100
+        self.product_fluctuation = self._mean_by(product_index[step_rows], steps, len(self.product_ids))
+        self.location_fluctuation = self._mean_by(location_ids[step_rows], steps, self.location_count)
+        self.category_fluctuation = self._mean_by(product_category[product_index[step_rows]], steps,
+                                                  len(self.categories))
+        city_ids = sorted(set(city['id'] for city, _ in districts if city))
+        city_positions = {city_id: i for i, city_id in enumerate(city_ids)}
+        location_city = np.array([city_positions[city['id']] if city else -1 for city, _ in districts], dtype=np.int64)
+        self.cities = [get_city_by_id(city_id) for city_id in city_ids]
+        self.city_fluctuation = self._mean_by(location_city[location_ids[step_rows]], steps, len(city_ids))
+        self.avg_fluctuation = float(steps.mean()) if len(steps) else 0.0
+
+        # Replay predictions for the last days of history
+        last_date = int(dates.max()) if n else 0
+        self.backtest_start = last_date - ANALYTICS_BACKTEST_DAYS + 1
+        rows = np.flatnonzero((position >= PREDICTION_MIN_POINTS) & (dates >= self.backtest_start))
+        rows = rows[~np.isnan(current_prices[rows])]
+        window = np.minimum(position[rows], PREDICTION_WINDOW)
+        cumulative = np.concatenate(([0.0], np.cumsum(prices_f)))
+        avg_price = (cumulative[rows] - cumulative[rows - window]) / window
+        newest = (prices_f[rows - 1] + prices_f[rows - 2] + prices_f[rows - 3]) / 3
+        oldest = (prices_f[rows - window] + prices_f[rows - window + 1] + prices_f[rows - window + 2]) / 3
+        predicted = np.rint(trend_prediction(avg_price, newest - oldest, current_prices[rows]))
+        actual = prices_f[rows]
+        accuracy = np.maximum(0, 100 - np.abs(predicted - actual) / actual * 100)
+
+        self.avg_accuracy = float(accuracy.mean()) if len(accuracy) else None
+        self.daily_accuracy = self._mean_by(dates[rows] - self.backtest_start, accuracy, ANALYTICS_BACKTEST_DAYS)
+        self.category_accuracy = self._mean_by(product_category[product_index[rows]], accuracy, len(self.categories))
+        self.category_products = np.bincount(product_category[product_category >= 0], minlength=len(self.categories))
+
+        # The latest replayed day of each pair, for the table
+        latest = last_row[rows]
+        self.latest_rows = rows[latest]
+        self.latest_product_ids = product_ids[self.latest_rows]
+        self.latest_location_ids = location_ids[self.latest_rows]
+        self.latest_categories = product_category[product_index[self.latest_rows]]
+        self.latest_cities = location_city[self.latest_location_ids]
+        self.latest_predicted = predicted[latest]
+        self.latest_actual = actual[latest]
+        self.latest_accuracy = accuracy[latest]
+
+    @staticmethod
+    def _mean_by(groups, values, size):
+        """
+        Mean of `values` per group id in [0, size), NaN for empty groups; negative ids are skipped
+        """
+        keep = groups >= 0
+        totals = np.bincount(groups[keep], weights=values[keep], minlength=size)
+        counts = np.bincount(groups[keep], minlength=size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return totals / counts
+
+    def stats(self):
+        stats = {
+            'avg_fluctuation': round(self.avg_fluctuation, 1),
+            'avg_accuracy': round(self.avg_accuracy, 1) if self.avg_accuracy is not None else None,
+            'most_volatile_product': 'N/A',
+            'most_volatile_fluctuation': 0,
+            'most_stable_location': 'N/A',
+            'most_stable_fluctuation': 0
+        }
+        if len(self.product_fluctuation) and not np.isnan(self.product_fluctuation).all():
+            i = int(np.nanargmax(self.product_fluctuation))
+            product = get_product_by_id(int(self.product_ids[i]))
+            stats['most_volatile_product'] = product['name'] if product else f"Product {int(self.product_ids[i])}"
+            stats['most_volatile_fluctuation'] = round(float(self.product_fluctuation[i]), 1)
+        if len(self.location_fluctuation) and not np.isnan(self.location_fluctuation).all():
+            i = int(np.nanargmin(self.location_fluctuation))
+            stats['most_stable_location'] = location_registry.name(i)
+            stats['most_stable_fluctuation'] = round(float(self.location_fluctuation[i]), 1)
+        return stats
+
+    def accuracy_chart(self):
+        """
+        Return (labels, values) of the mean prediction accuracy per replayed day
+        """
+        days = np.flatnonzero(~np.isnan(self.daily_accuracy))
+        return ([date.fromordinal(int(self.backtest_start + day)).strftime('%b %d') for day in days],
+                [round(float(self.daily_accuracy[day]), 1) for day in days])
+
+    def city_chart(self):
+        """
+        Return (labels, values) of the mean fluctuation per city
+        """
+        cities = [i for i in range(len(self.cities)) if not np.isnan(self.city_fluctuation[i])]
+        return ([self.cities[i]['name'] for i in cities],
+                [round(float(self.city_fluctuation[i]), 1) for i in cities])
+
+    def category_summary(self):
+        summary = []
+        for i, category in enumerate(self.categories):
+            fluctuation, accuracy = self.category_fluctuation[i], self.category_accuracy[i]
+            summary.append({
+                'name': category['name'],
+                'products': int(self.category_products[i]),
+                'fluctuation': None if np.isnan(fluctuation) else round(float(fluctuation), 1),
+                'accuracy': None if np.isnan(accuracy) else round(float(accuracy), 1)
+            })
+        return summary
+
+    def predictions(self, category_id=None, city_id=None, limit=ANALYTICS_TABLE_ROWS):
+        """
+        Return the pairs whose latest replayed prediction was least accurate,
+        optionally within one category and city
+        """
+        matching = np.ones(len(self.latest_rows), dtype=bool)
+        if category_id is not None:
+            position = next((i for i, category in enumerate(self.categories) if category['id'] == category_id), -2)
+            matching &= self.latest_categories == position
+        if city_id is not None:
+            position = next((i for i, city in enumerate(self.cities) if city['id'] == city_id), -2)
+            matching &= self.latest_cities == position
+        candidates = np.flatnonzero(matching)
+        candidates = candidates[np.argsort(self.latest_accuracy[candidates], kind='stable')[:limit]]
+
+        predictions = []
+        for i in candidates.tolist():
+            product = get_product_by_id(int(self.latest_product_ids[i]))
+            category = get_category_for_product(product['id']) if product else None
+            predictions.append({
+                'product_name': product['name'] if product else f"Product {int(self.latest_product_ids[i])}",
+                'category': category['name'] if category else '',
+                'location': location_registry.name(int(self.latest_location_ids[i])),
+                'base_price': product['price'] if product else None,
+                'predicted_price': int(self.latest_predicted[i]),
+                'actual_price': int(self.latest_actual[i]),
+                'accuracy': round(float(self.latest_accuracy[i]))
+            })
+        return predictions
+
+price_analytics = None
+analytics_refresh = None
+analytics_lock = threading.Lock()
+
+def compute_price_analytics():
+    global price_analytics
+    history = price_history_by_pair()
+    key = (history[0], catalog_index.version)
+    if price_analytics is None or price_analytics.key != key:
+        price_analytics = PriceAnalytics(key, *history[1:])
+    return price_analytics
+
+def get_price_analytics():
+    """
+    Current analytics. When the history or catalog changed since they were
+    computed, the previous results are returned while a background thread
+    refreshes them; only the very first call computes inline.
+    """
+    global analytics_refresh
+    analytics = price_analytics
+    if analytics is None:
+        with analytics_lock:
+            return compute_price_analytics()
+    if analytics.key != (price_history_store.version, catalog_index.version):
+        with analytics_lock:
+            if analytics_refresh is None or not analytics_refresh.is_alive():
+                analytics_refresh = threading.Thread(target=compute_price_analytics, daemon=True)
+                analytics_refresh.start()
+    return analytics
+
+# Price history generation
+def generate_price_history(days, seed=None, end=None):
+    """
+    Synthetic price history for every product in every district over the
+    `days` days before the `end` date ordinal (default today): the location
+    price with a random -5% to +5% variation. The same seed gives the same
+    history.
+
+    Returns an iterator of (date ordinal, PRICE_RECORD records) with one day
+    generated per step, as a product x district matrix.
+    """
+    rng = np.random.default_rng(seed)
+    snapshot = catalog_index.snapshot
+    products = [product for category in snapshot.products_data['categories'] for product in category['products']]
+    product_ids = np.array([product['id'] for product in products], dtype=np.int64)
+    base_prices = np.array([product['price'] for product in products], dtype=np.float64)
+    location_ids = []
+    price_factors = []
+    for city in snapshot.locations_data['cities']:
+        for district in city['districts']:
+            location_ids.append(location_registry.intern(city['id'], district['id']))
+            price_factors.append(district['price_factor'])
+
+    location_prices = np.rint(base_prices[:, None] * np.array(price_factors, dtype=np.float64)[None, :]).ravel()
+    keys = ((product_ids[:, None] << LOCATION_KEY_BITS) | np.array(location_ids, dtype=np.int64)[None, :]).ravel()
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    location_prices = location_prices[order]
+    end = end if end is not None else date.today().toordinal()
+
+    def generate_days():
+        for ordinal in range(end - days, end):
+            records = np.empty(len(keys), dtype=PRICE_RECORD)
+            records['key'] = keys
+            records['price'] = np.rint(location_prices * (0.95 + rng.random(len(keys)) * 0.1))
+            yield ordinal, records
+
+    return generate_days()
+
+class PriceHistoryGeneration:
+    """
+    Regenerates the whole price history in a background thread, one job at
+    a time, with progress the admin page can poll. Each day goes to storage
+    as soon as it is generated; the new history replaces the old one once
+    every day is written.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.status = {'state': 'idle', 'days_done': 0, 'days_total': 0, 'seed': None, 'error': None}
+
+    def progress(self):
+        with self.lock:
+            return dict(self.status)
+
+    def _update(self, **fields):
+        with self.lock:
+            self.status.update(fields)
+
+    def start(self, days, seed=None):
+        """
+        Start regenerating `days` days of history. Returns False if a job is already running
+        """
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.status = {'state': 'generating', 'days_done': 0, 'days_total': days, 'seed': seed, 'error': None}
+            self.thread = threading.Thread(target=self._run, args=(days, seed), daemon=True)
+            self.thread.start()
+            return True
+
+    def _track(self, generated):
+        # Passes days through to storage, counting them as they are written
+        for days_done, day in enumerate(generated, 1):
+            yield day
+            self._update(days_done=days_done)
+        self._update(state='saving')
+
+    def _run(self, days, seed):
+        try:
+            price_history_store.replace_days(self._track(generate_price_history(days, seed)))
+            prediction_cache.invalidate()
+            self._update(state='done')
+            start_price_history_compaction()
+        except Exception as e:
+            self._update(state='failed', error=str(e))
+            print(f"Error regenerating price history: {str(e)}")
+
+price_history_generation = PriceHistoryGeneration()
+
 def initialize_price_history():
     """
     Create initial price history data for the past 10 days (if it doesn't exist)
     """
-    # Check if price history file already exists
-    if os.path.exists('data/price_history.json'):
+    # Check if price history already exists
+    if len(price_history_store):
         return
     
-    today = datetime.now()
-    history_entries = []
-    
-    # For each product in each location, create 10 days of price history
-    for category in products_data['categories']:
-        for product in category['products']:
-            product_id = product['id']
-            base_price = product['price']
-            
-            for city in locations_data['cities']:
-                for district in city['districts']:
-                    location_key = f"{city['id']}_{district['id']}"
-                    
-                    # Calculate base price with location factor
-                    location_price = round(base_price * district['price_factor'])
-                    
-                    # Create 10 days of slightly varying prices
-                    for day_offset in range(10, 0, -1):
-                        date = (today - timedelta(days=day_offset)).strftime('%Y-%m-%d')
-                        
-                        # Random variation between -5% and +5%
-                        variation = 0.95 + (random.random() * 0.1)
-                        price = round(location_price * variation)
-                        
-                        history_entries.append({
-                            'product_id': product_id,
-                            'location_key': location_key,
-                            'date': date,
-                            'price': price
-                        })
-    
-    # Save the price history
-    price_history = {'history': history_entries}
-    with open('data/price_history.json', 'w') as f:
-        json.dump(price_history, f, indent=2)
+    price_history_store.replace_days(generate_price_history(10))
     
-    print(f"Created initial price history with {len(history_entries)} entries")
+    print(f"Created initial price history with {len(price_history_store)} entries")
 
 def update_daily_price_history():
     """
@@ -231,34 +3728,24 @@ def update_daily_price_history():
     """
     today = datetime.now().strftime('%Y-%m-%d')
     
-    # Load existing price history
-    try:
-        with open('data/price_history.json', 'r') as f:
-            price_history = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        price_history = {'history': []}
-    
-    # Check if we already have entries for today
-    today_entries = [
-        entry for entry in price_history['history'] 
-        if entry['date'] == today
-    ]
-    
-    if today_entries:
-        print(f"Price history for {today} already exists ({len(today_entries)} entries)")
+    # Check the ingestion watermark instead of scanning the history for today
+    last_ingested = price_history_store.last_ingested_date()
+    if last_ingested is not None and last_ingested >= today:
+        print(f"Price history for {today} already exists ({price_history_store.day_count(today)} entries)")
         return
     
     # Add today's prices for all products in all locations
     new_entries = []
+    snapshot = catalog_index.snapshot
     
-    for category in products_data['categories']:
+    for category in snapshot.products_data['categories']:
         for product in category['products']:
             product_id = product['id']
             base_price = product['price']
             
-            for city in locations_data['cities']:
+            for city in snapshot.locations_data['cities']:
                 for district in city['districts']:
-                    location_key = f"{city['id']}_{district['id']}"
+                    location_id = location_registry.intern(city['id'], district['id'])
                     
                     # Calculate price with location factor
                     price = round(base_price * district['price_factor'])
@@ -267,29 +3754,43 @@ def update_daily_price_history():
                     variation = 0.98 + (random.random() * 0.04)
                     price = round(price * variation)
                     
-                    new_entries.append({
-                        'product_id': product_id,
-                        'location_key': location_key,
-                        'date': today,
-                        'price': price
-                    })
-    
-    # Add new entries to history
-    price_history['history'].extend(new_entries)
+                    new_entries.append((product_id, location_id, price))
     
-    # Optionally, limit history size to keep only recent data (e.g., last 30 days)
-    if len(price_history['history']) > 100000:  # Arbitrary limit
-        # Sort by date (oldest first)
-        price_history['history'].sort(key=lambda x: x['date'])
-        # Keep only the most recent entries
-        price_history['history'] = price_history['history'][-100000:]
-    
-    # Save updated price history
-    with open('data/price_history.json', 'w') as f:
-        json.dump(price_history, f, indent=2)
+    # Add today as a new partition and advance the watermark, unless another worker got there first
+    if not price_history_store.ingest_day(today, new_entries):
+        print(f"Price history for {today} was already added by another worker")
+        return
+    prediction_cache.invalidate()
     
     print(f"Added {len(new_entries)} price history entries for {today}")
     
+    # Apply the retention policy in the background
+    start_price_history_compaction()
+
+price_history_compaction = None
+
+def compact_price_history():
+    """
+    Fold price history past the daily retention window into weekly and monthly aggregates
+    """
+    try:
+        folded = price_history_store.compact(date.today().toordinal(),
+                                             app.config['PRICE_HISTORY_DAILY_DAYS'],
+                                             app.config['PRICE_HISTORY_WEEKLY_DAYS'],
+                                             app.config['PRICE_HISTORY_PRODUCT_DAILY_DAYS'])
+        if folded:
+            prediction_cache.invalidate()
+            price_history_store.save()
+            print(f"Compacted {folded} price history rows into aggregates")
+    except Exception as e:
+        print(f"Error compacting price history: {str(e)}")
+
+def start_price_history_compaction():
+    global price_history_compaction
+    if price_history_compaction is None or not price_history_compaction.is_alive():
+        price_history_compaction = threading.Thread(target=compact_price_history, daemon=True)
+        price_history_compaction.start()
+    
 # Initialize app data
 def init_app_data():
     # Create data directory if it doesn't exist
@@ -301,28 +3802,146 @@ def init_app_data():
     # Update today's price history
     update_daily_price_history()
 
-# Call initialization when app starts
-init_app_data()
+# Startup
+startup_lock = threading.Lock()
+datasets_loaded = threading.Event()
+warm_up_lock = threading.Lock()
+warm_up_thread = None
+readiness = {'datasets': False, 'price_history': False, 'predictions': False, 'error': None}
+
+def install_users(data):
+    """
+    Index a freshly loaded users dataset, then publish it with one assignment,
+    so requests never see users_data half-replaced or the index pointing at
+    users that are no longer in it
+    """
+    user_index.rebuild(data['users'])
+    dashboard_metrics.rebuild_users(data['users'])
+    users_data['users'] = data['users']
+
+def load_datasets():
+    """
+    Load the datasets and build their indexes, once. Callers that arrive
+    while another thread is loading wait for it to finish.
+    """
+    if datasets_loaded.is_set():
+        return
+    with startup_lock:
+        if datasets_loaded.is_set():
+            return
+        if storage.name == 'sqlite' and storage.is_empty():
+            storage.import_from(JsonStorage())
+            print(f"Imported JSON data into {storage.path}")
+        catalog_index.publish(storage.load('products'), storage.load('locations'))
+        install_users(storage.load('users'))
+        order_history['orders'] = storage.load('orders')['orders']
+        rebuild_order_indexes()
+        inventory_ledger.load(list(catalog_index.products.values()), list(location_registry.keys))
+        datasets_loaded.set()
+        readiness['datasets'] = True
+
+def warm_up():
+    """
+    Load everything a request may need: datasets, price history (seeding and
+    updating it as init_app_data does), the batch predictions and analytics
+    """
+    try:
+        load_datasets()
+        init_app_data()
+        readiness['price_history'] = True
+        predict_prices_batch()
+        readiness['predictions'] = True
+        get_price_analytics()
+    except Exception as e:
+        readiness['error'] = str(e)
+        print(f"Error warming up: {str(e)}")
+
+def start_warm_up():
+    global warm_up_thread
+    # Not startup_lock: that is held while the datasets load, and /ready must not wait for it
+    with warm_up_lock:
+        if warm_up_thread is None:
+            warm_up_thread = threading.Thread(target=warm_up, daemon=True)
+            warm_up_thread.start()
+
+@app.before_request
+def ensure_started():
+    # Price history and predictions keep warming in the background
+    start_warm_up()
+    if request.endpoint == 'ready':
+        # The probe reports progress instead of waiting for it
+        return
+    load_datasets()
+    start_cart_expiry()
+
+@app.route('/ready')
+def ready():
+    """
+    Readiness probe: 200 once caches are warm, 503 until then
+    """
+    is_ready = readiness['datasets'] and readiness['price_history'] and readiness['predictions']
+    return jsonify(dict(readiness, ready=bool(is_ready))), 200 if is_ready else 503
+
+def loaded_by_cli_command():
+    """
+    True when the app is being imported by a `flask` CLI command other than
+    `flask run`, which must not race a warm-up thread
+    """
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.info_name != 'run'
+
+if app.config['WARM_UP_ON_IMPORT'] and not loaded_by_cli_command():
+    start_warm_up()
+
+# Cross-worker coherence
+STALE_CHECK_INTERVAL = 0.5  # seconds between checks for datasets changed by other workers
+last_stale_check = 0.0
+reload_lock = threading.Lock()
+
+def reload_dataset(name):
+    """
+    Reload one dataset changed by another worker, in place, and rebuild what depends on it
+    """
+    if name == 'orders':
+        for order in storage.refresh_orders():
+            index_order(order)
+    elif name == 'price_history':
+        if price_history_store.loaded:
+            storage.refresh_price_history(price_history_store)
+            prediction_cache.invalidate()
+    elif name == 'products':
+        catalog_index.publish(products_data=storage.load(name))
+    elif name == 'locations':
+        catalog_index.publish(locations_data=storage.load(name))
+    else:
+        install_users(storage.load(name))
+
+@app.before_request
+def refresh_stale_datasets():
+    global last_stale_check
+    if not datasets_loaded.is_set():
+        # Only /ready gets here before the datasets are loaded; there is nothing to refresh yet
+        return
+    now = time.monotonic()
+    if now - last_stale_check < STALE_CHECK_INTERVAL:
+        return
+    # Only one thread checks; the others carry on with the current data
+    if not reload_lock.acquire(blocking=False):
+        return
+    try:
+        last_stale_check = now
+        for name in storage.stale_datasets():
+            reload_dataset(name)
+    finally:
+        reload_lock.release()
 
 # Routes
 @app.route('/')
 def index():
     location = get_location_info()
     
-    # Apply location-based pricing to products
-    categories = []
-    for category in products_data['categories']:
-        category_copy = category.copy()
-        products_copy = []
-        
-        for product in category['products']:
-            product_copy = product.copy()
-            product_copy['original_price'] = product['price']
-            product_copy['price'] = calculate_price_with_location(product['price'], location)
-            products_copy.append(product_copy)
-            
-        category_copy['products'] = products_copy
-        categories.append(category_copy)
+    # Catalog with location-based pricing applied
+    categories = priced_catalog.get(location)['categories']
     
     return render_template('index.html', 
                           categories=categories, 
@@ -332,23 +3951,13 @@ def index():
 
 @app.route('/category/<int:category_id>')
 def category(category_id):
-    category = get_category_by_id(category_id)
     location = get_location_info()
     
-    if not category:
-        return redirect(url_for('index'))
-    
-    # Apply location-based pricing to products
-    category_copy = category.copy()
-    products_copy = []
+    # Category with location-based pricing applied
+    category_copy = priced_catalog.get(location)['categories_by_id'].get(category_id)
     
-    for product in category['products']:
-        product_copy = product.copy()
-        product_copy['original_price'] = product['price']
-        product_copy['price'] = calculate_price_with_location(product['price'], location)
-        products_copy.append(product_copy)
-        
-    category_copy['products'] = products_copy
+    if not category_copy:
+        return redirect(url_for('index'))
     
     return render_template('category.html', 
                           category=category_copy, 
@@ -385,7 +3994,7 @@ def location_selection():
     current_district_id = session.get('district_id', 101)
     
     return render_template('location.html', 
-                          locations=locations_data,
+                          locations=catalog_index.snapshot.locations_data,
                           current_city_id=current_city_id,
                           current_district_id=current_district_id,
                           location=get_location_info(),
@@ -466,7 +4075,7 @@ def register():
         
         # Create new user
         new_user = {
-            'id': max(u['id'] for u in users_data['users']) + 1,
+            'id': id_allocator.next_id('users'),
             'first_name': first_name,
             'last_name': last_name,
             'email': email,
@@ -481,6 +4090,8 @@ def register():
         }
         
         users_data['users'].append(new_user)
+        user_index.add(new_user)
+        dashboard_metrics.add_user(new_user)
         save_data(users_data, 'users.json')
         
         # Log in the new user
@@ -504,25 +4115,15 @@ def add_to_cart():
     product_id = int(request.form.get('product_id'))
     quantity = int(request.form.get('quantity', 1))
     
-    if 'cart' not in session:
-        session['cart'] = []
-    
-    cart = session['cart']
+    if quantity <= 0:
+        flash('Quantity must be at least 1', 'error')
+        return redirect(request.referrer or url_for('index'))
     
-    # Check if product already in cart
-    for item in cart:
-        if item['product_id'] == product_id:
-            item['quantity'] += quantity
-            session['cart'] = cart
-            return redirect(request.referrer or url_for('index'))
+    # Add to the quantity already in the cart, if any
+    def add(items):
+        items[product_id] = items.get(product_id, 0) + quantity
     
-    # Add new item to cart
-    cart.append({
-        'product_id': product_id,
-        'quantity': quantity
-    })
-    
-    session['cart'] = cart
+    cart_store.update(get_cart_id(create=True), add)
     return redirect(request.referrer or url_for('index'))
 
 @app.route('/update-cart', methods=['POST'])
@@ -538,31 +4139,19 @@ def update_cart():
     if quantity < 0:
         quantity = 0  # Ensure quantity is not negative
     
-    if 'cart' not in session:
+    cart_id = get_cart_id()
+    if not cart_id:
         return redirect(url_for('cart'))
     
-    cart = session['cart']
-    
-    if quantity == 0:
-        # Remove item from cart
-        cart = [item for item in cart if item['product_id'] != product_id]
-    else:
-        # Update quantity
-        item_found = False
-        for item in cart:
-            if item['product_id'] == product_id:
-                item['quantity'] = quantity
-                item_found = True
-                break
-        
-        # If item not found but quantity > 0, add it
-        if not item_found and quantity > 0:
-            cart.append({
-                'product_id': product_id,
-                'quantity': quantity
-            })
+    def update(items):
+        if quantity == 0:
+            # Remove item from cart
+            items.pop(product_id, None)
+        else:
+            # Update quantity, adding the item if it is not in the cart
+            items[product_id] = quantity
     
-    session['cart'] = cart
+    cart_store.update(cart_id, update)
     return redirect(url_for('cart'))
 
 @app.route('/cart')
@@ -572,27 +4161,26 @@ def cart():
     total = 0
     original_total = 0
     
-    if 'cart' in session:
-        for item in session['cart']:
-            product = get_product_by_id(item['product_id'])
-            if product:
-                price = calculate_price_with_location(product['price'], location)
-                subtotal = price * item['quantity']
-                original = product['price'] * item['quantity']
-                
-                cart_items.append({
-                    'id': product['id'],
-                    'name': product['name'],
-                    'image': product['image'],
-                    'unit': product['unit'],
-                    'price': price,
-                    'quantity': item['quantity'],
-                    'subtotal': subtotal,
-                    'original': original
-                })
-                
-                total += subtotal
-                original_total += original
+    for product_id, quantity in get_cart().items():
+        product = get_product_by_id(product_id)
+        if product:
+            price = calculate_price_with_location(product['price'], location)
+            subtotal = price * quantity
+            original = product['price'] * quantity
+            
+            cart_items.append({
+                'id': product['id'],
+                'name': product['name'],
+                'image': product['image'],
+                'unit': product['unit'],
+                'price': price,
+                'quantity': quantity,
+                'subtotal': subtotal,
+                'original': original
+            })
+            
+            total += subtotal
+            original_total += original
     
     return render_template('cart.html', 
                           cart_items=cart_items, 
@@ -604,7 +4192,9 @@ def cart():
 
 @app.route('/clear-cart')
 def clear_cart():
-    session.pop('cart', None)
+    cart_id = get_cart_id()
+    if cart_id:
+        cart_store.update(cart_id, lambda items: items.clear())
     return redirect(url_for('cart'))
 
 @app.route('/checkout', methods=['GET', 'POST'])
@@ -617,7 +4207,8 @@ def checkout():
         flash('Please select a delivery location', 'error')
         return redirect(url_for('location_selection', redirect_url=url_for('checkout')))
     
-    if 'cart' not in session or not session['cart']:
+    cart = get_cart()
+    if not cart:
         flash('Your cart is empty', 'error')
         return redirect(url_for('cart'))
     
@@ -625,11 +4216,11 @@ def checkout():
     cart_items = []
     total = 0
     
-    for item in session['cart']:
-        product = get_product_by_id(item['product_id'])
+    for product_id, quantity in cart.items():
+        product = get_product_by_id(product_id)
         if product:
             price = calculate_price_with_location(product['price'], location)
-            subtotal = price * item['quantity']
+            subtotal = price * quantity
             
             cart_items.append({
                 'id': product['id'],
@@ -637,15 +4228,30 @@ def checkout():
                 'image': product['image'],
                 'unit': product['unit'],
                 'price': price,
-                'quantity': item['quantity'],
+                'quantity': quantity,
                 'subtotal': subtotal
             })
             
             total += subtotal
     
+    if not cart_items:
+        flash('Your cart is empty', 'error')
+        return redirect(url_for('cart'))
+    
     if request.method == 'POST':
+        # Hold the stock before recording the order
+        try:
+            reservation = inventory_ledger.reserve(location['id'], [(item['id'], item['quantity']) for item in cart_items])
+        except InsufficientStock as e:
+            product = get_product_by_id(e.product_id)
+            flash(f"Only {e.available} of {product['name']} left in stock", 'error')
+            return redirect(url_for('cart'))
+        except ValueError:
+            flash('Please correct the quantities in your cart', 'error')
+            return redirect(url_for('cart'))
+        
         # Create a new order
-        order_id = max(order['id'] for order in order_history['orders']) + 1 if order_history['orders'] else 1
+        order_id = id_allocator.next_id('orders')
         
         new_order = {
             'id': order_id,
@@ -670,16 +4276,19 @@ def checkout():
                 'quantity': item['quantity'],
                 'subtotal': item['subtotal']
             })
-            
-            # Update inventory (if implemented)
-            # update_inventory(item['id'], location['city']['id'], location['district']['id'], -item['quantity'])
         
-        # Add order to history
+        # Persist the order, then add it to history
+        try:
+            storage.append_order(new_order)
+        except Exception:
+            inventory_ledger.release(reservation)
+            raise
         order_history['orders'].append(new_order)
-        save_data(order_history, 'order_history.json')
+        index_order(new_order)
+        inventory_ledger.commit(reservation)
         
         # Clear cart
-        session.pop('cart', None)
+        cart_store.update(get_cart_id(), lambda items: items.clear())
         
         # Redirect to order confirmation
         flash('Order placed successfully!', 'success')
@@ -694,14 +4303,31 @@ def checkout():
 
 @app.route('/api/cart_count')
 def cart_count():
-    count = 0
-    if 'cart' in session:
-        for item in session['cart']:
-            count += item['quantity']
+    count = sum(get_cart().values())
     
     return jsonify({'count': count})
 
 # Admin routes
+@app.route('/admin/api/prediction_cache_stats')
+@admin_required
+def prediction_cache_stats():
+    return jsonify(prediction_cache.stats())
+
+@app.route('/admin/api/price_history_generation')
+@admin_required
+def price_history_generation_progress():
+    return jsonify(price_history_generation.progress())
+
+@app.route('/admin/api/price_history_aggregates')
+@admin_required
+def price_history_aggregates():
+    product_id = request.args.get('product_id', type=int)
+    location_key = request.args.get('location_key')
+    location_id = location_registry.find_key(location_key) if location_key else None
+    if location_key and location_id is None:
+        return jsonify([])
+    return jsonify(price_history_store.aggregate_entries(product_id=product_id, location_id=location_id))
+
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     if request.method == 'POST':
@@ -712,9 +4338,9 @@ def admin_login():
         password_hash = hashlib.md5(password.encode()).hexdigest()
         
         # Find admin user
-        admin_user = next((u for u in users_data['users'] if u['email'] == username and u['is_admin']), None)
+        admin_user = get_user_by_email(username)
         
-        if admin_user and admin_user['password_hash'] == password_hash:
+        if admin_user and admin_user['is_admin'] and admin_user['password_hash'] == password_hash:
             session['user_id'] = admin_user['id']
             return redirect(url_for('admin_dashboard'))
         
@@ -734,19 +4360,13 @@ def admin_logout():
 def admin_dashboard():
     admin_user = get_user_by_id(session['user_id'])
     
-    # Mock statistics for dashboard
-    stats = {
-        'total_orders': len(order_history['orders']),
-        'orders_today': random.randint(5, 20),
-        'total_revenue': sum(order['total'] for order in order_history['orders']),
-        'revenue_today': random.randint(1000, 5000),
-        'total_users': len(users_data['users']),
-        'new_users_today': random.randint(1, 10)
-    }
+    today = datetime.now().strftime('%Y-%m-%d')
+    stats = dashboard_metrics.stats(today)
+    stats['total_users'] = len(users_data['users'])
     
     # Recent orders
     recent_orders = []
-    for order in sorted(order_history['orders'], key=lambda x: x['date'], reverse=True)[:5]:
+    for order in dashboard_metrics.recent_orders():
         user = get_user_by_id(order['user_id'])
         recent_orders.append({
             'id': order['id'],
@@ -755,22 +4375,18 @@ def admin_dashboard():
             'amount': order['total']
         })
     
-    # Price predictions
+    # Price predictions with the largest expected moves
     price_predictions = []
-    for i in range(5):
-        product = get_product_by_id(random.choice([101, 102, 201, 301]))
-        city = get_city_by_id(random.choice([1, 2, 3]))
-        district = random.choice(city['districts'])
-        location = {'city': city, 'district': district}
-        
-        predicted_price = predict_price(product['id'], location)
-        current_price = calculate_price_with_location(product['price'], location)
+    predictions = predict_prices_batch()
+    for product_id, location_id in predictions.largest_changes(5):
+        product = get_product_by_id(product_id)
+        prediction = predictions.get(product_id, location_id)
         
         price_predictions.append({
             'name': product['name'],
-            'location': f"{city['name']}, {district['name']}",
-            'predicted_price': predicted_price or current_price,
-            'current_price': current_price
+            'location': location_registry.name(location_id),
+            'predicted_price': prediction['predicted_price'],
+            'current_price': prediction['current_price']
         })
     
     return render_template('admin_dashboard.html',
@@ -826,21 +4442,15 @@ def profile():
     return render_template('profile.html', 
                           user=user,
                           location=get_location_info(),
-                          locations=locations_data,
+                          locations=catalog_index.snapshot.locations_data,
                           user_logged_in=True)
 
 # Add this function to manage inventory
 def update_inventory(product_id, city_id, district_id, quantity):
-    for category in products_data['categories']:
-        for product in category['products']:
-            if product['id'] == product_id:
-                if 'inventory' not in product:
-                    product['inventory'] = {}
-                key = f"{city_id}_{district_id}"
-                product['inventory'][key] = quantity
-                save_data(products_data, 'products.json')
-                return True
-    return False
+    if not get_product_by_id(product_id) or not get_district_by_id(city_id, district_id):
+        return False
+    inventory_ledger.set_quantity(product_id, location_registry.intern(city_id, district_id), quantity)
+    return True
 
 # Modify the admin_products route to include inventory management
 @app.route('/admin/products', methods=['GET', 'POST'])
@@ -855,37 +4465,21 @@ def admin_products():
         
         if action == 'add_product':
             try:
-                # Get the highest existing product ID and add 1
-                max_id = 0
-                for category in products_data['categories']:
-                    for product in category['products']:
-                        if product['id'] > max_id:
-                            max_id = product['id']
-                
                 new_product = {
-                    'id': max_id + 1,
+                    'id': id_allocator.next_id('products'),
                     'name': request.form.get('name'),
                     'price': float(request.form.get('price')),
                     'unit': request.form.get('unit'),
                     'image': request.form.get('image', '/placeholder.svg?height=200&width=200'),
-                    'description': request.form.get('description', ''),
-                    'inventory': {}  # Initialize empty inventory
+                    'description': request.form.get('description', '')
                 }
                 
                 category_id = int(request.form.get('category_id'))
-                category_found = False
-                
-                for category in products_data['categories']:
-                    if category['id'] == category_id:
-                        category['products'].append(new_product)
-                        category_found = True
-                        break
                 
-                if not category_found:
+                if not catalog_index.add_product(category_id, new_product):
                     message = f"Category ID {category_id} not found"
                     message_type = "error"
                 else:
-                    save_data(products_data, 'products.json')
                     message = 'Product added successfully'
                     message_type = 'success'
             except Exception as e:
@@ -902,53 +4496,16 @@ def admin_products():
                 product_description = request.form.get('description', '')
                 category_id = int(request.form.get('category_id'))
                 
-                # Find the product to update
-                product_found = False
-                old_category_id = None
-                
-                # First find the product and its current category
-                for category in products_data['categories']:
-                    for i, product in enumerate(category['products']):
-                        if product['id'] == product_id:
-                            old_category_id = category['id']
-                            if old_category_id == category_id:
-                                # Update in the same category
-                                product['name'] = product_name
-                                product['price'] = product_price
-                                product['unit'] = product_unit
-                                product['image'] = product_image
-                                product['description'] = product_description
-                                product_found = True
-                            else:
-                                # Remove from current category to move to the new one
-                                removed_product = category['products'].pop(i)
-                                # Preserve inventory data
-                                if 'inventory' in removed_product:
-                                    removed_product['inventory'] = removed_product['inventory']
-                            break
-                    if old_category_id:
-                        break
-                
-                # If product is being moved to a different category, add it to the new one
-                if old_category_id != category_id and old_category_id is not None:
-                    for category in products_data['categories']:
-                        if category['id'] == category_id:
-                            # Create updated product with the same ID
-                            updated_product = {
-                                'id': product_id,
-                                'name': product_name,
-                                'price': product_price,
-                                'unit': product_unit,
-                                'image': product_image,
-                                'description': product_description,
-                                'inventory': removed_product.get('inventory', {})
-                            }
-                            category['products'].append(updated_product)
-                            product_found = True
-                            break
+                # Update in place or move to the new category, preserving inventory data
+                product_found = catalog_index.update_product(product_id, category_id, {
+                    'name': product_name,
+                    'price': product_price,
+                    'unit': product_unit,
+                    'image': product_image,
+                    'description': product_description
+                })
                 
                 if product_found:
-                    save_data(products_data, 'products.json')
                     message = 'Product updated successfully'
                     message_type = 'success'
                 else:
@@ -977,18 +4534,14 @@ def admin_products():
         
         elif action == 'add_category':
             try:
-                # Get the highest existing category ID and add 1
-                max_id = max(category['id'] for category in products_data['categories'])
-                
                 new_category = {
-                    'id': max_id + 1,
+                    'id': id_allocator.next_id('categories'),
                     'name': request.form.get('name'),
                     'image': request.form.get('image', '/placeholder.svg?height=80&width=80'),
                     'products': []
                 }
                 
-                products_data['categories'].append(new_category)
-                save_data(products_data, 'products.json')
+                catalog_index.add_category(new_category)
                 message = 'Category added successfully'
                 message_type = 'success'
             except Exception as e:
@@ -996,27 +4549,28 @@ def admin_products():
                 message_type = "error"
     
     # Prepare products list with categories and inventory
+    snapshot = catalog_index.snapshot
     products = []
-    for category in products_data['categories']:
+    for category in snapshot.products_data['categories']:
         for product in category['products']:
             # Calculate predicted price range
             min_price = round(product['price'] * 0.8)
             max_price = round(product['price'] * 1.2)
             
-            inventory = product.get('inventory', {})
+            inventory = inventory_ledger.stock(product['id'])
             
             # Format inventory for display
             inventory_display = []
-            for key, value in inventory.items():
-                city_id, district_id = map(int, key.split('_'))
-                city = get_city_by_id(city_id)
-                district = get_district_by_id(city_id, district_id)
+            for location_id, (value, reserved) in inventory.items():
+                city_id, district_id = location_registry.pairs[location_id]
+                city, district = location_registry.location(location_id)
                 if city and district:
                     inventory_display.append({
                         'location': f"{city['name']}, {district['name']}",
                         'city_id': city_id,
                         'district_id': district_id,
-                        'quantity': value
+                        'quantity': value,
+                        'reserved': reserved
                     })
             
             products.append({
@@ -1035,7 +4589,7 @@ def admin_products():
     
     # Get all cities and districts for the inventory form
     locations = []
-    for city in locations_data['cities']:
+    for city in snapshot.locations_data['cities']:
         for district in city['districts']:
             locations.append({
                 'city_id': city['id'],
@@ -1046,9 +4600,9 @@ def admin_products():
     return render_template('admin_products.html',
                           admin_user=admin_user,
                           products=products,
-                          categories=products_data['categories'],
+                          categories=snapshot.products_data['categories'],
                           locations=locations,
-                          locations_data=locations_data,
+                          locations_data=snapshot.locations_data,
                           message=message,
                           message_type=message_type)
 
@@ -1057,27 +4611,14 @@ def admin_products():
 @admin_required
 def delete_product(product_id):
     # First check if the product exists in any orders
-    product_in_orders = False
-    for order in order_history['orders']:
-        for item in order['items']:
-            if item['product_id'] == product_id:
-                product_in_orders = True
-                break
-        if product_in_orders:
-            break
-    
-    if product_in_orders:
+    if product_order_index.order_count(product_id):
         flash('Cannot delete product that exists in order history', 'error')
         return redirect(url_for('admin_products'))
     
     # Now delete the product
-    for category in products_data['categories']:
-        for product in category['products']:
-            if product['id'] == product_id:
-                category['products'].remove(product)
-                save_data(products_data, 'products.json')
-                flash('Product deleted successfully', 'success')
-                return redirect(url_for('admin_products'))
+    if catalog_index.remove_product(product_id):
+        flash('Product deleted successfully', 'success')
+        return redirect(url_for('admin_products'))
     
     flash('Product not found', 'error')
     return redirect(url_for('admin_products'))
@@ -1120,7 +4661,7 @@ def admin_users():
         district = get_district_by_id(user['city_id'], user['district_id'])
         
         # Count orders for this user
-        orders_count = sum(1 for order in order_history['orders'] if order['user_id'] == user['id'])
+        orders_count = user_order_index.count(user['id'])
         
         users.append({
             'id': user['id'],
@@ -1143,77 +4684,62 @@ def admin_users():
 def admin_price_analytics():
     admin_user = get_user_by_id(session['user_id'])
     
-    # Mock statistics for price analytics
-    stats = {
-        'avg_fluctuation': 12.5,
-        'most_volatile_product': 'Fresh Apples',
-        'most_volatile_fluctuation': 18.3,
-        'most_stable_location': 'Mumbai, Dadar',
-        'most_stable_fluctuation': 5.2
-    }
+    category_id = request.args.get('category', type=int)
+    city_id = request.args.get('location', type=int)
     
-    # Mock predictions data
-    predictions = []
-    for i in range(10):
-        product = get_product_by_id(random.choice([101, 102, 201, 301]))
-        category = next(c['name'] for c in products_data['categories'] if product['id'] // 100 == c['id'])
-        city = get_city_by_id(random.choice([1, 2, 3]))
-        district = random.choice(city['districts'])
-        
-        base_price = product['price']
-        predicted_price = round(base_price * (0.8 + random.random() * 0.4))
-        actual_price = round(base_price * district['price_factor'])
-        
-        # Calculate accuracy
-        if predicted_price == 0 or actual_price == 0:
-            accuracy = 0
-        else:
-            accuracy = round(100 - abs(predicted_price - actual_price) / actual_price * 100)
-        
-        predictions.append({
-            'product_name': product['name'],
-            'category': category,
-            'location': f"{city['name']}, {district['name']}",
-            'base_price': base_price,
-            'predicted_price': predicted_price,
-            'actual_price': actual_price,
-            'accuracy': accuracy
-        })
+    analytics = get_price_analytics()
+    snapshot = catalog_index.snapshot
+    accuracy_labels, accuracy_values = analytics.accuracy_chart()
+    location_labels, location_values = analytics.city_chart()
     
     return render_template('admin_price_analytics.html',
                           admin_user=admin_user,
-                          stats=stats,
-                          predictions=predictions,
-                          categories=products_data['categories'],
-                          cities=locations_data['cities'])
+                          stats=analytics.stats(),
+                          predictions=analytics.predictions(category_id, city_id),
+                          category_summary=analytics.category_summary(),
+                          accuracy_labels=accuracy_labels,
+                          accuracy_values=accuracy_values,
+                          location_labels=location_labels,
+                          location_values=location_values,
+                          backtest_days=ANALYTICS_BACKTEST_DAYS,
+                          selected_category=category_id,
+                          selected_city=city_id,
+                          categories=snapshot.products_data['categories'],
+                          cities=snapshot.locations_data['cities'])
 
 @app.route('/orders')
 @login_required
 def orders():
     user = get_user_by_id(session['user_id'])
     
-    # Get orders for the current user
+    # Get a page of the current user's orders, newest first
+    orders_count = user_order_index.count(user['id'])
+    page_count = max(1, -(-orders_count // ORDERS_PAGE_SIZE))
+    page = min(max(request.args.get('page', 1, type=int), 1), page_count)
+    
     user_orders = []
-    for order in sorted(order_history['orders'], key=lambda x: x['date'], reverse=True):
-        if order['user_id'] == user['id']:
-            # Get location info
-            city = get_city_by_id(order['location']['city_id'])
-            district = get_district_by_id(order['location']['city_id'], order['location']['district_id'])
-            
-            # Format order for display
-            order_info = {
-                'id': order['id'],
-                'date': order['date'],
-                'location': f"{city['name']}, {district['name']}",
-                'items_count': len(order['items']),
-                'total': order['total'],
-                'status': order.get('status', 'pending'),
-                'items': order['items']
-            }
-            user_orders.append(order_info)
+    for order in user_order_index.page(user['id'], page):
+        # Get location info
+        city = get_city_by_id(order['location']['city_id'])
+        district = get_district_by_id(order['location']['city_id'], order['location']['district_id'])
+        
+        # Format order for display
+        order_info = {
+            'id': order['id'],
+            'date': order['date'],
+            'location': f"{city['name']}, {district['name']}",
+            'items_count': len(order['items']),
+            'total': order['total'],
+            'status': order.get('status', 'pending'),
+            'items': order['items']
+        }
+        user_orders.append(order_info)
     
     return render_template('orders.html', 
                           orders=user_orders,
+                          page=page,
+                          page_count=page_count,
+                          orders_count=orders_count,
                           location=get_location_info(),
                           user_logged_in=True,
                           user=user)
@@ -1296,12 +4822,6 @@ def admin_manage_admins():
                         message = "A user with this email already exists"
                         message_type = "error"
                     else:
-                        # Get highest user ID
-                        max_id = 0
-                        for user in users_data['users']:
-                            if user['id'] > max_id:
-                                max_id = user['id']
-                        
                         # Set default city/district if needed
                         default_city_id = 1  # Assuming city ID 1 exists
                         default_district_id = 1  # Assuming district ID 1 exists
@@ -1310,7 +4830,7 @@ def admin_manage_admins():
                         password_hash = hashlib.md5(password.encode()).hexdigest()
                         
                         new_user = {
-                            'id': max_id + 1,
+                            'id': id_allocator.next_id('users'),
                             'first_name': first_name,
                             'last_name': last_name,
                             'email': email,
@@ -1325,6 +4845,8 @@ def admin_manage_admins():
                         }
                         
                         users_data['users'].append(new_user)
+                        user_index.add(new_user)
+                        dashboard_metrics.add_user(new_user)
                         
                         # Save updated users
                         save_data(users_data, 'users.json')
@@ -1340,7 +4862,7 @@ def admin_manage_admins():
     users = []
     for user in users_data['users']:
         # Count orders for this user
-        orders_count = sum(1 for order in order_history['orders'] if order['user_id'] == user['id'])
+        orders_count = user_order_index.count(user['id'])
         
         # Get city and district
         city = get_city_by_id(user['city_id'])
@@ -1367,6 +4889,8 @@ def admin_manage_admins():
                           message=message,
                           message_type=message_type)
 
+PRICE_HISTORY_PAGE_SIZE = 500  # entries per page of the admin price history table
+
 @app.route('/admin/price-history', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -1380,6 +4904,7 @@ def admin_price_history():
     city_id = request.args.get('city_id', type=int)
     district_id = request.args.get('district_id', type=int)
     days = request.args.get('days', default=10, type=int)
+    cursor = request.args.get('cursor')
     
     if request.method == 'POST':
         action = request.form.get('action')
@@ -1398,40 +4923,18 @@ def admin_price_history():
                     message = "Product not found"
                     message_type = "error"
                 else:
-                    # Load price history
-                    try:
-                        with open('data/price_history.json', 'r') as f:
-                            price_history = json.load(f)
-                    except (FileNotFoundError, json.JSONDecodeError):
-                        price_history = {'history': []}
+                    location_id = location_registry.intern(entry_city_id, entry_district_id)
                     
-                    # Create location key
-                    location_key = f"{entry_city_id}_{entry_district_id}"
-                    
-                    # Check if entry for this date, product, and location already exists
-                    for i, entry in enumerate(price_history['history']):
-                        if (entry['product_id'] == entry_product_id and 
-                            entry['location_key'] == location_key and 
-                            entry['date'] == entry_date):
-                            # Update existing entry
-                            price_history['history'][i]['price'] = entry_price
-                            message = f"Updated price history for {product['name']} on {entry_date}"
-                            message_type = "success"
-                            break
-                    else:
-                        # Add new entry
-                        price_history['history'].append({
-                            'product_id': entry_product_id,
-                            'location_key': location_key,
-                            'date': entry_date,
-                            'price': entry_price
-                        })
+                    # Update the existing entry for this date, product, and location or add a new one
+                    if price_history_store.upsert(entry_product_id, location_id, entry_date, entry_price):
                         message = f"Added new price history for {product['name']} on {entry_date}"
-                        message_type = "success"
+                    else:
+                        message = f"Updated price history for {product['name']} on {entry_date}"
+                    message_type = "success"
+                    prediction_cache.invalidate()
                     
                     # Save updated price history
-                    with open('data/price_history.json', 'w') as f:
-                        json.dump(price_history, f, indent=2)
+                    price_history_store.save()
             
             except Exception as e:
                 message = f"Error adding price entry: {str(e)}"
@@ -1440,64 +4943,57 @@ def admin_price_history():
         elif action == 'regenerate_history':
             try:
                 days_to_generate = int(request.form.get('days_to_generate', 10))
+                seed = request.form.get('seed', type=int)
                 
-                # Delete existing price history file
-                if os.path.exists('data/price_history.json'):
-                    os.remove('data/price_history.json')
-                
-                # Generate new history
-                initialize_price_history()
-                
-                message = f"Successfully regenerated price history for the past {days_to_generate} days"
-                message_type = "success"
+                # Generate new history in the background; the page polls its progress
+                if price_history_generation.start(days_to_generate, seed):
+                    message = f"Regenerating price history for the past {days_to_generate} days in the background"
+                    message_type = "success"
+                else:
+                    message = "Price history is already being regenerated"
+                    message_type = "error"
             
             except Exception as e:
                 message = f"Error regenerating price history: {str(e)}"
                 message_type = "error"
     
-    # Load price history
-    try:
-        with open('data/price_history.json', 'r') as f:
-            price_history = json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        price_history = {'history': []}
-    
-    # Filter price history based on parameters
-    filtered_history = price_history['history']
-    
-    if product_id:
-        filtered_history = [entry for entry in filtered_history if entry['product_id'] == product_id]
-    
-    if city_id and district_id:
-        location_key = f"{city_id}_{district_id}"
-        filtered_history = [entry for entry in filtered_history if entry['location_key'] == location_key]
-    
-    # Limit to the specified number of days
+    # One page of price history matching the filters, limited to the specified number of days
+    location_id = location_registry.find(city_id, district_id) if city_id and district_id else None
     cutoff_date = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
-    filtered_history = [entry for entry in filtered_history if entry['date'] >= cutoff_date]
-    
-    # Sort by date (newest first)
-    filtered_history.sort(key=lambda x: (x['product_id'], x['location_key'], x['date']), reverse=True)
+    page_cursor = None
+    if cursor:
+        try:
+            cursor_product_id, cursor_location_key, cursor_date = cursor.split(':')
+            date.fromisoformat(cursor_date)
+            page_cursor = (int(cursor_product_id), location_registry.find_key(cursor_location_key), cursor_date)
+        except ValueError:
+            page_cursor = None
+        if page_cursor and page_cursor[1] is None:
+            page_cursor = None
+    if city_id and district_id and location_id is None:
+        page_history, next_cursor = [], None
+    else:
+        page_history, next_cursor = price_history_store.page(product_id=product_id or None,
+                                                             location_id=location_id,
+                                                             since=cutoff_date,
+                                                             cursor=page_cursor,
+                                                             limit=PRICE_HISTORY_PAGE_SIZE)
     
     # Get product and location details for display
     display_history = []
-    for entry in filtered_history[:500]:  # Limit to 500 entries for performance
+    for entry in page_history:
         product = get_product_by_id(entry['product_id'])
-        location_key_parts = entry['location_key'].split('_')
-        city_id, district_id = int(location_key_parts[0]), int(location_key_parts[1])
-        
-        city = get_city_by_id(city_id)
-        district = get_district_by_id(city_id, district_id)
+        entry_city_id, entry_district_id = location_registry.pairs[entry['location_id']]
+        city, district = location_registry.location(entry['location_id'])
         
         if product and city and district:
             display_history.append({
                 'product_id': entry['product_id'],
                 'product_name': product['name'],
-                'category': next((c['name'] for c in products_data['categories'] 
-                                if product['id'] // 100 == c['id']), "Unknown"),
+                'category': get_category_for_product(product['id'])['name'],
                 'location': f"{city['name']}, {district['name']}",
-                'city_id': city_id,
-                'district_id': district_id,
+                'city_id': entry_city_id,
+                'district_id': entry_district_id,
                 'date': entry['date'],
                 'price': entry['price'],
                 'base_price': product['price'],
@@ -1509,19 +5005,17 @@ def admin_price_history():
     stats = {}
     if display_history:
         # Count total entries
-        stats['total_entries'] = len(price_history['history'])
+        stats['total_entries'] = len(price_history_store)
+        stats['aggregate_periods'] = len(price_history_store.aggregates)
         stats['displayed_entries'] = len(display_history)
         
         # Count unique products and locations
-        unique_products = len(set(entry['product_id'] for entry in price_history['history']))
-        unique_locations = len(set(entry['location_key'] for entry in price_history['history']))
+        unique_products, unique_locations = price_history_store.unique_counts()
         stats['unique_products'] = unique_products
         stats['unique_locations'] = unique_locations
         
         # Get date range
-        all_dates = [entry['date'] for entry in price_history['history']]
-        stats['oldest_date'] = min(all_dates)
-        stats['newest_date'] = max(all_dates)
+        stats['oldest_date'], stats['newest_date'] = price_history_store.date_range()
         
         # Avg price deviation from expected
         deviations = []
@@ -1537,19 +5031,67 @@ def admin_price_history():
                           admin_user=admin_user,
                           price_history=display_history,
                           products=get_all_products(),
-                          locations=locations_data,
+                          locations=catalog_index.snapshot.locations_data,
                           stats=stats,
                           filter_product_id=product_id,
                           filter_city_id=city_id,
                           filter_district_id=district_id,
                           filter_days=days,
+                          cursor=cursor,
+                          next_cursor=(f"{next_cursor[0]}:{location_registry.keys[next_cursor[1]]}:{next_cursor[2]}"
+                                       if next_cursor else None),
+                          generation=price_history_generation.progress(),
                           message=message,
                           message_type=message_type)
 
+@app.cli.command('import-json')
+def import_json_command():
+    """
+    Copy the JSON datasets and price history into the SQLite database
+    """
+    target = SqliteStorage(app.config['SQLITE_PATH'])
+    target.import_from(JsonStorage())
+    print(f"Imported JSON data into {app.config['SQLITE_PATH']}")
+
+@app.cli.command('expire-carts')
+def expire_carts_command():
+    """
+    Delete the carts that have not changed for CART_MAX_AGE_DAYS
+    """
+    expire_carts()
+
+@app.cli.command('import-price-history')
+@click.argument('path', default=PRICE_HISTORY_FILE)
+def import_price_history_command(path):
+    """
+    Replace the price history with the entries of a JSON file ({"history": [...]}),
+    and the aggregates if the file has them ({"aggregates": [...]})
+    """
+    load_datasets()
+    with open(path, 'r') as f:
+        data = json.load(f)
+    entries = data['history']
+    price_history_store.replace(entries, data.get('aggregates'))
+    price_history_store.save()
+    flush_data()
+    print(f"Imported {len(entries)} price history entries from {path}")
+
+@app.cli.command('export-price-history')
+@click.argument('path', default='data/price_history_export.json')
+def export_price_history_command(path):
+    """
+    Write the price history to a JSON file in the original {"history": [...]}
+    format, with the weekly and monthly aggregates under "aggregates"
+    """
+    load_datasets()
+    entries = price_history_store.entries()
+    write_json_atomic({'history': entries, 'aggregates': price_history_store.aggregate_entries()}, path)
+    print(f"Exported {len(entries)} price history entries to {path}")
+
 # Helper function to get all products for dropdowns
 def get_all_products():
     all_products = []
-    for category in products_data['categories']:
+    for category in catalog_index.snapshot.products_data['categories']:
         for product in category['products']:
             all_products.append({
                 'id': product['id'],
@@ -0,0 +1,40 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py reads the catalog from the parent of the working directory and keeps
+# everything else under it, so the tests run against a scratch copy of the data
+workspace = tempfile.mkdtemp(prefix='dynamic-pricing-tests-')
+work_dir = os.path.join(workspace, 'app')
+os.makedirs(os.path.join(work_dir, 'data'))
+for name in ('products.json', 'locations.json'):
+    shutil.copy(os.path.join(ROOT, name), workspace)
+for name in ('users.json', 'order_history.json'):
+    shutil.copy(os.path.join(ROOT, name), work_dir)
+shutil.copy(os.path.join(ROOT, 'data', 'price_history.json'), os.path.join(work_dir, 'data'))
+os.chdir(work_dir)
+
+os.environ['STORAGE_BACKEND'] = 'json'
+os.environ['WARM_UP_ON_IMPORT'] = '0'
+sys.path.insert(0, ROOT)
+
+@pytest.fixture(scope='session', autouse=True)
+def scratch_workspace():
+    yield work_dir
+    import app
+    app.flush_data()
+    shutil.rmtree(workspace, ignore_errors=True)
+
+@pytest.fixture(scope='session')
+def datasets():
+    """
+    The app with its datasets loaded and indexed
+    """
+    import app
+    app.load_datasets()
+    return app
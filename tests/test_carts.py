@@ -0,0 +1,68 @@
+import os
+import secrets
+import time
+
+import pytest
+
+import app
+
+def new_cart_id():
+    return secrets.token_hex(16)
+
+def add(product_id, quantity):
+    def change(items):
+        items[product_id] = items.get(product_id, 0) + quantity
+    return change
+
+def backdate(cart_id, days):
+    stamp = time.time() - days * 86400
+    os.utime(os.path.join(app.CARTS_DIR, f"{cart_id}.json"), (stamp, stamp))
+
+def test_carts_are_cached_until_they_change():
+    store = app.CartStore(4)
+    cart_id = new_cart_id()
+    store.update(cart_id, add(101, 1))
+    items = store.get(cart_id)
+    assert items == {101: 1}
+    assert store.get(cart_id) is items
+
+    # Written through another worker's store
+    app.CartStore(4).update(cart_id, add(101, 2))
+    assert store.get(cart_id) == {101: 3}
+
+def test_least_recently_used_carts_are_evicted():
+    store = app.CartStore(2)
+    cart_ids = [new_cart_id() for _ in range(3)]
+    for cart_id in cart_ids:
+        store.update(cart_id, add(101, 1))
+    assert list(store.carts) == cart_ids[1:]
+
+def test_abandoned_carts_expire():
+    store = app.CartStore(4)
+    abandoned, active = new_cart_id(), new_cart_id()
+    store.update(abandoned, add(101, 1))
+    store.update(active, add(102, 1))
+    store.get(abandoned)
+    backdate(abandoned, app.app.config['CART_MAX_AGE_DAYS'] + 1)
+
+    app.expire_carts()
+    assert app.storage.load_cart(abandoned) == (None, {})
+    assert store.get(abandoned) == {}
+    assert store.get(active) == {102: 1}
+
+    # A cart recreated under the same id starts empty
+    store.update(abandoned, add(103, 1))
+    assert store.get(abandoned) == {103: 1}
+
+def test_carts_changed_recently_are_kept():
+    cart_id = new_cart_id()
+    app.cart_store.update(cart_id, add(101, 1))
+    backdate(cart_id, app.app.config['CART_MAX_AGE_DAYS'] - 1)
+
+    app.expire_carts()
+    assert app.storage.load_cart(cart_id)[1] == {101: 1}
+
+@pytest.mark.parametrize('cart_id', ['../users', 'ABC', '0' * 31, None])
+def test_invalid_cart_ids_are_rejected(cart_id):
+    with pytest.raises(ValueError):
+        app.storage.load_cart(cart_id)
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+import app
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / 'inventory.bin'), str(tmp_path / 'inventory.json')
+
+@pytest.fixture
+def ledger(paths):
+    ledger = app.InventoryLedger(*paths)
+    ledger.load([{'id': 101, 'inventory': {'1_101': 5}}, {'id': 102, 'inventory': {'1_101': 1}}, {'id': 103}],
+                ['1_101', '2_201'])
+    return ledger
+
+@pytest.fixture
+def location():
+    return app.location_registry.id_for_key('1_101')
+
+def test_reserve_then_commit_sells_the_stock(ledger, location):
+    reservation = ledger.reserve(location, [(101, 2)])
+    assert ledger.stock(101) == {location: (5, 2)}
+
+    ledger.commit(reservation)
+    assert ledger.stock(101) == {location: (3, 0)}
+
+def test_release_returns_the_stock(ledger, location):
+    reservation = ledger.reserve(location, [(101, 2), (101, 1)])
+    assert ledger.stock(101) == {location: (5, 3)}
+
+    ledger.release(reservation)
+    assert ledger.stock(101) == {location: (5, 0)}
+
+def test_reservations_are_all_or_none(ledger, location):
+    with pytest.raises(app.InsufficientStock) as error:
+        ledger.reserve(location, [(101, 2), (102, 2)])
+    assert error.value.product_id == 102
+    assert error.value.available == 1
+    assert ledger.stock(101) == {location: (5, 0)}
+
+    # Reserved stock is not available to the next reservation
+    ledger.reserve(location, [(101, 4)])
+    with pytest.raises(app.InsufficientStock):
+        ledger.reserve(location, [(101, 2)])
+
+def test_untracked_stock_is_unlimited(ledger, location):
+    reservation = ledger.reserve(location, [(103, 1000), (999, 1)])
+    ledger.commit(reservation)
+    assert ledger.stock(103) == {}
+
+@pytest.mark.parametrize('quantity', [0, -3])
+def test_non_positive_quantities_are_rejected(ledger, location, quantity):
+    with pytest.raises(ValueError):
+        ledger.reserve(location, [(101, quantity)])
+    assert ledger.stock(101) == {location: (5, 0)}
+
+def test_negative_stock_cannot_be_set(ledger, location):
+    with pytest.raises(ValueError):
+        ledger.set_quantity(101, location, -1)
+
+def test_ledger_grows_for_new_products_and_locations(ledger, paths, location):
+    new_location = app.location_registry.intern(3, 301)
+    ledger.set_quantity(104, new_location, 7)
+    ledger.flush()
+
+    reopened = app.InventoryLedger(*paths)
+    reopened.load([], [])
+    assert reopened.stock(104) == {new_location: (7, 0)}
+    assert reopened.stock(101) == {location: (5, 0)}
+
+def test_stale_reservations_are_released_on_load(ledger, paths, location):
+    ledger.reserve(location, [(101, 2)])
+    ledger.reserve(location, [(102, 1)])
+    # Left behind by a worker that stopped long ago
+    ledger.cells[2][ledger._cell(101, location)] -= app.RESERVATION_TIMEOUT + 1
+    ledger.flush()
+
+    reopened = app.InventoryLedger(*paths)
+    reopened.load([], [])
+    assert reopened.stock(101) == {location: (5, 0)}
+    assert reopened.stock(102) == {location: (1, 1)}
+
+def test_interrupted_grow_keeps_a_consistent_shape(ledger, paths, location, monkeypatch):
+    write_bytes_atomic = app.write_bytes_atomic
+
+    def crash_on_matrices(contents, filepath):
+        if filepath == ledger.path:
+            raise SystemExit('crash')
+        write_bytes_atomic(contents, filepath)
+
+    monkeypatch.setattr(app, 'write_bytes_atomic', crash_on_matrices)
+    with pytest.raises(SystemExit):
+        ledger.set_quantity(104, location, 7)
+    monkeypatch.setattr(app, 'write_bytes_atomic', write_bytes_atomic)
+
+    reopened = app.InventoryLedger(*paths)
+    reopened.load([], [])
+    assert not os.path.exists(f"{ledger.axes_path}.new")
+    assert reopened.stock(104) == {}
+    assert reopened.stock(101) == {location: (5, 0)}
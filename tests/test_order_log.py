@@ -0,0 +1,90 @@
+import json
+import os
+
+import app
+
+def write_snapshot(tmp_path, orders):
+    (tmp_path / 'order_history.json').write_text(json.dumps({'orders': orders}))
+
+def open_log(tmp_path):
+    log = app.OrderLog(str(tmp_path / 'order_history.json'), str(tmp_path / 'order_history.log'))
+    log.load()
+    return log
+
+def order_ids(orders):
+    return [order['id'] for order in orders]
+
+def test_appended_orders_are_replayed_on_load(tmp_path):
+    write_snapshot(tmp_path, [{'id': 1}])
+    log = open_log(tmp_path)
+    log.append({'id': 2})
+    log.append({'id': 3})
+    log.sync()
+
+    assert order_ids(open_log(tmp_path).data['orders']) == [1, 2, 3]
+    # Appends leave the snapshot alone
+    assert order_ids(json.loads((tmp_path / 'order_history.json').read_text())['orders']) == [1]
+
+def test_torn_last_line_is_cut_off(tmp_path):
+    write_snapshot(tmp_path, [])
+    log = open_log(tmp_path)
+    log.append({'id': 1})
+    log.sync()
+    with open(tmp_path / 'order_history.log', 'a') as f:
+        f.write('{"id": 2, "tot')
+
+    log = open_log(tmp_path)
+    assert order_ids(log.data['orders']) == [1]
+    log.append({'id': 3})
+    log.sync()
+    assert order_ids(open_log(tmp_path).data['orders']) == [1, 3]
+
+def test_log_is_rotated_and_compacted_past_the_size_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'ORDER_LOG_COMPACT_SIZE', 500)
+    write_snapshot(tmp_path, [{'id': 1}])
+    log = open_log(tmp_path)
+    for order_id in range(2, 12):
+        log.append({'id': order_id, 'note': 'x' * 100})
+    assert log.compacting is not None
+    log.compacting.join()
+
+    assert not os.path.exists(log.rotated_path)
+    snapshot = json.loads((tmp_path / 'order_history.json').read_text())
+    logged = [json.loads(line) for line in (tmp_path / 'order_history.log').read_text().splitlines()]
+    # Every order is in exactly one of the snapshot and the new log
+    assert sorted(order_ids(snapshot['orders']) + order_ids(logged)) == list(range(1, 12))
+    assert order_ids(open_log(tmp_path).data['orders']) == list(range(1, 12))
+
+def test_compact_folds_the_log_into_the_snapshot(tmp_path):
+    write_snapshot(tmp_path, [{'id': 1}])
+    log = open_log(tmp_path)
+    log.append({'id': 2})
+    log.compact()
+
+    assert order_ids(json.loads((tmp_path / 'order_history.json').read_text())['orders']) == [1, 2]
+    assert (tmp_path / 'order_history.log').read_text() == ''
+    assert not os.path.exists(log.rotated_path)
+
+def test_interrupted_compaction_is_finished_on_load(tmp_path):
+    write_snapshot(tmp_path, [{'id': 1}])
+    (tmp_path / 'order_history.log.1').write_text(json.dumps({'id': 2}) + '\n' + json.dumps({'id': 1}) + '\n')
+
+    log = open_log(tmp_path)
+    assert order_ids(log.data['orders']) == [1, 2]
+    assert not os.path.exists(log.rotated_path)
+    assert order_ids(json.loads((tmp_path / 'order_history.json').read_text())['orders']) == [1, 2]
+
+def test_refresh_picks_up_orders_from_other_processes(tmp_path):
+    write_snapshot(tmp_path, [])
+    writer = open_log(tmp_path)
+    reader = open_log(tmp_path)
+    writer.append({'id': 1})
+    assert order_ids(reader.refresh()) == [1]
+    assert reader.refresh() == []
+
+    # Orders written before and after a compaction are each picked up once
+    writer.append({'id': 2})
+    writer.compact()
+    writer.append({'id': 3})
+    assert order_ids(reader.refresh()) == [2, 3]
+    assert order_ids(reader.data['orders']) == [1, 2, 3]
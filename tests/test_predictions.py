@@ -0,0 +1,48 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+@pytest.fixture(scope='module')
+def all_locations(datasets):
+    app = datasets
+    return [
+        {'city': city, 'district': district, 'id': app.location_registry.intern(city['id'], district['id'])}
+        for city in app.catalog_index.snapshot.locations_data['cities']
+        for district in city['districts']
+    ]
+
+def assert_batch_matches_scalar(app, locations):
+    batch = app.predict_prices_batch()
+    compared = 0
+    for location in locations:
+        for product_id in list(app.catalog_index.products) + [999999]:
+            assert batch.get(product_id, location['id']) == app.compute_price_prediction(product_id, location)
+            compared += 1
+    return compared
+
+def test_batch_matches_scalar_predictions(datasets, all_locations):
+    assert assert_batch_matches_scalar(datasets, all_locations)
+
+def test_batch_matches_after_history_changes(datasets, all_locations):
+    app = datasets
+    before = app.predict_prices_batch()
+    rng = random.Random(7)
+    products = list(app.catalog_index.products)
+    for _ in range(300):
+        location = rng.choice(all_locations)
+        day = (date(2025, 1, 1) + timedelta(days=rng.randint(0, 60))).isoformat()
+        app.price_history_store.upsert(rng.choice(products), location['id'], day, rng.randint(10, 500))
+    # Rows for a district the catalog does not have
+    app.price_history_store.upsert(products[0], app.location_registry.intern(999, 999), '2025-01-01', 50)
+
+    assert app.predict_prices_batch() is not before
+    assert assert_batch_matches_scalar(app, all_locations)
+    assert app.predict_prices_batch() is app.predict_prices_batch()
+
+def test_predict_price_is_cached_per_history_version(datasets, all_locations):
+    app = datasets
+    location = all_locations[0]
+    product_id = next(iter(app.catalog_index.products))
+    assert app.predict_price(product_id, location) is app.predict_price(product_id, location)
+    assert app.predict_price(product_id, None) is None
@@ -0,0 +1,101 @@
+from datetime import date, timedelta
+
+import pytest
+
+import app
+
+TODAY = date(2025, 6, 30)
+
+def day(days_ago):
+    return (TODAY - timedelta(days=days_ago)).isoformat()
+
+@pytest.fixture
+def store():
+    store = app.PriceHistoryStore()
+    store.install({'history': []})
+    return store
+
+@pytest.fixture
+def locations():
+    return [app.location_registry.intern(1, 101), app.location_registry.intern(2, 201)]
+
+def test_upsert_adds_then_updates(store, locations):
+    assert store.upsert(101, locations[0], day(1), 100) is True
+    assert store.upsert(101, locations[0], day(0), 110) is True
+    assert store.upsert(101, locations[0], day(1), 105) is False
+
+    assert len(store) == 2
+    assert store.series(101, locations[0]) == [(TODAY.toordinal() - 1, 105), (TODAY.toordinal(), 110)]
+    assert store.series(101, locations[0], limit=1) == [(TODAY.toordinal(), 110)]
+    assert store.date_range() == (day(1), day(0))
+
+def test_unique_counts_follow_the_data(store, locations):
+    assert store.unique_counts() == (0, 0)
+    store.upsert(101, locations[0], day(0), 100)
+    store.upsert(102, locations[0], day(0), 100)
+    store.upsert(102, locations[1], day(20), 100)
+    assert store.unique_counts() == (2, 2)
+
+    store.compact(TODAY.toordinal(), 10, 730)
+    assert store.unique_counts() == (2, 1)
+
+def test_pages_are_ordered_and_cursor_resumes(store, locations):
+    for product_id in (101, 102):
+        for location_id in locations:
+            for days_ago in range(3):
+                store.upsert(product_id, location_id, day(days_ago), product_id + days_ago)
+
+    entries, cursor = store.page(limit=100)
+    assert cursor is None
+    assert len(entries) == 12
+    location_keys = [app.location_registry.keys[entry['location_id']] for entry in entries]
+    sort_values = [(entry['product_id'], key, entry['date']) for entry, key in zip(entries, location_keys)]
+    assert sort_values == sorted(sort_values, reverse=True)
+
+    paged, cursor = [], None
+    while True:
+        page, cursor = store.page(cursor=cursor, limit=5)
+        assert len(page) <= 5
+        paged.extend(page)
+        if cursor is None:
+            break
+    assert paged == entries
+
+def test_page_filters(store, locations):
+    for product_id in (101, 102):
+        for location_id in locations:
+            for days_ago in range(3):
+                store.upsert(product_id, location_id, day(days_ago), 100)
+
+    entries, _ = store.page(product_id=102, location_id=locations[1], since=day(1))
+    assert [(entry['product_id'], entry['location_id'], entry['date']) for entry in entries] == [
+        (102, locations[1], day(0)), (102, locations[1], day(1))
+    ]
+
+def test_retention_folds_old_days_into_aggregates(store, locations):
+    for days_ago, price in ((0, 100), (20, 90), (21, 80), (22, 70)):
+        store.upsert(101, locations[0], day(days_ago), price)
+
+    assert store.compact(TODAY.toordinal(), 10, 730) == 3
+    assert len(store) == 1
+    assert store.date_range() == (day(0), day(0))
+    aggregates = store.aggregate_entries()
+    assert {entry['resolution'] for entry in aggregates} == {'weekly'}
+    assert sum(entry['count'] for entry in aggregates) == 3
+    assert sum(entry['sum'] for entry in aggregates) == 240
+    assert min(entry['min'] for entry in aggregates) == 70
+    assert max(entry['max'] for entry in aggregates) == 90
+
+    # Weeks past the weekly window move to their month
+    store.compact(TODAY.toordinal(), 10, 0)
+    aggregates = store.aggregate_entries()
+    assert {entry['resolution'] for entry in aggregates} == {'monthly'}
+    assert sum(entry['count'] for entry in aggregates) == 3
+
+def test_retention_can_be_longer_for_one_product(store, locations):
+    store.upsert(101, locations[0], day(20), 100)
+    store.upsert(102, locations[0], day(20), 100)
+
+    assert store.compact(TODAY.toordinal(), 10, 730, {102: 30}) == 1
+    assert store.series(101, locations[0]) == []
+    assert store.series(102, locations[0]) == [(TODAY.toordinal() - 20, 100)]
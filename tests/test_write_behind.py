@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+
+import app
+
+class Recorder:
+    """
+    Write function that records its calls and fails the first `failures` of them
+    """
+
+    def __init__(self, failures=0, error=OSError('disk full')):
+        self.failures = failures
+        self.error = error
+        self.calls = []
+        self.written = []
+        self.lock = threading.Lock()
+
+    def __call__(self, data, target):
+        with self.lock:
+            self.calls.append(time.monotonic())
+            if self.failures:
+                self.failures -= 1
+                raise self.error
+            self.written.append((target, data))
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def test_saves_of_one_target_are_coalesced():
+    writer = app.WriteBehindWriter(0.2)
+    write = Recorder()
+    for version in range(1, 4):
+        writer.schedule({'version': version}, 'target', write)
+    writer.flush()
+
+    assert write.written == [('target', {'version': 3})]
+    assert not writer.is_pending('target')
+
+def test_targets_are_written_separately():
+    writer = app.WriteBehindWriter(0.2)
+    write = Recorder()
+    writer.schedule({'name': 'a'}, 'a', write)
+    writer.schedule({'name': 'b'}, 'b', write)
+    writer.flush()
+
+    assert sorted(write.written) == [('a', {'name': 'a'}), ('b', {'name': 'b'})]
+
+def test_flush_does_not_wait_for_the_coalescing_delay():
+    writer = app.WriteBehindWriter(60)
+    write = Recorder()
+    writer.schedule({'version': 1}, 'target', write)
+    started = time.monotonic()
+    writer.flush()
+
+    assert write.written == [('target', {'version': 1})]
+    assert time.monotonic() - started < 5
+
+def test_failed_save_is_reported_and_retried(monkeypatch):
+    monkeypatch.setattr(app, 'SAVE_RETRY_DELAY', 0.05)
+    writer = app.WriteBehindWriter(0)
+    write = Recorder(failures=2)
+    writer.schedule({'version': 1}, 'target', write)
+    with pytest.raises(app.SaveError):
+        writer.flush()
+    assert writer.is_pending('target')
+
+    wait_for(lambda: not writer.is_pending('target'))
+    assert write.written == [('target', {'version': 1})]
+    writer.flush()
+
+def test_newer_data_replaces_a_failed_save(monkeypatch):
+    monkeypatch.setattr(app, 'SAVE_RETRY_DELAY', 0.05)
+    writer = app.WriteBehindWriter(0)
+    write = Recorder(failures=1)
+    writer.schedule({'version': 1}, 'target', write)
+    wait_for(lambda: write.calls)
+    writer.schedule({'version': 2}, 'target', write)
+    wait_for(lambda: not writer.is_pending('target'))
+
+    assert write.written == [('target', {'version': 2})]
+
+def test_runtime_errors_back_off(monkeypatch):
+    monkeypatch.setattr(app, 'SAVE_RETRY_DELAY', 60)
+    writer = app.WriteBehindWriter(0)
+    write = Recorder(failures=2, error=RuntimeError('dictionary changed size during iteration'))
+    writer.schedule({'version': 1}, 'target', write)
+    wait_for(lambda: write.calls)
+    time.sleep(0.2)
+
+    assert len(write.calls) == 1
+    assert writer.is_pending('target')
+
+def test_interpreter_shutdown_is_retried_at_once(monkeypatch):
+    monkeypatch.setattr(app, 'SAVE_RETRY_DELAY', 60)
+    writer = app.WriteBehindWriter(0)
+    write = Recorder(failures=2, error=RuntimeError("can't create new thread at interpreter shutdown"))
+    writer.schedule({'version': 1}, 'target', write)
+    wait_for(lambda: write.written, timeout=1)
+
+    assert len(write.calls) == 3